@@ -30,6 +30,10 @@ global_udev = pyudev.Udev()
 import logging
 log = logging.getLogger("storage")
 
+# number of times udev_trigger has been run, so that cached views of the
+# udev database know when they have to wait for udev to catch up
+trigger_count = 0
+
 def udev_enumerate_devices(deviceClass="block"):
     devices = global_udev.enumerate_devices(subsystem=deviceClass)
     return [path[4:] for path in devices]
@@ -85,6 +89,9 @@ def udev_settle():
     iutil.execWithRedirect("udevadm", argv, stderr="/dev/null")
 
 def udev_trigger(subsystem=None, action="add"):
+    global trigger_count
+    trigger_count += 1
+
     argv = ["trigger", "--action=%s" % action]
     if subsystem:
         argv.append("--subsystem-match=%s" % subsystem)
@@ -0,0 +1,454 @@
+#
+# blockcopy.py - raw block device copy helpers
+#
+# Copyright (C) 2010 Fabio Erculiani
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import mmap
+import stat
+import errno
+import fcntl
+import struct
+import ctypes
+import ctypes.util
+import threading
+import Queue
+
+import iutil
+
+import logging
+log = logging.getLogger("anaconda")
+
+# O_DIRECT transfers must be aligned to the logical block size of the
+# devices involved, 4096 is a safe choice for all of them
+DIRECT_ALIGNMENT = 4096
+DEFAULT_CHUNK_SIZE = 1024 * 1024 * 8
+# unused regions smaller than this are copied anyway, it's cheaper than
+# splitting the stream
+MERGE_GAP = 1024 * 1024
+
+# lseek(2) whence values
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# linux/fs.h block device ioctls, they take a (start, length) u64 pair
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+# linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# errors telling us that zeroing/discarding is not supported
+_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+    errno.ENOSYS)
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+
+# always use the 64bit offset variants, 32bit off_t would not allow
+# copying devices bigger than 2GiB
+_pread = getattr(_libc, "pread64", _libc.pread)
+_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+    ctypes.c_int64]
+_pread.restype = ctypes.c_ssize_t
+
+_pwrite = getattr(_libc, "pwrite64", _libc.pwrite)
+_pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+    ctypes.c_int64]
+_pwrite.restype = ctypes.c_ssize_t
+
+_fallocate = getattr(_libc, "fallocate64", None) or \
+    getattr(_libc, "fallocate", None)
+if _fallocate is not None:
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+        ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+
+_memcmp = _libc.memcmp
+_memcmp.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+_memcmp.restype = ctypes.c_int
+
+
+def _check_io(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+class AlignedBuffer(object):
+    """
+    Page aligned memory buffer usable with O_DIRECT file descriptors.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # anonymous mappings are always page aligned
+        self._map = mmap.mmap(-1, size)
+        self._cbuf = (ctypes.c_char * size).from_buffer(self._map)
+        self.address = ctypes.addressof(self._cbuf)
+        self.length = 0
+
+    def pread(self, fd, count, offset):
+        """
+        Fill the buffer with up to count bytes read from fd at offset.
+        """
+        done = 0
+        while done < count:
+            ret = _pread(fd, self.address + done, count - done, offset + done)
+            if ret < 0 and ctypes.get_errno() == errno.EINTR:
+                continue
+            if _check_io(ret) == 0:
+                break
+            done += ret
+        self.length = done
+        return done
+
+    def pwrite(self, fd, offset):
+        """
+        Write the buffer content to fd at offset.
+        """
+        done = 0
+        while done < self.length:
+            ret = _pwrite(fd, self.address + done, self.length - done,
+                offset + done)
+            if ret < 0 and ctypes.get_errno() == errno.EINTR:
+                continue
+            done += _check_io(ret)
+        return done
+
+    def is_zero(self, zero_buf):
+        """
+        Return True if the buffer content is all zeroes. zero_buf must be
+        a zero filled AlignedBuffer at least as big as this one.
+        """
+        return _memcmp(self.address, zero_buf.address, self.length) == 0
+
+    def close(self):
+        del self._cbuf
+        self._map.close()
+
+
+def get_ext_used_ranges(device):
+    """
+    Return the list of (offset, length) byte ranges of the ext2/3/4
+    filesystem on device that are in use according to its block
+    allocation bitmaps, as reported by dumpe2fs.
+    """
+    output = iutil.execWithCapture("dumpe2fs", [device],
+        stderr = "/dev/null")
+    block_size = None
+    block_count = None
+    free = []
+    for line in output.split("\n"):
+        if line.startswith("Block size:"):
+            block_size = int(line.split(":", 1)[1])
+        elif line.startswith("Block count:"):
+            block_count = int(line.split(":", 1)[1])
+        elif line[:1].isspace() and line.strip().startswith("Free blocks:"):
+            # per group list, like "  Free blocks: 12768-32767, 32801"
+            for item in line.split(":", 1)[1].split(","):
+                item = item.strip()
+                if not item:
+                    continue
+                first, sep, last = item.partition("-")
+                free.append((int(first), int(last or first)))
+
+    if block_size is None or block_count is None:
+        raise ValueError("cannot parse dumpe2fs output for %s" % (device,))
+
+    free.sort()
+    ranges = []
+    next_used = 0
+    for first, last in free:
+        if first > next_used:
+            ranges.append((next_used * block_size,
+                (first - next_used) * block_size))
+        next_used = max(next_used, last + 1)
+    if next_used < block_count:
+        ranges.append((next_used * block_size,
+            (block_count - next_used) * block_size))
+    return ranges
+
+def get_data_ranges(path, size):
+    """
+    Return the list of (offset, length) byte ranges of the first size
+    bytes of path that contain data, using SEEK_DATA/SEEK_HOLE. Block
+    devices and filesystems without hole reporting are all data.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return [(0, size)]
+        ranges = []
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as err:
+                if err.errno == errno.ENXIO:
+                    # no data past offset
+                    break
+                if err.errno == errno.EINVAL:
+                    return [(0, size)]
+                raise
+            if start >= size:
+                break
+            end = min(size, os.lseek(fd, start, SEEK_HOLE))
+            ranges.append((start, end - start))
+            offset = end
+        return ranges
+    finally:
+        os.close(fd)
+
+def _normalize_ranges(ranges, size):
+    """
+    Align ranges outwards to DIRECT_ALIGNMENT, clip them to size and
+    merge the overlapping or close ones.
+    """
+    merged = []
+    for offset, length in sorted(ranges):
+        start = offset - offset % DIRECT_ALIGNMENT
+        end = offset + length
+        end = min(size, end + (-end) % DIRECT_ALIGNMENT)
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1] + MERGE_GAP:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end - start) for start, end in merged]
+
+
+def open_device(path, flags, direct = True):
+    """
+    Open path, with O_DIRECT if requested and supported. Return a tuple
+    composed by the file descriptor and a boolean telling whether
+    O_DIRECT is in use.
+    """
+    if direct:
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError as err:
+            if err.errno != errno.EINVAL:
+                raise
+            log.info("open_device: O_DIRECT not supported on %s" % (path,))
+    return os.open(path, flags), False
+
+
+class BlockCopier(object):
+    """
+    Stream size bytes from the source block device (or image) onto the
+    target one.
+
+    Transfers use large aligned buffers and, where supported, O_DIRECT so
+    that the page cache is not trashed. Reading and writing are double
+    buffered: a reader thread fills a buffer while the calling thread
+    writes the previous one, so source and target work concurrently.
+
+    If ranges is given, only those (offset, length) byte ranges of the
+    source are copied, see get_ext_used_ranges() and get_data_ranges().
+    All-zero chunks are never written: the target range is zeroed with
+    BLKZEROOUT (or a hole is punched in image files) instead. With
+    discard, the unused regions of the target are discarded too.
+    """
+
+    def __init__(self, source, dest, size, chunk_size = DEFAULT_CHUNK_SIZE,
+                 buffers = 2, direct = True, ranges = None, discard = False):
+        self._source = source
+        self._dest = dest
+        self._size = size
+        # keep chunks aligned, the tail is handled separately
+        self._chunk_size = max(DIRECT_ALIGNMENT,
+            chunk_size - chunk_size % DIRECT_ALIGNMENT)
+        self._buffers = max(2, buffers)
+        self._direct = direct
+        if ranges is None:
+            ranges = [(0, size)]
+        self._ranges = _normalize_ranges(ranges, size)
+        self._discard = discard
+        self._dest_is_blockdev = False
+        self._can_zero = True
+        self.copied_bytes = 0
+        self.zeroed_bytes = 0
+        self.discarded_bytes = 0
+
+    @property
+    def total_bytes(self):
+        """ Amount of bytes that are going to be processed. """
+        return sum([length for offset, length in self._ranges])
+
+    def _chunks(self, end):
+        for offset, length in self._ranges:
+            range_end = min(offset + length, end)
+            while offset < range_end:
+                count = min(self._chunk_size, range_end - offset)
+                yield offset, count
+                offset += count
+
+    def _reader(self, fd, end, free_q, full_q, errors):
+        try:
+            for offset, count in self._chunks(end):
+                buf = free_q.get()
+                if buf is None:
+                    return
+                if buf.pread(fd, count, offset) != count:
+                    raise IOError(errno.EIO,
+                        "short read from %s at offset %d" % (
+                            self._source, offset))
+                full_q.put((offset, buf))
+        except:
+            errors.append(sys.exc_info())
+        full_q.put(None)
+
+    def _range_request(self, fd, request, offset, length):
+        """
+        Zero (request = BLKZEROOUT) or discard (request = BLKDISCARD) the
+        given target range. Image files get a hole punched in both cases.
+        Return False if not supported.
+        """
+        try:
+            if self._dest_is_blockdev:
+                fcntl.ioctl(fd, request, struct.pack("QQ", offset, length))
+                return True
+            if _fallocate is None:
+                return False
+            ret = _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                offset, length)
+            _check_io(ret)
+            return True
+        except (IOError, OSError) as err:
+            if err.errno in _UNSUPPORTED_ERRNOS:
+                return False
+            raise
+
+    def _write(self, fd, offset, buf, zero_buf):
+        if self._can_zero and buf.is_zero(zero_buf):
+            if self._range_request(fd, BLKZEROOUT, offset, buf.length):
+                self.zeroed_bytes += buf.length
+                return buf.length
+            log.info("BlockCopier: cannot zero out %s, writing zeroes" % (
+                self._dest,))
+            self._can_zero = False
+        return buf.pwrite(fd, offset)
+
+    def _discard_unused(self, fd):
+        offset = 0
+        for start, length in self._ranges + [(self._size, 0)]:
+            if start > offset:
+                if not self._range_request(fd, BLKDISCARD, offset,
+                                           start - offset):
+                    log.info("BlockCopier: discard not supported on %s" % (
+                        self._dest,))
+                    return
+                self.discarded_bytes += start - offset
+            offset = start + length
+
+    def run(self, callback = None):
+        """
+        Do the copy. If given, callback is called after every chunk with
+        the amount of bytes copied so far.
+        """
+        in_fd, in_direct = open_device(self._source, os.O_RDONLY,
+            direct = self._direct)
+        try:
+            out_fd, out_direct = open_device(self._dest, os.O_WRONLY,
+                direct = self._direct)
+            try:
+                out_st = os.fstat(out_fd)
+                self._dest_is_blockdev = stat.S_ISBLK(out_st.st_mode)
+                if stat.S_ISREG(out_st.st_mode) and \
+                        out_st.st_size < self._size:
+                    os.ftruncate(out_fd, self._size)
+                self._copy(in_fd, out_fd, in_direct or out_direct, callback)
+                if self._discard:
+                    self._discard_unused(out_fd)
+                os.fsync(out_fd)
+            finally:
+                os.close(out_fd)
+        finally:
+            os.close(in_fd)
+
+    def _copy(self, in_fd, out_fd, direct, callback):
+        end = self._size
+        if direct:
+            # copy the unaligned tail separately, without O_DIRECT
+            end -= end % DIRECT_ALIGNMENT
+
+        buffers = [AlignedBuffer(self._chunk_size) for x in \
+            range(self._buffers)]
+        zero_buf = AlignedBuffer(self._chunk_size)
+        free_q = Queue.Queue()
+        full_q = Queue.Queue()
+        for buf in buffers:
+            free_q.put(buf)
+        errors = []
+
+        reader = threading.Thread(target = self._reader,
+            args = (in_fd, end, free_q, full_q, errors))
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                item = full_q.get()
+                if item is None:
+                    break
+                offset, buf = item
+                self.copied_bytes += self._write(out_fd, offset, buf,
+                    zero_buf)
+                free_q.put(buf)
+                if callback is not None:
+                    callback(self.copied_bytes)
+        finally:
+            # make sure the reader does not block forever
+            free_q.put(None)
+            reader.join()
+            for buf in buffers:
+                buf.close()
+            zero_buf.close()
+
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+        if end < self._size and self._ranges and \
+                self._ranges[-1][0] + self._ranges[-1][1] > end:
+            tail_start = max(end, self._ranges[-1][0])
+            self._copy_tail(tail_start, self._size - tail_start)
+            if callback is not None:
+                callback(self.copied_bytes)
+
+    def _copy_tail(self, offset, count):
+        in_fd = os.open(self._source, os.O_RDONLY)
+        try:
+            out_fd = os.open(self._dest, os.O_WRONLY)
+            try:
+                buf = AlignedBuffer(max(count, DIRECT_ALIGNMENT))
+                try:
+                    if buf.pread(in_fd, count, offset) != count:
+                        raise IOError(errno.EIO,
+                            "short read from %s at offset %d" % (
+                                self._source, offset))
+                    self.copied_bytes += buf.pwrite(out_fd, offset)
+                finally:
+                    buf.close()
+                os.fsync(out_fd)
+            finally:
+                os.close(out_fd)
+        finally:
+            os.close(in_fd)
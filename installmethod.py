@@ -25,6 +25,7 @@ import logging
 log = logging.getLogger("anaconda")
 
 import isys, product
+from storage.devicelibs import mdraid
 
 def doMethodComplete(anaconda):
     def _ejectDevice():
@@ -42,6 +43,12 @@ def doMethodComplete(anaconda):
             return anaconda.storage.devicetree.getDeviceByName(dev)
 
     anaconda.backend.complete(anaconda)
+
+    # the install is done, so let the arrays resync at full speed
+    for array in anaconda.storage.mdarrays:
+        log.info("%s resync: %s" % (array.name, array.resyncProgress))
+    mdraid.mdrestore_resync()
+
     dev = _ejectDevice()
     if dev:
         dev.eject()
@@ -22,6 +22,7 @@
 
 import glob
 import os, string, stat, sys
+import fcntl
 import signal
 import os.path
 from errno import *
@@ -30,7 +31,9 @@ import subprocess
 from flags import flags
 from constants import *
 import re
+import select
 import threading
+import time
 
 import gettext
 _ = lambda x: gettext.ldgettext("anaconda", x)
@@ -39,49 +42,25 @@ import logging
 log = logging.getLogger("anaconda")
 program_log = logging.getLogger("program")
 
-#Python reimplementation of the shell tee process, so we can
-#feed the pipe output into two places at the same time
-class tee(threading.Thread):
-    def __init__(self, inputdesc, outputdesc, logmethod):
-        threading.Thread.__init__(self)
-        self.inputdesc = os.fdopen(inputdesc, "r")
-        self.outputdesc = outputdesc
-        self.logmethod = logmethod
-        self.running = True
-
-    def run(self):
-        while self.running:
-            data = self.inputdesc.readline()
-            if data == "":
-                self.running = False
-            else:
-                self.logmethod(data.rstrip('\n'))
-                os.write(self.outputdesc, data)
-
-    def stop(self):
-        self.running = False
-        return self
+# how much of a program's output is read at once
+READ_CHUNK_SIZE = 65536
+# how long (in ms) to wait for a program's output before checking whether
+# it is still running
+POLL_INTERVAL = 100
 
-## Run an external program and redirect the output to a file.
-# @param command The command to run.
-# @param argv A list of arguments.
-# @param stdin The file descriptor to read stdin from.
-# @param stdout The file descriptor to redirect stdout to.
-# @param stderr The file descriptor to redirect stderr to.
-# @param root The directory to chroot to before running command.
-# @return The return code of command.
-def execWithRedirect(command, argv, stdin = None, stdout = None,
-                     stderr = None, root = '/'):
-    def chroot ():
-        os.chroot(root)
+def _openRedirects(stdin, stdout, stderr):
+    """ Turn the stdin, stdout and stderr arguments of the execWith*
+        functions into file descriptors.
 
-    stdinclose = stdoutclose = stderrclose = lambda : None
+        Returns the three descriptors and a function closing those that
+        were opened here.
+    """
+    opened = []
 
-    argv = list(argv)
     if isinstance(stdin, str):
         if os.access(stdin, os.R_OK):
             stdin = os.open(stdin, os.O_RDONLY)
-            stdinclose = lambda : os.close(stdin)
+            opened.append(stdin)
         else:
             stdin = sys.stdin.fileno()
     elif isinstance(stdin, int):
@@ -91,7 +70,7 @@ def execWithRedirect(command, argv, stdin = None, stdout = None,
 
     if isinstance(stdout, str):
         stdout = os.open(stdout, os.O_RDWR|os.O_CREAT)
-        stdoutclose = lambda : os.close(stdout)
+        opened.append(stdout)
     elif isinstance(stdout, int):
         pass
     elif stdout is None or not isinstance(stdout, file):
@@ -99,69 +78,211 @@ def execWithRedirect(command, argv, stdin = None, stdout = None,
 
     if isinstance(stderr, str):
         stderr = os.open(stderr, os.O_RDWR|os.O_CREAT)
-        stderrclose = lambda : os.close(stderr)
+        opened.append(stderr)
     elif isinstance(stderr, int):
         pass
     elif stderr is None or not isinstance(stderr, file):
         stderr = sys.stderr.fileno()
 
-    program_log.info("Running... %s" % (" ".join([command] + argv),))
-
-    #prepare os pipes for feeding tee proceses
-    pstdout, pstdin = os.pipe()
-    perrout, perrin = os.pipe()
-   
-    env = os.environ.copy()
-    env.update({"LC_ALL": "C", "LANGUAGE": "C", "LANG": "C"})
+    def closefds():
+        while opened:
+            os.close(opened.pop())
+
+    return (stdin, stdout, stderr, closefds)
+
+class _Program(object):
+    """ A program started by a ProgramRunner. """
+    def __init__(self, command, argv, proc, closefds):
+        self.command = command
+        self.argv = argv
+        self.proc = proc
+        self.closefds = closefds
+        self.fds = []
+        self.returncode = None
+        self.started = time.time()
+        self.elapsed = None
+
+class ProgramRunner(object):
+    """ Runs programs, copying their output both to a file descriptor and
+        to the program log.
+
+        Instead of a pair of threads per program, a single poll() loop
+        serves the output of every program the runner has going, in
+        whichever thread happens to be waiting for one of them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._poller = select.poll()
+        # pipe fd -> [program, pipe, target fd, log method, partial line]
+        self._outputs = {}
+        # programs whose exit has not been noticed yet
+        self._running = []
+
+    def start(self, command, argv, stdin=None, stdout=None, stderr=None,
+              root='/'):
+        """ Start a program and return it, see execWithRedirect. """
+        def preexec():
+            os.chroot(root)
+            # only the child needs the C locale, so there is no need to
+            # copy our whole environment for it
+            os.environ.update({"LC_ALL": "C", "LANGUAGE": "C", "LANG": "C"})
+
+        argv = list(argv)
+        (stdin, stdout, stderr, closefds) = _openRedirects(stdin, stdout,
+                                                           stderr)
+        program_log.info("Running... %s" % (" ".join([command] + argv),))
+
+        self._lock.acquire()
+        try:
+            try:
+                proc = subprocess.Popen([command] + argv, stdin=stdin,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        preexec_fn=preexec, cwd=root)
+            except OSError as e:
+                errstr = "Error running %s: %s" % (command, e.strerror)
+                log.error(errstr)
+                program_log.error(errstr)
+                closefds()
+                raise RuntimeError, errstr
+
+            program = _Program(command, argv, proc, closefds)
+            self._running.append(program)
+            for (pipe, target, logmethod) in \
+                    ((proc.stdout, stdout, program_log.info),
+                     (proc.stderr, stderr, program_log.error)):
+                fd = pipe.fileno()
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+                self._outputs[fd] = [program, pipe, target, logmethod, '']
+                self._poller.register(fd, select.POLLIN | select.POLLPRI)
+                program.fds.append(fd)
+        finally:
+            self._lock.release()
+
+        return program
+
+    def wait(self, program):
+        """ Wait for a program to exit and return its exit status. """
+        while program.fds:
+            self._lock.acquire()
+            try:
+                if program.returncode is None:
+                    self._pump(POLL_INTERVAL)
+                    map(self._reap, self._running[:])
+                elif not set(self._pump(0)) & set(program.fds):
+                    # it has exited and there is nothing left to read; the
+                    # pipes may be held open by something it left running
+                    for fd in program.fds[:]:
+                        self._closeOutput(fd)
+            finally:
+                self._lock.release()
+
+        if program.returncode is None:
+            program.proc.wait()
+            self._lock.acquire()
+            try:
+                self._reap(program)
+            finally:
+                self._lock.release()
+
+        program.closefds()
+        program_log.debug("%s exited with status %s after %.3fs"
+                          % (program.command, program.returncode,
+                             program.elapsed))
+        return program.returncode
+
+    def _reap(self, program):
+        if program.returncode is None and program.proc.poll() is not None:
+            program.returncode = program.proc.returncode
+            program.elapsed = time.time() - program.started
+            self._running.remove(program)
+
+    def _pump(self, timeout):
+        """ Copy and log the output that is ready, of all the programs.
+
+            Returns the pipe fds that were ready.
+        """
+        try:
+            events = self._poller.poll(timeout)
+        except select.error as e:
+            if e.args[0] != EINTR:
+                raise IOError, e.args
+            return []
 
-    try:
-        #prepare tee proceses
-        proc_std = tee(pstdout, stdout, program_log.info)
-        proc_err = tee(perrout, stderr, program_log.error)
+        ready = []
+        for (fd, event) in events:
+            try:
+                data = os.read(fd, READ_CHUNK_SIZE)
+            except OSError as e:
+                if e.errno != EINTR:
+                    raise IOError, e.args
+                continue
+
+            ready.append(fd)
+            if not data:
+                self._closeOutput(fd)
+                continue
+
+            output = self._outputs[fd]
+            try:
+                os.write(output[2], data)
+            except OSError as e:
+                log.debug("failed to copy output of %s: %s"
+                          % (output[0].command, e.strerror))
 
-        #start monitoring the outputs
-        proc_std.start()
-        proc_err.start()
+            lines = (output[4] + data).split('\n')
+            output[4] = lines.pop()
+            map(output[3], lines)
 
-        proc = subprocess.Popen([command] + argv, stdin=stdin,
-                                stdout=pstdin,
-                                stderr=perrin,
-                                preexec_fn=chroot, cwd=root,
-                                env=env)
+        return ready
 
-        proc.wait()
-        ret = proc.returncode
+    def _closeOutput(self, fd):
+        (program, pipe, target, logmethod, partial) = self._outputs.pop(fd)
+        self._poller.unregister(fd)
+        if partial:
+            logmethod(partial)
 
-        #close the input ends of pipes so we get EOF in the tee processes
-        os.close(pstdin)
-        os.close(perrin)
+        pipe.close()
+        program.fds.remove(fd)
 
-        #wait for the output to be written and destroy them
-        proc_std.join()
-        del proc_std
+_runner = ProgramRunner()
 
-        proc_err.join()
-        del proc_err
-
-        stdinclose()
-        stdoutclose()
-        stderrclose()
-    except OSError as e:
-        errstr = "Error running %s: %s" % (command, e.strerror)
-        log.error(errstr)
-        program_log.error(errstr)
-        #close the input ends of pipes so we get EOF in the tee processes
-        os.close(pstdin)
-        os.close(perrin)
-        proc_std.join()
-        proc_err.join()
+## Run an external program and redirect the output to a file.
+# @param command The command to run.
+# @param argv A list of arguments.
+# @param stdin The file descriptor to read stdin from.
+# @param stdout The file descriptor to redirect stdout to.
+# @param stderr The file descriptor to redirect stderr to.
+# @param root The directory to chroot to before running command.
+# @return The return code of command.
+def execWithRedirect(command, argv, stdin = None, stdout = None,
+                     stderr = None, root = '/'):
+    program = _runner.start(command, argv, stdin=stdin, stdout=stdout,
+                            stderr=stderr, root=root)
+    return _runner.wait(program)
 
-        stdinclose()
-        stdoutclose()
-        stderrclose()
-        raise RuntimeError, errstr
+## Run several independent external programs at the same time.
+# @param commands A list of (command, argv) tuples.
+# @param stdin The file descriptor to read stdin from.
+# @param stdout The file descriptor to redirect stdout to.
+# @param stderr The file descriptor to redirect stderr to.
+# @param root The directory to chroot to before running the commands.
+# @return A list of the return codes of the commands.
+def execManyWithRedirect(commands, stdin = None, stdout = None,
+                         stderr = None, root = '/'):
+    programs = []
+    try:
+        for (command, argv) in commands:
+            programs.append(_runner.start(command, argv, stdin=stdin,
+                                          stdout=stdout, stderr=stderr,
+                                          root=root))
+    except RuntimeError:
+        map(_runner.wait, programs)
+        raise
 
-    return ret
+    return map(_runner.wait, programs)
 
 ## Run an external program and capture standard out.
 # @param command The command to run.
@@ -232,6 +353,20 @@ def execWithCapture(command, argv, stdin = None, stderr = None, root='/'):
     closefds()
     return rc
 
+# how often (in seconds) at most execWithCallback calls its callback
+CALLBACK_INTERVAL = 0.1
+
+## Run an external program, passing its output to a callback.
+# @param command The command to run.
+# @param argv A list of arguments.
+# @param stdin The file descriptor to read stdin from.
+# @param stdout The file descriptor to echo stdout to.
+# @param stderr The file descriptor to redirect stderr to.
+# @param echo Whether to echo stdout.
+# @param callback Called with each batch of stdout data and callback_data.
+# @param callback_data Passed to callback.
+# @param root The directory to chroot to before running command.
+# @return The return code of command.
 def execWithCallback(command, argv, stdin = None, stdout = None,
                      stderr = None, echo = True, callback = None,
                      callback_data = None, root = '/'):
@@ -294,52 +429,89 @@ def execWithCallback(command, argv, stdin = None, stdout = None,
     os.close(p[1])
     os.close(p_stderr[1])
 
-    logline = ''
-    while 1:
-        try:
-            s = os.read(p[0], 1)
-        except OSError as e:
-            if e.errno != 4:
-                raise IOError, e.args
-
-        if echo:
-            os.write(stdout, s)
-
-        if s == '\n':
-            program_log.info(logline)
-            logline = ''
+    # read whatever stdout and stderr have in big chunks and only log
+    # complete lines of stdout; the callback gets all of stdout, but batched
+    # up so it runs at most once per CALLBACK_INTERVAL.  stderr is logged
+    # last, as callers look for error messages at the end of the log.
+    output = {p[0]: '', p_stderr[0]: ''}
+    poller = select.poll()
+    for fd in output:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    pid = 0
+    status = None
+    unsent = ''
+    lastcallback = 0
+    log_errors = ''
+    while output:
+        # once the child has exited only drain what is already there, the
+        # pipes may be held open by something it left running
+        if pid:
+            timeout = 0
         else:
-            logline += s
+            timeout = POLL_INTERVAL
 
-        if callback:
-            callback(s, callback_data=callback_data)
-
-        # break out early if the sub-process changes status.
-        # no need to flush the stream if the process has exited
         try:
-            (pid, status) = os.waitpid(childpid,os.WNOHANG)
-            if pid != 0:
-                break
-        except OSError as e:
-            log.critical("exception from waitpid: %s %s" %(e.errno, e.strerror))
+            events = poller.poll(timeout)
+        except select.error as e:
+            if e.args[0] != EINTR:
+                raise IOError, e.args
+            continue
 
-        if len(s) < 1:
+        if not events and pid:
             break
-    if len(logline) > 0:
-        program_log.info(logline)
 
-    log_errors = ''
-    while 1:
-        try:
-            err = os.read(p_stderr[0], 128)
-        except OSError as e:
-            if e.errno != 4:
-                raise IOError, e.args
-            break
-        log_errors += err
-        if len(err) < 1:
-            break
+        for (fd, event) in events:
+            try:
+                s = os.read(fd, READ_CHUNK_SIZE)
+            except OSError as e:
+                if e.errno != EINTR:
+                    raise IOError, e.args
+                continue
+
+            if not s:
+                poller.unregister(fd)
+                if fd == p[0] and output[fd]:
+                    program_log.info(output[fd])
+                elif fd == p_stderr[0]:
+                    log_errors += output[fd]
+                del output[fd]
+                continue
+
+            if fd == p_stderr[0]:
+                output[fd] += s
+                continue
+
+            if echo:
+                os.write(stdout, s)
+            unsent += s
+
+            lines = (output[fd] + s).split('\n')
+            output[fd] = lines.pop()
+            map(program_log.info, lines)
+
+        if callback and unsent and \
+           time.time() - lastcallback >= CALLBACK_INTERVAL:
+            callback(unsent, callback_data=callback_data)
+            unsent = ''
+            lastcallback = time.time()
+
+        # notice the sub-process changing status even if it did not
+        # close its output
+        if not pid:
+            try:
+                (pid, status) = os.waitpid(childpid, os.WNOHANG)
+            except OSError as e:
+                log.critical("exception from waitpid: %s %s" %(e.errno, e.strerror))
+
+    if output.get(p[0]):
+        program_log.info(output[p[0]])
+    log_errors += output.get(p_stderr[0], '')
     map(program_log.error, log_errors.splitlines())
+
+    if callback and unsent:
+        callback(unsent, callback_data=callback_data)
+
     os.close(p[0])
     os.close(p_stderr[0])
 
@@ -46,7 +46,7 @@ import partition_dialog_gui as p_d_g
 from partIntfHelpers import *
 from constants import *
 from partition_ui_helpers_gui import *
-from storage.partitioning import doPartitioning
+from storage.partitioning import doPartitioning, doIncrementalPartitioning
 from storage.partitioning import hasFreeDiskSpace
 from storage.devicelibs import lvm
 from storage.devices import devicePathToName, PartitionDevice
@@ -1018,87 +1018,123 @@ class PartitionWindow(InstallWindow):
         disks = self.storage.partitioned
         drvparent = self.tree.append(None)
         self.tree[drvparent]['Device'] = _("Hard Drives")
+        self.diskRows = {}
         for disk in disks:
             # add a parent node to the tree
             parent = self.tree.append(drvparent)
+            self.diskRows[disk.name] = parent
+            self.populateDisk(disk, parent)
 
-            self.tree[parent]['PyObject'] = disk
-            if disk.partitioned:
-                part = disk.format.firstPartition
-                extendedParent = None
-                while part:
-                    if part.type & parted.PARTITION_METADATA:
+        self.treeView.expand_all()
+        self.messageGraph.display()
+
+    def populateDisk(self, disk, parent):
+        """ Fill in the row of a disk and add rows for its contents. """
+        self.tree[parent]['PyObject'] = disk
+        if disk.partitioned:
+            part = disk.format.firstPartition
+            extendedParent = None
+            while part:
+                if part.type & parted.PARTITION_METADATA:
+                    part = part.nextPartition()
+                    continue
+
+                partName = devicePathToName(part.getDeviceNodeName())
+                device = self.storage.devicetree.getDeviceByName(partName)
+                if not device and not part.type & parted.PARTITION_FREESPACE:
+                    log.debug("can't find partition %s in device"
+                                       " tree" % partName)
+
+                # ignore the tiny < 1 MB free space partitions (#119479)
+                if part.getSize(unit="MB") <= 1.0 and \
+                   part.type & parted.PARTITION_FREESPACE:
+                    if not part.active or not device.bootable:
                         part = part.nextPartition()
                         continue
 
-                    partName = devicePathToName(part.getDeviceNodeName())
-                    device = self.storage.devicetree.getDeviceByName(partName)
-                    if not device and not part.type & parted.PARTITION_FREESPACE:
-                        log.debug("can't find partition %s in device"
-                                           " tree" % partName)
-
-                    # ignore the tiny < 1 MB free space partitions (#119479)
-                    if part.getSize(unit="MB") <= 1.0 and \
-                       part.type & parted.PARTITION_FREESPACE:
-                        if not part.active or not device.bootable:
-                            part = part.nextPartition()
-                            continue
-
-                    if device and device.isExtended:
-                        if extendedParent:
-                            raise RuntimeError, ("can't handle more than "
-                                                 "one extended partition per disk")
-                        extendedParent = self.tree.append(parent)
-                        iter = extendedParent
-                    elif device and device.isLogical:
-                        if not extendedParent:
-                            raise RuntimeError, ("crossed logical partition "
-                                                 "before extended")
-                        iter = self.tree.append(extendedParent)
-                    else:
-                        iter = self.tree.append(parent)
+                if device and device.isExtended:
+                    if extendedParent:
+                        raise RuntimeError, ("can't handle more than "
+                                             "one extended partition per disk")
+                    extendedParent = self.tree.append(parent)
+                    iter = extendedParent
+                elif device and device.isLogical:
+                    if not extendedParent:
+                        raise RuntimeError, ("crossed logical partition "
+                                             "before extended")
+                    iter = self.tree.append(extendedParent)
+                else:
+                    iter = self.tree.append(parent)
 
-                    if device and not device.isExtended:
-                        self.addDevice(device, iter)
+                if device and not device.isExtended:
+                    self.addDevice(device, iter)
+                else:
+                    # either extended or freespace
+                    if part.type & parted.PARTITION_FREESPACE:
+                        devstring = _("Free")
+                        ptype = ""
                     else:
-                        # either extended or freespace
-                        if part.type & parted.PARTITION_FREESPACE:
-                            devstring = _("Free")
-                            ptype = ""
-                        else:
-                            if device:
-                                devstring = device.name
-                            else:
-                                devstring = _("Unknown")
-                            ptype = _("Extended")
-
-                        self.tree[iter]['Device'] = devstring
-                        self.tree[iter]['Type'] = ptype
-                        size = part.getSize(unit="MB")
-                        if size < 1.0:
-                            sizestr = "< 1"
+                        if device:
+                            devstring = device.name
                         else:
-                            sizestr = "%Ld" % (size)
-                        self.tree[iter]['Size (MB)'] = sizestr
-                        self.tree[iter]['PyObject'] = device
+                            devstring = _("Unknown")
+                        ptype = _("Extended")
+
+                    self.tree[iter]['Device'] = devstring
+                    self.tree[iter]['Type'] = ptype
+                    size = part.getSize(unit="MB")
+                    if size < 1.0:
+                        sizestr = "< 1"
+                    else:
+                        sizestr = "%Ld" % (size)
+                    self.tree[iter]['Size (MB)'] = sizestr
+                    self.tree[iter]['PyObject'] = device
 
-                    part = part.nextPartition()
-            else:
-                # whole-disk formatting
-                self.addDevice(disk, parent)
+                part = part.nextPartition()
+        else:
+            # whole-disk formatting
+            self.addDevice(disk, parent)
 
-            # Insert a '\n' when device string is too long.  Usually when it
-            # contains '/dev/mapper'.  First column should be around 20 chars.
-            if len(disk.name) + len(disk.path) > 20:
-                separator = "\n"
-            else:
-                separator= " "
-            self.tree[parent]['Device'] = \
-                    "%s%s<span size=\"small\" color=\"gray\">(%s)</span>" \
-                    % (disk.name, separator, disk.path)
+        # Insert a '\n' when device string is too long.  Usually when it
+        # contains '/dev/mapper'.  First column should be around 20 chars.
+        if len(disk.name) + len(disk.path) > 20:
+            separator = "\n"
+        else:
+            separator= " "
+        self.tree[parent]['Device'] = \
+                "%s%s<span size=\"small\" color=\"gray\">(%s)</span>" \
+                % (disk.name, separator, disk.path)
+
+    def updateDisks(self, disks):
+        """ Redraw the rows and the stripe of the given disks only.
+
+            Returns False if other rows depend on these disks, in which
+            case everything has to be redrawn.
+        """
+        for disk in disks:
+            if disk.name not in self.diskRows:
+                return False
+
+            for container in self.storage.vgs + self.storage.mdarrays:
+                if container.dependsOn(disk):
+                    return False
+
+        for disk in disks:
+            parent = self.diskRows[disk.name]
+            child = self.tree.iter_children(parent)
+            while child and self.tree.remove(child):
+                pass
+
+            self.populateDisk(disk, parent)
 
         self.treeView.expand_all()
-        self.messageGraph.display()
+
+        stripe = self.stripeGraph.getDisplayed()
+        if stripe and stripe.obj in disks:
+            self.stripeGraph.shutDown()
+            self.stripeGraph.setDisplayed(stripe.obj)
+
+        return True
 
     def barviewActivateCB(self):
         """ Should be called when we double click on a slice"""
@@ -1291,17 +1327,20 @@ class PartitionWindow(InstallWindow):
                                         self.storage,
                                         device):
                 self.refresh()
-        elif doDeleteDevice(self.intf,
-                            self.storage,
-                            device):
+        else:
+            # the disk the partition leaves space on, if any
+            disk = getattr(device, "disk", None)
+            if not doDeleteDevice(self.intf, self.storage, device):
+                return
+
             if isinstance(device, storage.devices.PartitionDevice):
-                justRedraw = False
+                changed = [d for d in [disk] if d]
+                self.refresh(changed=changed)
             else:
-                justRedraw = True
                 if device.type == "lvmlv" and device in device.vg.lvs:
                     device.vg._removeLogVol(device)
 
-            self.refresh(justRedraw=justRedraw)
+                self.refresh(justRedraw=True)
 
     def createCB(self, *args):
         # First we must decide what parts of the create_storage_dialog
@@ -1577,16 +1616,23 @@ class PartitionWindow(InstallWindow):
         self.tree.clear()
         self.populate()
 
-    def refresh(self, justRedraw=None):
-        log.debug("refresh: justRedraw=%s" % justRedraw)
-        self.stripeGraph.shutDown()
-        self.tree.clear()
+    def refresh(self, justRedraw=None, changed=None):
+        """ Re-plan the partitions and redraw.
 
+            changed is a list of the partitions and disks an edit touched.
+            If it is given, only the disks the edit can affect are
+            re-planned and redrawn.
+        """
+        log.debug("refresh: justRedraw=%s changed=%s" % (justRedraw, changed))
+        disks = None
         if justRedraw:
             rc = 0
         else:
             try:
-                doPartitioning(self.storage)
+                if changed is None:
+                    doPartitioning(self.storage)
+                else:
+                    disks = doIncrementalPartitioning(self.storage, changed)
                 rc = 0
             except PartitioningError, msg:
                 self.intf.messageWindow(_("Error Partitioning"),
@@ -1621,8 +1667,13 @@ class PartitionWindow(InstallWindow):
                     #    for req in reqs:
                     #        req.ignoreBootConstraints = 1
 
-	if not rc == -1:
-	    self.populate()
+        if rc == -1:
+            self.stripeGraph.shutDown()
+            self.tree.clear()
+        elif disks is None or not self.updateDisks(disks):
+            self.stripeGraph.shutDown()
+            self.tree.clear()
+            self.populate()
 
         return rc
 
@@ -1685,7 +1736,13 @@ class PartitionWindow(InstallWindow):
                 # XXX we should handle exceptions here
                 self.anaconda.storage.devicetree.registerAction(action)
 
-            if self.refresh(justRedraw=not actions):
+            # a new request is built by the editor, device is only the
+            # placeholder it started from
+            changed = [a.device for a in actions]
+            if not isNew:
+                changed.append(device)
+
+            if self.refresh(justRedraw=not actions, changed=changed):
                 # autopart failed -- cancel the actions and try to get
                 # back to previous state
                 actions.reverse()
@@ -42,6 +42,7 @@ _ = lambda x: gettext.ldgettext("anaconda", x)
 import backend
 import isys
 import iutil
+import blockcopy
 
 import packages
 
@@ -181,20 +182,33 @@ class LiveCDCopyBackend(backend.AnacondaBackend):
         progress.processEvents()
 
         osimg = self._getLiveBlockDevice() # the real image
-        osfd = os.open(osimg, os.O_RDONLY)
 
         rootDevice = anaconda.storage.rootDevice
         rootDevice.setup()
-        rootfd = os.open(rootDevice.path, os.O_WRONLY)
 
-        readamt = 1024 * 1024 * 8 # 8 megs at a time
         size = self._getLiveSize()
-        copied = 0
-        while copied < size:
+        # only copy what the live filesystem actually uses
+        try:
+            if self.rootFsType in ("ext2", "ext3", "ext4"):
+                ranges = blockcopy.get_ext_used_ranges(osimg)
+            else:
+                ranges = blockcopy.get_data_ranges(osimg, size)
+        except (IOError, OSError, ValueError), e:
+            log.error("unable to get the used regions of %s: %s" %(osimg, e))
+            ranges = None
+
+        while True:
+            copier = blockcopy.BlockCopier(osimg, rootDevice.path, size,
+                                           ranges = ranges, discard = True)
+            total = float(copier.total_bytes)
+            def updateProgress(copied):
+                progress.set_fraction(pct = copied / total)
+                progress.processEvents()
+
             try:
-                buf = os.read(osfd, readamt)
-                written = os.write(rootfd, buf)
-            except:
+                copier.run(updateProgress)
+            except (IOError, OSError), e:
+                log.error("error copying the live image: %s" %(e,))
                 rc = anaconda.intf.messageWindow(_("Error"),
                         _("There was an error installing the live image to "
                           "your hard drive.  This could be due to bad media.  "
@@ -207,19 +221,12 @@ class LiveCDCopyBackend(backend.AnacondaBackend):
                 if rc == 0:
                     sys.exit(0)
                 else:
-                    os.lseek(osfd, 0, 0)
-                    os.lseek(rootfd, 0, 0)
-                    copied = 0
                     continue
+            break
 
-            if (written < readamt) and (written < len(buf)):
-                raise RuntimeError, "error copying filesystem!"
-            copied += written
-            progress.set_fraction(pct = copied / float(size))
-            progress.processEvents()
-
-        os.close(osfd)
-        os.close(rootfd)
+        log.info("copied %d bytes of the live image, zeroed %d, discarded %d"
+                 %(copier.copied_bytes - copier.zeroed_bytes,
+                   copier.zeroed_bytes, copier.discarded_bytes))
 
         anaconda.intf.setInstallProgressClass(None)
 
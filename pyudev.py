@@ -3,6 +3,7 @@ from __future__ import print_function
 import sys
 import os
 import fnmatch
+import select
 from ctypes import *
 
 
@@ -110,6 +111,31 @@ libudev_udev_enumerate_get_list_entry.argtypes = [ c_void_p ]
 libudev_udev_device_get_devlinks_list_entry = libudev.udev_device_get_devlinks_list_entry
 libudev_udev_device_get_devlinks_list_entry.restype = c_void_p
 libudev_udev_device_get_devlinks_list_entry.argtypes = [ c_void_p ]
+libudev_udev_device_get_action = libudev.udev_device_get_action
+libudev_udev_device_get_action.restype = c_char_p
+libudev_udev_device_get_action.argtypes = [ c_void_p ]
+
+libudev_udev_monitor_new_from_netlink = libudev.udev_monitor_new_from_netlink
+libudev_udev_monitor_new_from_netlink.restype = c_void_p
+libudev_udev_monitor_new_from_netlink.argtypes = [ c_void_p, c_char_p ]
+libudev_udev_monitor_unref = libudev.udev_monitor_unref
+libudev_udev_monitor_unref.argtypes = [ c_void_p ]
+
+libudev_udev_monitor_filter_add_match_subsystem_devtype = libudev.udev_monitor_filter_add_match_subsystem_devtype
+libudev_udev_monitor_filter_add_match_subsystem_devtype.restype = c_int
+libudev_udev_monitor_filter_add_match_subsystem_devtype.argtypes = [ c_void_p, c_char_p, c_char_p ]
+libudev_udev_monitor_set_receive_buffer_size = libudev.udev_monitor_set_receive_buffer_size
+libudev_udev_monitor_set_receive_buffer_size.restype = c_int
+libudev_udev_monitor_set_receive_buffer_size.argtypes = [ c_void_p, c_int ]
+libudev_udev_monitor_enable_receiving = libudev.udev_monitor_enable_receiving
+libudev_udev_monitor_enable_receiving.restype = c_int
+libudev_udev_monitor_enable_receiving.argtypes = [ c_void_p ]
+libudev_udev_monitor_get_fd = libudev.udev_monitor_get_fd
+libudev_udev_monitor_get_fd.restype = c_int
+libudev_udev_monitor_get_fd.argtypes = [ c_void_p ]
+libudev_udev_monitor_receive_device = libudev.udev_monitor_receive_device
+libudev_udev_monitor_receive_device.restype = c_void_p
+libudev_udev_monitor_receive_device.argtypes = [ c_void_p ]
 
 
 class UdevDevice(dict):
@@ -168,6 +194,58 @@ class UdevDevice(dict):
         libudev_udev_device_unref(udev_device)
 
 
+class UdevMonitor(object):
+
+    # large enough to hold the events of a few thousand devices appearing
+    # at once between two reads
+    RECEIVE_BUFFER_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def fileno(self):
+        return libudev_udev_monitor_get_fd(self.monitor)
+
+    def receive_event(self, timeout=0):
+        """ Wait up to timeout seconds for the next event.
+
+            Return an (action, syspath) tuple, or None if no event arrived.
+        """
+        poller = select.poll()
+        poller.register(self.fileno(), select.POLLIN)
+        if not poller.poll(int(timeout * 1000)):
+            return None
+
+        udev_device = libudev_udev_monitor_receive_device(self.monitor)
+        if not udev_device:
+            return None
+
+        action = libudev_udev_device_get_action(udev_device)
+        syspath = libudev_udev_device_get_syspath(udev_device)
+
+        # cleanup
+        libudev_udev_device_unref(udev_device)
+
+        return (action, syspath)
+
+    def receive_events(self, timeout=0):
+        """ Return the list of (action, syspath) events already queued.
+
+            If timeout is given, wait up to that long for the first one.
+        """
+        events = []
+        event = self.receive_event(timeout)
+        while event:
+            events.append(event)
+            event = self.receive_event()
+
+        return events
+
+    def unref(self):
+        libudev_udev_monitor_unref(self.monitor)
+        self.monitor = None
+
+
 class Udev(object):
 
     def __init__(self):
@@ -222,6 +300,37 @@ class Udev(object):
             if device:
                 yield device
 
+    def create_monitor(self, subsystem=None):
+        """ Return a UdevMonitor receiving events after udev processed them.
+
+            Return None if the monitor could not be set up.
+        """
+        monitor = libudev_udev_monitor_new_from_netlink(self.udev, "udev")
+        if not monitor:
+            print("error: unable to create the udev monitor", file=sys.stderr)
+            return None
+
+        # add the match subsystem
+        if subsystem is not None:
+            rc = libudev_udev_monitor_filter_add_match_subsystem_devtype(
+                                                    monitor, subsystem, None)
+            if not rc == 0:
+                print("error: unable to add the match subsystem", file=sys.stderr)
+                libudev_udev_monitor_unref(monitor)
+                return None
+
+        # not fatal, the default buffer will do for smaller systems
+        libudev_udev_monitor_set_receive_buffer_size(monitor,
+                                        UdevMonitor.RECEIVE_BUFFER_SIZE)
+
+        rc = libudev_udev_monitor_enable_receiving(monitor)
+        if not rc == 0:
+            print("error: unable to enable receiving udev events", file=sys.stderr)
+            libudev_udev_monitor_unref(monitor)
+            return None
+
+        return UdevMonitor(monitor)
+
     def unref(self):
         libudev_udev_unref(self.udev)
         self.udev = None
@@ -231,6 +231,10 @@ FIREWALL_PACKAGE = "net-firewall/ufw"
 FIREWALL_SERVICE = "ufw"
 
 LIVE_USER = "sabayonuser"
+# live image manifest, shipped in the image (relative to its root) or
+# generated and cached on first use
+LIVE_MANIFEST = "/usr/share/anaconda/live.manifest"
+LIVE_MANIFEST_CACHE = "/tmp/live.manifest"
 REPO_NAME = "sabayonlinux.org"
 
 SB_PRIVATE_KEY = "/boot/SecureBoot/user-private.key"
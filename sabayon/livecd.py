@@ -38,10 +38,13 @@ from constants import productPath as PRODUCT_PATH, productName as PRODUCT_NAME,
 import backend
 import isys
 import iutil
+import blockcopy
 import logging
 from anaconda_log import PROGRAM_LOG_FILE
 import sabayon.utils
+import sabayon.livecopy
 from sabayon import Entropy
+from sabayon.const import LIVE_MANIFEST, LIVE_MANIFEST_CACHE
 
 # Entropy imports
 from entropy.const import etpConst, const_kill_threads
@@ -51,6 +54,11 @@ import entropy.tools
 
 log = logging.getLogger("anaconda")
 
+# room the target filesystem needs on top of the copied data: the inode
+# tables and other metadata, plus the journal
+LIVE_FS_OVERHEAD = 0.05
+LIVE_FS_JOURNAL = 128 * 1048576
+
 class LiveCDCopyBackend(backend.AnacondaBackend):
 
     def __init__(self, anaconda):
@@ -71,6 +79,15 @@ class LiveCDCopyBackend(backend.AnacondaBackend):
             raise SystemExit(1)
 
     def _getLiveSize(self):
+        for manifest_path in (PRODUCT_PATH + LIVE_MANIFEST,
+                              LIVE_MANIFEST_CACHE):
+            try:
+                usage = sabayon.livecopy.LiveManifest.read_disk_usage(
+                    manifest_path)
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            return int(usage * (1 + LIVE_FS_OVERHEAD)) + LIVE_FS_JOURNAL
+
         st = os.statvfs(PRODUCT_PATH)
         compressed_byte_size = st.f_blocks * st.f_bsize
         return compressed_byte_size * 3 # 3 times is enough
@@ -78,6 +95,146 @@ class LiveCDCopyBackend(backend.AnacondaBackend):
     def _getLiveSizeMB(self):
         return self._getLiveSize() / 1048576
 
+    def _getLiveRootDevice(self):
+        """
+        Return a (device, fstype, read_only) tuple describing the block
+        device backing the live root, or (None, None, None).
+        """
+        live_root = (None, None, None)
+        with open("/proc/mounts", "r") as mounts_f:
+            for line in mounts_f:
+                items = line.split()
+                if len(items) < 4 or items[1] != PRODUCT_PATH:
+                    continue
+                # last entry wins, it's the one on top
+                live_root = (items[0], items[2],
+                    "ro" in items[3].split(","))
+        return live_root
+
+    def _getExtFsSize(self, device):
+        output = iutil.execWithCapture("dumpe2fs", ["-h", device],
+            stderr = "/dev/null")
+        fields = {}
+        for line in output.split("\n"):
+            key, sep, value = line.partition(":")
+            if sep:
+                fields[key.strip()] = value.strip()
+        return int(fields["Block count"]) * int(fields["Block size"])
+
+    def _canCloneLiveRoot(self, anaconda):
+        """
+        Return True if the live root filesystem can be streamed as is
+        onto the target root device instead of being copied file by file.
+        """
+        def _reject(reason):
+            log.info("Not cloning the live root: %s" % (reason,))
+            return False
+
+        if os.getenv("SABAYON_DISABLE_BLOCK_CLONE"):
+            return _reject("disabled by SABAYON_DISABLE_BLOCK_CLONE")
+
+        live_dev, live_fstype, read_only = self._getLiveRootDevice()
+        if live_dev is None or not live_dev.startswith("/dev/"):
+            return _reject("live root is not backed by a block device")
+        if live_fstype not in ("ext2", "ext3", "ext4"):
+            return _reject("live root filesystem is %s" % (live_fstype,))
+        if not read_only:
+            return _reject("live root is mounted read-write")
+
+        # every mount point but / would need its own copy
+        mountpoints = anaconda.storage.mountpoints.keys()
+        if mountpoints != ["/"]:
+            return _reject("separate mount points: %s" % (
+                sorted(mountpoints),))
+
+        root_device = anaconda.storage.rootDevice
+        if root_device.format.type != live_fstype:
+            return _reject("target root filesystem is %s" % (
+                root_device.format.type,))
+        if not root_device.format.resizable:
+            return _reject("target root filesystem cannot be resized")
+        try:
+            live_size = self._getExtFsSize(live_dev)
+        except (KeyError, ValueError), err:
+            return _reject("cannot read the live root size: %s" % (err,))
+        if root_device.size < live_size / 1048576:
+            return _reject("target root device is too small")
+
+        return True
+
+    def _cloneLiveRoot(self, anaconda):
+        """
+        Stream the live root filesystem onto the target root device, then
+        grow it to the device size and give it its own UUID.
+        """
+        live_dev = self._getLiveRootDevice()[0]
+        size = self._getExtFsSize(live_dev)
+        root_device = anaconda.storage.rootDevice
+
+        anaconda.storage.umountFilesystems(swapoff = False)
+        root_device.setup()
+
+        log.info("Cloning live root %s (%d bytes) onto %s" % (
+            live_dev, size, root_device.path,))
+        self._progress.set_text(_("Cloning the live image"))
+        self._progress.set_fraction(0.0)
+
+        try:
+            ranges = blockcopy.get_ext_used_ranges(live_dev)
+        except ValueError, err:
+            log.error("Unable to read the live root allocation: %s" % (err,))
+            ranges = None
+
+        copier = blockcopy.BlockCopier(live_dev, root_device.path, size,
+            ranges = ranges, discard = True)
+        def _update_progress(copied_bytes):
+            self._progress.set_fraction(
+                float(copied_bytes) / copier.total_bytes)
+
+        try:
+            copier.run(_update_progress)
+        except (IOError, OSError), err:
+            log.error("Unable to clone the live root: %s" % (err,))
+            anaconda.intf.messageWindow(_("Error"),
+                _("There was an error installing the live image to "
+                  "your hard drive.  This could be due to bad media.  "
+                  "Please verify your installation media."),
+                type = "custom", custom_icon = "error",
+                custom_buttons = [_("_Exit installer")])
+            raise SystemExit(1)
+
+        # resize2fs wants a freshly checked filesystem, e2fsck returns 1
+        # when it fixed something, which is fine
+        commands = [("e2fsck", ["-f", "-y", root_device.path], 1),
+                    ("resize2fs", [root_device.path], 0),
+                    ("tune2fs", ["-U", "random", root_device.path], 0)]
+        if root_device.format.label:
+            commands.append(("tune2fs",
+                ["-L", root_device.format.label, root_device.path], 0))
+        for command, args, max_rc in commands:
+            rc = iutil.execWithRedirect(command, args,
+                stdout = PROGRAM_LOG_FILE, stderr = PROGRAM_LOG_FILE)
+            if rc > max_rc:
+                # the filesystem is unchecked, not grown or still shares
+                # the live image UUID, don't install onto it
+                log.error("%s %s failed with exit status %s" % (
+                    command, args, rc,))
+                anaconda.intf.messageWindow(_("Error"),
+                    _("There was an error preparing the installed live "
+                      "image on %s (%s exited with status %s).  Please "
+                      "check the logs and your hard drive.") % (
+                        root_device.path, command, rc,),
+                    type = "custom", custom_icon = "error",
+                    custom_buttons = [_("_Exit installer")])
+                raise SystemExit(1)
+
+        # the cloned filesystem has the live image UUID, catch the new one
+        root_device.format.uuid = isys.readFSUuid(root_device.path)
+        log.info("Cloned root %s has UUID %s" % (
+            root_device.path, root_device.format.uuid,))
+
+        anaconda.storage.mountFilesystems()
+
     def postAction(self, anaconda):
         try:
             anaconda.storage.umountFilesystems(swapoff = False)
@@ -117,7 +274,11 @@ class LiveCDCopyBackend(backend.AnacondaBackend):
         self._progress.set_fraction(0.0)
 
         # Actually install
-        self._sabayon_install.live_install()
+        cloned = False
+        if self._canCloneLiveRoot(anaconda):
+            self._cloneLiveRoot(anaconda)
+            cloned = True
+        self._sabayon_install.live_install(copy_files = not cloned)
         self._sabayon_install.setup_secureboot()
         self._sabayon_install.setup_users()
         self._sabayon_install.setup_language() # before ldconfig, thx
@@ -0,0 +1,812 @@
+# -*- coding: utf-8 -*-
+#
+# sabayon/livecopy.py
+#
+# Copyright (C) 2010 Fabio Erculiani
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Python imports
+import os
+import sys
+import stat
+import errno
+import ctypes
+import ctypes.util
+import bisect
+import threading
+import multiprocessing
+import Queue
+
+import logging
+log = logging.getLogger("anaconda")
+
+# maximum amount of data handed to the kernel per copy syscall
+_KERNEL_COPY_CHUNK = 1024 * 1024 * 64
+# buffer size used when no in-kernel copy facility is available
+_USER_COPY_CHUNK = 1024 * 1024
+
+# directories of the live image whose content is never copied
+PRUNED_DIRS = ("/proc", "/dev", "/sys")
+
+# errors telling us that a given in-kernel copy facility cannot be
+# used for the current pair of file descriptors
+_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+    errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _load_libc():
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        return None
+    try:
+        return ctypes.CDLL(libc_name, use_errno = True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+_copy_file_range = getattr(_libc, "copy_file_range", None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+
+_sendfile = getattr(_libc, "sendfile", None)
+if _sendfile is not None:
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+
+_llistxattr = getattr(_libc, "llistxattr", None)
+if _llistxattr is not None:
+    _llistxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t]
+    _llistxattr.restype = ctypes.c_ssize_t
+
+_lgetxattr = getattr(_libc, "lgetxattr", None)
+if _lgetxattr is not None:
+    _lgetxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+        ctypes.c_size_t]
+    _lgetxattr.restype = ctypes.c_ssize_t
+
+_lsetxattr = getattr(_libc, "lsetxattr", None)
+if _lsetxattr is not None:
+    _lsetxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+        ctypes.c_size_t, ctypes.c_int]
+    _lsetxattr.restype = ctypes.c_int
+
+
+def _do_copy_file_range(in_fd, out_fd, count):
+    return _copy_file_range(in_fd, None, out_fd, None, count, 0)
+
+def _do_sendfile(in_fd, out_fd, count):
+    return _sendfile(out_fd, in_fd, None, count)
+
+_KERNEL_COPY_CALLS = []
+if _copy_file_range is not None:
+    _KERNEL_COPY_CALLS.append(_do_copy_file_range)
+if _sendfile is not None:
+    _KERNEL_COPY_CALLS.append(_do_sendfile)
+
+
+def _kernel_copy(call, in_fd, out_fd):
+    """
+    Copy in_fd to out_fd, up to its end, using the given in-kernel copy
+    call. Return the amount of bytes copied, or None if the call is not
+    usable for these file descriptors and nothing has been copied yet.
+    """
+    copied = 0
+    while True:
+        count = call(in_fd, out_fd, _KERNEL_COPY_CHUNK)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if copied == 0 and err in _UNSUPPORTED_ERRNOS:
+                return None
+            raise OSError(err, os.strerror(err))
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+def copy_file_data(in_fd, out_fd):
+    """
+    Copy the content of in_fd into out_fd, up to its end, trying
+    copy_file_range(2) and sendfile(2) first and falling back to a plain
+    read/write loop. Return the amount of bytes copied.
+    """
+    for call in _KERNEL_COPY_CALLS:
+        copied = _kernel_copy(call, in_fd, out_fd)
+        if copied is not None:
+            return copied
+
+    copied = 0
+    while True:
+        buf = os.read(in_fd, _USER_COPY_CHUNK)
+        if not buf:
+            break
+        while buf:
+            written = os.write(out_fd, buf)
+            buf = buf[written:]
+            copied += written
+    return copied
+
+
+def _xattr_error():
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
+
+def get_xattrs(path):
+    """
+    Return a dict of the extended attributes of path (not following
+    symlinks), or None if path has none or they are not supported.
+    """
+    if _llistxattr is None or _lgetxattr is None:
+        return None
+    size = _llistxattr(path, None, 0)
+    if size < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+            return None
+        raise OSError(err, os.strerror(err))
+    if size == 0:
+        return None
+
+    buf = ctypes.create_string_buffer(size)
+    size = _llistxattr(path, buf, size)
+    if size < 0:
+        raise _xattr_error()
+
+    xattrs = {}
+    for name in buf.raw[:size].split("\0")[:-1]:
+        value_size = _lgetxattr(path, name, None, 0)
+        if value_size < 0:
+            raise _xattr_error()
+        value_buf = ctypes.create_string_buffer(max(1, value_size))
+        value_size = _lgetxattr(path, name, value_buf, value_size)
+        if value_size < 0:
+            raise _xattr_error()
+        xattrs[name] = value_buf.raw[:value_size]
+    return xattrs or None
+
+def set_xattrs(path, xattrs):
+    """
+    Set the given dict of extended attributes on path (not following
+    symlinks).
+    """
+    if _lsetxattr is None:
+        log.warning("set_xattrs: lsetxattr not available, skipping %s" % (
+            path,))
+        return
+    for name, value in xattrs.items():
+        if _lsetxattr(path, name, value, len(value), 0) < 0:
+            raise _xattr_error()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def remove_paths(paths, workers = None):
+    """
+    Remove the given files (or symlinks, fifos, device nodes) using a
+    pool of threads. Return the amount of paths actually removed.
+    """
+    if workers is None:
+        try:
+            workers = multiprocessing.cpu_count() * 2
+        except NotImplementedError:
+            workers = 4
+
+    path_q = Queue.Queue()
+    for path in paths:
+        path_q.put(path)
+    removed = [0]
+    lock = threading.Lock()
+
+    def _remover():
+        count = 0
+        while True:
+            try:
+                path = path_q.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                os.remove(path)
+                count += 1
+            except OSError as err:
+                if err.errno not in (errno.ENOENT, errno.EISDIR):
+                    log.warning("remove_paths: cannot remove %s: %s" % (
+                        path, err,))
+        with lock:
+            removed[0] += count
+
+    threads = []
+    for x in range(max(1, min(workers, path_q.qsize()))):
+        thread = threading.Thread(target = _remover)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return removed[0]
+
+
+class ManifestEntry(object):
+    """
+    A live image entry as recorded in a LiveManifest. Attribute names
+    mirror os.stat_result so that entries can be used in place of it.
+    """
+
+    __slots__ = ("path", "st_mode", "st_uid", "st_gid", "st_size",
+        "st_mtime", "st_rdev", "xattrs")
+
+    def __init__(self, path, st_mode, st_uid, st_gid, st_size, st_mtime,
+                 st_rdev, xattrs = None):
+        self.path = path
+        self.st_mode = st_mode
+        self.st_uid = st_uid
+        self.st_gid = st_gid
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+        self.st_rdev = st_rdev
+        self.xattrs = xattrs
+
+    @property
+    def st_atime(self):
+        return self.st_mtime
+
+
+class LiveManifest(object):
+    """
+    Persistent list of every entry of the live image: path, type and
+    mode, owner, size, mtime, device number and extended attributes.
+
+    The manifest is generated once (at ISO build time, or on first use
+    and then cached) and spares the installer from walking the live image
+    just to know how much data is going to be copied. Totals are stored
+    in the header so read_totals() does not need to parse the entries.
+    The entry order guarantees that a directory always comes before its
+    content, so the manifest can be used as LiveCopier work list.
+    """
+
+    _MAGIC = "# sabayon-live-manifest"
+    VERSION = 1
+
+    def __init__(self, entries, total_files, total_bytes):
+        self.entries = entries
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+
+    @classmethod
+    def generate(cls, source, prune = None, skip = None):
+        """
+        Build a manifest by walking source. The content of the pruned
+        directories (relative paths) is not recorded, and neither are the
+        relative paths listed in skip.
+        """
+        source = source.rstrip("/")
+        prune = frozenset(prune or ())
+        skip = frozenset(skip or ())
+        entries = []
+        total_files = 0
+        total_bytes = 0
+
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            names = os.listdir(source + rel_dir)
+            names.sort()
+            subdirs = []
+            for name in names:
+                rel_path = rel_dir + "/" + name
+                if rel_path in skip:
+                    continue
+                path = source + rel_path
+                st = os.lstat(path)
+                entries.append(ManifestEntry(rel_path, st.st_mode,
+                    st.st_uid, st.st_gid, st.st_size, int(st.st_mtime),
+                    st.st_rdev, get_xattrs(path)))
+                if stat.S_ISDIR(st.st_mode):
+                    if rel_path not in prune:
+                        subdirs.append(rel_path)
+                    continue
+                total_files += 1
+                if stat.S_ISREG(st.st_mode):
+                    total_bytes += st.st_size
+            subdirs.reverse()
+            stack.extend(subdirs)
+
+        return cls(entries, total_files, total_bytes)
+
+    @classmethod
+    def _header(cls, total_files, total_bytes, total_entries):
+        return "%s %d files=%d bytes=%d entries=%d\n" % (cls._MAGIC,
+            cls.VERSION, total_files, total_bytes, total_entries)
+
+    @classmethod
+    def _parse_header(cls, line):
+        items = line.split()
+        magic = " ".join(items[:2])
+        if magic != cls._MAGIC or len(items) != 6:
+            raise ValueError("not a live manifest")
+        if int(items[2]) != cls.VERSION:
+            raise ValueError("unsupported live manifest version %s" % (
+                items[2],))
+        return dict(x.split("=", 1) for x in items[3:])
+
+    def write(self, path):
+        """
+        Atomically write the manifest to path.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as man_f:
+            man_f.write(self._header(self.total_files, self.total_bytes,
+                len(self.entries)))
+            for entry in self.entries:
+                if entry.xattrs:
+                    xattrs = ",".join(["%s=%s" % (
+                        name, value.encode("hex")) for name, value in \
+                        sorted(entry.xattrs.items())])
+                else:
+                    xattrs = "-"
+                man_f.write("%o\t%d\t%d\t%d\t%d\t%d\t%s\t%s\n" % (
+                    entry.st_mode, entry.st_uid, entry.st_gid, entry.st_size,
+                    entry.st_mtime, entry.st_rdev, xattrs,
+                    entry.path.encode("string_escape")))
+            man_f.flush()
+            os.fsync(man_f.fileno())
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def read_totals(cls, path):
+        """
+        Return (total_files, total_bytes) reading just the header.
+        """
+        with open(path, "r") as man_f:
+            header = cls._parse_header(man_f.readline())
+        return int(header["files"]), int(header["bytes"])
+
+    @classmethod
+    def read_disk_usage(cls, path, block_size = 4096):
+        """
+        Return an upper bound of the bytes the live image takes once
+        copied onto a filesystem with the given block size, reading just
+        the header. Every entry is counted as if it wasted a whole block
+        to rounding, which also covers directories and long symlinks.
+        """
+        with open(path, "r") as man_f:
+            header = cls._parse_header(man_f.readline())
+        return int(header["bytes"]) + int(header["entries"]) * block_size
+
+    @classmethod
+    def read(cls, path):
+        """
+        Load a manifest written by write().
+        """
+        entries = []
+        with open(path, "r") as man_f:
+            header = cls._parse_header(man_f.readline())
+            for line in man_f:
+                (mode, uid, gid, size, mtime, rdev, xattrs,
+                    rel_path) = line.rstrip("\n").split("\t", 7)
+                if xattrs == "-":
+                    xattrs = None
+                else:
+                    xattrs = dict((name, value.decode("hex")) for name, \
+                        value in [x.split("=", 1) for x in xattrs.split(",")])
+                entries.append(ManifestEntry(
+                    rel_path.decode("string_escape"), int(mode, 8),
+                    int(uid), int(gid), int(size), int(mtime), int(rdev),
+                    xattrs))
+
+        if len(entries) != int(header["entries"]):
+            raise ValueError("truncated live manifest %s" % (path,))
+        return cls(entries, int(header["files"]), int(header["bytes"]))
+
+
+def load_manifest(source, manifest_path, cache_path, prune = None):
+    """
+    Return the LiveManifest of the live image at source. The manifest
+    shipped in the image (manifest_path, relative to source) is used if
+    available, then the one cached at cache_path. If none is usable, a
+    new one is generated and cached.
+    """
+    for path in (source.rstrip("/") + manifest_path, cache_path):
+        if not os.path.isfile(path):
+            continue
+        try:
+            return LiveManifest.read(path)
+        except (IOError, OSError, ValueError, TypeError), err:
+            log.warning("load_manifest: cannot use %s: %s" % (path, err))
+
+    manifest = LiveManifest.generate(source, prune = prune,
+        skip = (manifest_path,))
+    try:
+        manifest.write(cache_path)
+    except (IOError, OSError), err:
+        log.warning("load_manifest: cannot cache %s: %s" % (cache_path, err))
+    return manifest
+
+
+class ExcludeIndex(object):
+    """
+    In-memory index of the live image paths that must not be copied.
+
+    Files are kept in a hash set. Whole directories can be excluded too:
+    they are kept as a sorted list of "/"-terminated prefixes, containing
+    no nested entries, so that a single bisection tells whether a path
+    lives in an excluded subtree.
+    """
+
+    def __init__(self):
+        self._files = set()
+        self._dirs = set()
+        self._prefixes = []
+
+    def update(self, files = (), dirs = ()):
+        """
+        Bulk load excluded files and candidate directories. Candidate
+        directories are not excluded until prune_subtrees() says so.
+        """
+        self._files.update(files)
+        self._dirs.update(dirs)
+
+    @property
+    def dirs(self):
+        """ The candidate directories. """
+        return self._dirs
+
+    @property
+    def pruned_dirs(self):
+        """ The directories whose whole subtree is excluded. """
+        return [x[:-1] for x in self._prefixes]
+
+    def prune_subtrees(self, manifest, can_prune = None):
+        """
+        Exclude the whole subtree of the candidate directories that,
+        according to the given LiveManifest, only contain excluded files
+        and candidate directories. can_prune is an optional callable
+        that gets the last say on each of them.
+        """
+        needed = set()
+        for entry in manifest.entries:
+            if stat.S_ISDIR(entry.st_mode):
+                if entry.path in self._dirs:
+                    continue
+                parent = entry.path
+            elif entry.path in self._files:
+                continue
+            else:
+                parent = os.path.dirname(entry.path)
+            # keep this directory and all its parents
+            while parent != "/" and parent not in needed:
+                needed.add(parent)
+                parent = os.path.dirname(parent)
+
+        prefixes = []
+        for prefix in sorted([x + "/" for x in self._dirs - needed]):
+            if prefixes and prefix.startswith(prefixes[-1]):
+                # nested into an already pruned directory
+                continue
+            if can_prune is not None and not can_prune(prefix[:-1]):
+                continue
+            prefixes.append(prefix)
+        self._prefixes = prefixes
+
+    def __contains__(self, path):
+        if path in self._files:
+            return True
+        if not self._prefixes:
+            return False
+        # prefixes are not nested, so the only candidate is the greatest
+        # one not greater than path
+        key = path + "/"
+        idx = bisect.bisect_right(self._prefixes, key)
+        return idx > 0 and key.startswith(self._prefixes[idx - 1])
+
+    def __len__(self):
+        return len(self._files)
+
+
+class LiveCopier(object):
+    """
+    Multi-threaded copy engine used to transfer the live image content
+    into the target root.
+
+    A pool of workers shares a queue of directories to process: each
+    worker lists one directory, creates its subdirectories on the target,
+    queues them and copies every other entry. Every source entry is
+    lstat()ed exactly once. Progress is accounted in bytes.
+
+    If a LiveManifest is given, the live image is not walked at all: the
+    directory tree is created from the manifest first, then its entries
+    are handed out to the workers in batches, and the extended attributes
+    recorded in the manifest are restored too.
+    """
+
+    # amount of manifest entries handed out to a worker at once
+    _MANIFEST_BATCH = 256
+
+    def __init__(self, source, dest, exclude = None, prune = None,
+                 workers = None, manifest = None):
+        """
+        source is the live image root, dest the target root.
+        exclude is an optional callable that is given the path (relative
+        to source, starting with "/") of every entry and returns True if
+        the entry (and its whole content, for directories) must not be
+        copied. An ExcludeIndex works too. prune is a list of
+        relative directory paths that are created on the target but whose
+        content is not copied. manifest is an optional LiveManifest of
+        source.
+        """
+        self._source = source.rstrip("/")
+        self._dest = dest.rstrip("/")
+        if isinstance(exclude, ExcludeIndex):
+            exclude = exclude.__contains__
+        self._exclude = exclude
+        self._prune = frozenset(prune or ())
+        self._manifest = manifest
+        if workers is None:
+            try:
+                workers = multiprocessing.cpu_count() * 2
+            except NotImplementedError:
+                workers = 4
+        self._workers = max(1, workers)
+
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._dirs = []
+        self._error = None
+        self.copied_bytes = 0
+        self.copied_files = 0
+
+    def run(self, callback = None, interval = 0.5):
+        """
+        Copy the whole tree, blocking until done. If given, callback is
+        called every interval seconds from the calling thread with the
+        amount of bytes copied so far.
+        """
+        threads = []
+        for x in range(self._workers):
+            thread = threading.Thread(target = self._worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        done = threading.Event()
+        def _wait_queue():
+            self._queue.join()
+            done.set()
+        waiter = threading.Thread(target = _wait_queue)
+        waiter.daemon = True
+
+        if self._manifest is None:
+            self._queue.put("")
+        else:
+            self._queue_manifest()
+        waiter.start()
+        while not done.wait(interval):
+            if callback is not None:
+                callback(self.copied_bytes)
+
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            exc_type, exc_value, exc_tb = self._error
+            raise exc_type, exc_value, exc_tb
+
+        # directory timestamps can only be restored once all their
+        # children have been written
+        for dst, st in self._dirs:
+            os.utime(dst, (st.st_atime, st.st_mtime))
+
+        if callback is not None:
+            callback(self.copied_bytes)
+
+    def _is_pruned(self, rel_path):
+        for pruned in self._prune:
+            if rel_path.startswith(pruned + "/"):
+                return True
+        return False
+
+    def _queue_manifest(self):
+        batch = []
+        for entry in self._manifest.entries:
+            if self._is_pruned(entry.path):
+                continue
+            if self._exclude is not None and self._exclude(entry.path):
+                continue
+            if stat.S_ISDIR(entry.st_mode):
+                # directories must exist before workers fill them
+                self._make_dir(self._dest + entry.path, entry)
+                continue
+            batch.append(entry)
+            if len(batch) == self._MANIFEST_BATCH:
+                self._queue.put(batch)
+                batch = []
+        if batch:
+            self._queue.put(batch)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is not None:
+                    continue
+                if isinstance(item, list):
+                    self._copy_entries(item)
+                else:
+                    self._copy_dir(item)
+            except:
+                with self._lock:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _copy_entries(self, entries):
+        # exclusion has already been checked while queueing
+        for entry in entries:
+            self._copy_entry(entry.path, entry)
+
+    def _copy_dir(self, rel_dir):
+        src_dir = self._source + rel_dir
+        names = os.listdir(src_dir)
+        names.sort()
+
+        for name in names:
+            rel_path = rel_dir + "/" + name
+            if self._exclude is not None and self._exclude(rel_path):
+                continue
+            st = os.lstat(src_dir + "/" + name)
+
+            if stat.S_ISDIR(st.st_mode):
+                self._make_dir(self._dest + rel_path, st)
+                if rel_path not in self._prune:
+                    self._queue.put(rel_path)
+                continue
+
+            self._copy_entry(rel_path, st)
+
+    def _copy_entry(self, rel_path, st):
+        src = self._source + rel_path
+        dst = self._dest + rel_path
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+            self._copy_reg(src, dst, st)
+        elif stat.S_ISLNK(mode):
+            self._copy_lnk(src, dst, st)
+        elif stat.S_ISFIFO(mode):
+            self._copy_special(dst, st, fifo = True)
+        else:
+            self._copy_special(dst, st)
+
+        xattrs = getattr(st, "xattrs", None)
+        if xattrs:
+            # must come after chown, which drops security.capability
+            set_xattrs(dst, xattrs)
+
+    def _make_dir(self, dst, st):
+        try:
+            os.mkdir(dst)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            dst_st = os.lstat(dst)
+            if stat.S_ISLNK(dst_st.st_mode):
+                if os.path.isdir(dst):
+                    # the target already provides this directory through
+                    # a symlink, just fill it
+                    return
+                os.remove(dst)
+                os.mkdir(dst)
+            elif not stat.S_ISDIR(dst_st.st_mode):
+                # if our directory is a file on the target, really weird
+                os.remove(dst)
+                os.mkdir(dst)
+
+        os.lchown(dst, st.st_uid, st.st_gid)
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        xattrs = getattr(st, "xattrs", None)
+        if xattrs:
+            set_xattrs(dst, xattrs)
+        with self._lock:
+            self._dirs.append((dst, st))
+
+    def _copy_reg(self, src, dst, st):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+        in_fd = os.open(src, os.O_RDONLY)
+        try:
+            try:
+                out_fd = os.open(dst, flags, 0600)
+            except OSError as err:
+                if err.errno != errno.ELOOP:
+                    raise
+                # target is a symlink, replace it
+                os.remove(dst)
+                out_fd = os.open(dst, flags, 0600)
+            try:
+                # the manifest may not match the image, copy what's there
+                copied = copy_file_data(in_fd, out_fd)
+                # chown before chmod, chown drops setuid/setgid bits
+                os.fchown(out_fd, st.st_uid, st.st_gid)
+                os.fchmod(out_fd, stat.S_IMODE(st.st_mode))
+            finally:
+                os.close(out_fd)
+        finally:
+            os.close(in_fd)
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+        with self._lock:
+            self.copied_bytes += copied
+            self.copied_files += 1
+
+    def _copy_lnk(self, src, dst, st):
+        source_link = os.readlink(src)
+        try:
+            os.symlink(source_link, dst)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                # for security we skip live symlinks replacing real dirs
+                return
+            os.remove(dst)
+            os.symlink(source_link, dst)
+        os.lchown(dst, st.st_uid, st.st_gid)
+
+        with self._lock:
+            self.copied_files += 1
+
+    def _copy_special(self, dst, st, fifo = False):
+        _remove(dst)
+        if fifo:
+            os.mkfifo(dst, stat.S_IMODE(st.st_mode))
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+        os.lchown(dst, st.st_uid, st.st_gid)
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+        with self._lock:
+            self.copied_files += 1
+
+
+if __name__ == "__main__":
+    # used at ISO build time to ship the manifest inside the live image:
+    # livecopy.py <live root> <manifest path>
+    if len(sys.argv) != 3:
+        sys.stderr.write("usage: %s <live root> <manifest path>\n" % (
+            sys.argv[0],))
+        raise SystemExit(1)
+    live_root = os.path.realpath(sys.argv[1])
+    manifest_path = os.path.realpath(sys.argv[2])
+    skip = []
+    if manifest_path.startswith(live_root + "/"):
+        skip.append(manifest_path[len(live_root):])
+    LiveManifest.generate(live_root, prune = PRUNED_DIRS,
+        skip = skip).write(manifest_path)
@@ -56,9 +56,10 @@ from entropy.services.client import WebService
 import logging
 from constants import productPath
 from sabayon import Entropy
+from sabayon import livecopy
 from sabayon.const import LIVE_USER, LANGUAGE_PACKS, REPO_NAME, \
     ASIAN_FONTS_PACKAGES, FIREWALL_SERVICE, SB_PRIVATE_KEY, \
-    SB_PUBLIC_X509, SB_PUBLIC_DER
+    SB_PUBLIC_X509, SB_PUBLIC_DER, LIVE_MANIFEST, LIVE_MANIFEST_CACHE
 
 import gettext
 _ = lambda x: gettext.ldgettext("anaconda", x)
@@ -207,34 +208,15 @@ class SabayonInstall:
             self.cmdline = cmd_f.readline().strip().split()
         #sys.stderr = STDERR_LOG
 
-        self._files_db_path = self._root+"/files.db"
-        try:
-            self._files_db = self._entropy.open_generic_repository(
-                 self._files_db_path, dbname = "filesdb",
-                indexing_override = True)
-        except TypeError:
-            # new API
-            self._files_db = self._entropy.open_generic_repository(
-                 self._files_db_path, name = "filesdb",
-                indexing_override = True)
-        if hasattr(self._files_db, "initializeDatabase"):
-            self._files_db.initializeDatabase()
-        else:
-            self._files_db.initializeRepository()
         self._live_repo = self._open_live_installed_repository()
         self._package_identifiers_to_remove = set()
+        # live image paths owned by the packages that are going to be
+        # removed, they are not copied
+        self._files_to_ignore = livecopy.ExcludeIndex()
+        # live image path -> package database paths it comes from
+        self._ignored_dirs_origin = {}
 
     def destroy(self):
-        # remove files db if exists
-        if hasattr(self._files_db, "close"):
-            self._files_db.close()
-        else:
-            self._files_db.closeDB()
-        try:
-            os.remove(self._files_db_path)
-        except OSError:
-            pass
-
         self._progress.stop()
 
     def spawn_chroot(self, args, silent = False):
@@ -376,19 +358,8 @@ class SabayonInstall:
         try:
             rc = 0
             if match[0] != -1:
-
-                if action_factory is not None:
-                    pkg = action_factory.get(
-                        action, (match[0], inst_repo.name))
-                    rc = pkg.start()
-                    pkg.finalize()
-
-                else:
-                    pkg = self._entropy.Package()
-                    pkg.prepare((match[0],), "remove")
-                    if 'remove_installed_vanished' not in pkg.pkgmeta:
-                        rc = pkg.run()
-                        pkg.kill()
+                rc = self._run_remove_action(inst_repo, action_factory,
+                    action, match[0])
 
         finally:
             if silent:
@@ -400,6 +371,172 @@ class SabayonInstall:
 
         return rc
 
+    def _run_remove_action(self, inst_repo, action_factory, action, pkg_id):
+        """
+        Run the Entropy removal of an installed package identifier, which
+        takes care of its triggers and of config protection.
+        """
+        rc = 0
+        if action_factory is not None:
+            pkg = action_factory.get(action, (pkg_id, inst_repo.name))
+            rc = pkg.start()
+            pkg.finalize()
+
+        else:
+            pkg = self._entropy.Package()
+            pkg.prepare((pkg_id,), "remove")
+            if 'remove_installed_vanished' not in pkg.pkgmeta:
+                rc = pkg.run()
+                pkg.kill()
+
+        return rc
+
+    def _needs_remove_action(self, inst_repo, pkg_id, files):
+        """
+        Tell whether removing a package takes more than deleting its
+        files: it has a trigger or removal phases to run, or some of its
+        files are config protected.
+        """
+        try:
+            trigger = inst_repo.retrieveTrigger(pkg_id)
+            phases = inst_repo.retrieveSpmPhases(pkg_id) or ""
+            protect = (inst_repo.retrieveProtect(pkg_id) or "").split()
+            mask = (inst_repo.retrieveProtectMask(pkg_id) or "").split()
+        except AttributeError:
+            # not a repository we know, leave it all to Entropy
+            return True
+
+        if trigger or "prerm" in phases or "postrm" in phases:
+            return True
+
+        for path in files:
+            if [x for x in protect if path.startswith(x)] and \
+                    not [x for x in mask if path.startswith(x)]:
+                return True
+
+        return False
+
+    def _owned_paths(self, inst_repo, paths):
+        """
+        Return the paths that are still owned by an installed package.
+        """
+        return set([x for x in paths if inst_repo.isFileAvailable(x)])
+
+    def remove_packages(self, package_ids):
+        """
+        Remove the given installed package identifiers from the target
+        system at once. Packages with triggers, removal phases or config
+        protected files go through the Entropy removal action. For all
+        the others the files and package metadata are dropped in bulk,
+        shared files and directories are kept.
+        """
+        chroot = self._root
+        root = etpSys['rootdir']
+        if chroot != root:
+            self._change_entropy_chroot(chroot)
+
+        # the removal actions are as chatty as in remove_package
+        silent = not os.getenv('SABAYON_DEBUG')
+        oldstdout = sys.stdout
+        if silent:
+            sys.stdout = STDERR_LOG
+            _set_mute(True)
+
+        try:
+            inst_repo = self._entropy.installed_repository()
+            total_counter = len(package_ids)
+            self._progress.set_fraction(0.0)
+            self._progress.set_text(_("Cleaning packages"))
+
+            try:
+                action_factory = self._entropy.PackageActionFactory()
+                action = action_factory.REMOVE_ACTION
+            except AttributeError:
+                action_factory = None
+                action = "remove"
+
+            files = set()
+            dirs = set()
+            removed = 0
+            for pkg_id in package_ids:
+                atom = inst_repo.retrieveAtom(pkg_id)
+                if not atom:
+                    continue
+
+                category = inst_repo.retrieveCategory(pkg_id)
+                version = inst_repo.retrieveVersion(pkg_id)
+                name = inst_repo.retrieveName(pkg_id)
+                ebuild_path = self._root+"/var/db/pkg/%s/%s-%s" % (
+                    category, name, version)
+                if os.path.isdir(ebuild_path):
+                    shutil.rmtree(ebuild_path, True)
+
+                pkg_files = set()
+                pkg_dirs = set()
+                for path, ctype in inst_repo.retrieveContent(pkg_id,
+                                                             extended = True):
+                    if ctype == "dir":
+                        pkg_dirs.add(path)
+                    else:
+                        pkg_files.add(path)
+
+                self._progress.set_text("%s: %s" % (
+                    _("Cleaning package"), atom,))
+                if self._needs_remove_action(inst_repo, pkg_id, pkg_files):
+                    self._run_remove_action(inst_repo, action_factory,
+                        action, pkg_id)
+                else:
+                    files.update(pkg_files)
+                    try:
+                        inst_repo.removePackage(pkg_id, do_commit = False)
+                    except TypeError:
+                        # old API
+                        inst_repo.removePackage(pkg_id)
+                dirs.update(pkg_dirs)
+                removed += 1
+                self._progress.set_fraction(
+                    float(removed) / total_counter * 0.5)
+
+            if hasattr(inst_repo, "commit"):
+                inst_repo.commit()
+            else:
+                inst_repo.commitChanges()
+
+            # only what's there and not owned by the surviving packages,
+            # the repository connection cannot be shared across threads
+            files = set([x for x in files if
+                os.path.lexists(self._root + self._live_path(x))])
+            dirs = set([x for x in dirs if
+                os.path.isdir(self._root + self._live_path(x))])
+            owned = self._owned_paths(inst_repo, files | dirs)
+            unlinked = livecopy.remove_paths(
+                [self._root + self._live_path(x) for x in files - owned])
+            self._progress.set_fraction(0.75)
+
+            # bottom-up, so that a single pass is enough
+            pruned = 0
+            for path in sorted(dirs - owned, key = lambda x: x.count("/"),
+                               reverse = True):
+                try:
+                    os.rmdir(self._root + self._live_path(path))
+                    pruned += 1
+                except OSError:
+                    # not empty, not there or not a directory
+                    pass
+
+            log.info("remove_packages: removed %d packages, %d files, "
+                "%d directories" % (removed, unlinked, pruned,))
+            self._progress.set_fraction(1.0)
+
+        finally:
+            if silent:
+                sys.stdout = oldstdout
+                _set_mute(False)
+            if chroot != root:
+                self._change_entropy_chroot(root)
+
+        return removed
+
     def install_package_file(self, package_file):
         chroot = self._root
         root = etpSys['rootdir']
@@ -995,143 +1132,18 @@ blacklist nouveau
         except Exception as err:
             log.error("Unable to emit_install_done(): %s" % err)
 
-    def live_install(self):
+    def live_install(self, copy_files = True):
         """
         This function copy the LiveCD/DVD content into self._root
+        and removes the unwanted packages. If copy_files is False, the
+        live image content is expected to be already there.
         """
 
         if not os.getenv("SABAYON_DISABLE_PKG_REMOVAL"):
             self._setup_packages_to_remove()
 
-        action = _("System Installation")
-        copy_update_interval = 300
-        copy_update_counter = 299
-        # get file counters
-        total_files = 0
-        image_dir = self._prod_root
-        for z,z,files in os.walk(image_dir):
-            for file in files:
-                total_files += 1
-
-        self._progress.set_fraction(0.0)
-        self._progress.set_text(action)
-
-        def copy_other(fromfile, tofile):
-            proc = subprocess.Popen(("/bin/cp", "-a", fromfile, tofile),
-                stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-            proc.wait()
-            del proc
-
-        def copy_reg(fromfile, tofile):
-            try:
-                shutil.copy2(fromfile, tofile)
-                user = os.stat(fromfile)[4]
-                group = os.stat(fromfile)[5]
-                os.chown(tofile, user, group)
-                shutil.copystat(fromfile, tofile)
-            except IOError, e:
-                if (e[0] == 40) or (e[0] == 2):
-                    # workaround for Too many levels of symbolic links
-                    copy_other(fromfile, tofile)
-                else:
-                    raise
-
-        def copy_lnk(fromfile, tofile):
-            source_link = os.readlink(fromfile)
-            if os.path.lexists(tofile):
-                os.remove(tofile)
-            os.symlink(source_link, tofile)
-
-        current_counter = 0
-        currentfile = "/"
-        image_dir_len = len(image_dir)
-        # Create the directory structure
-        # self.InstallFilesToIgnore
-        for currentdir, subdirs, files in os.walk(image_dir):
-
-            copy_update_counter += 1
-            to_currentdir = currentdir[image_dir_len:]
-            for t_dir in ("/proc", "/dev", "/sys"):
-                if to_currentdir.startswith(t_dir):
-                    # don't touch subdirs
-                    subdirs = []
-                    break
-
-            for xdir in subdirs:
-
-                image_path_dir = currentdir + "/" + xdir
-                mydir = image_path_dir[image_dir_len:]
-                rootdir = self._root + mydir
-
-                # handle broken symlinks
-                if os.path.islink(rootdir) and not os.path.exists(rootdir):
-                    # broken symlink
-                    os.remove(rootdir)
-
-                # if our directory is a file on the live system
-                elif os.path.isfile(rootdir): # really weird...!
-                    os.remove(rootdir)
-
-                # if our directory is a symlink instead, then copy the symlink
-                if os.path.islink(image_path_dir) and not os.path.isdir(rootdir):
-                    # for security we skip live items that are dirs
-                    tolink = os.readlink(image_path_dir)
-                    if os.path.islink(rootdir):
-                        os.remove(rootdir)
-                    os.symlink(tolink,rootdir)
-                elif (not os.path.isdir(rootdir)) and \
-                    (not os.access(rootdir,os.R_OK)):
-                    os.makedirs(rootdir)
-
-                if not os.path.islink(rootdir):
-                    # symlink don't need permissions, also until os.walk
-                    # ends they might be broken
-                    user = os.stat(image_path_dir)[4]
-                    group = os.stat(image_path_dir)[5]
-                    os.chown(rootdir,user,group)
-                    shutil.copystat(image_path_dir,rootdir)
-
-            files.sort()
-            for path_file in files:
-
-                current_counter += 1
-                fromfile = currentdir + "/" + path_file
-                currentfile = fromfile[image_dir_len:]
-
-                if currentfile.startswith("/dev/"):
-                    continue
-                if currentfile.startswith("/proc/"):
-                    continue
-                if currentfile.startswith("/sys/"):
-                    continue
-
-                try:
-                    # if file is in the ignore list
-                    if self._files_db.isFileAvailable(
-                        currentfile.decode('raw_unicode_escape')):
-                        continue
-                except:
-                    import traceback
-                    traceback.print_exc()
-
-                tofile = self._root + currentfile
-                st_info = os.lstat(fromfile)
-                if stat.S_ISREG(st_info[stat.ST_MODE]):
-                    copy_reg(fromfile, tofile)
-                elif stat.S_ISLNK(st_info[stat.ST_MODE]):
-                    copy_lnk(fromfile, tofile)
-                else:
-                    copy_other(fromfile, tofile)
-
-
-            if (copy_update_counter == copy_update_interval) or \
-                ((total_files - 1000) < current_counter):
-                # do that every 1000 iterations
-                copy_update_counter = 0
-                frac = float(current_counter)/total_files
-                self._progress.set_fraction(frac)
-
-        self._progress.set_fraction(1)
+        if copy_files:
+            self._copy_live_image()
 
         self._change_entropy_chroot(self._root)
         # doing here, because client_repo should point to self._root chroot
@@ -1141,57 +1153,7 @@ blacklist nouveau
 
             # this makes packages removal much faster
             client_repo.createAllIndexes()
-
-            total_counter = len(self._package_identifiers_to_remove)
-            current_counter = 0
-            self._progress.set_fraction(current_counter)
-            self._progress.set_text(_("Cleaning packages"))
-            self._entropy.oldcount = [0,total_counter]
-
-            for pkg_id in self._package_identifiers_to_remove:
-                current_counter += 1
-                atom = client_repo.retrieveAtom(pkg_id)
-                if not atom:
-                    continue
-
-                ### XXX needed to speed up removal process
-                #"""
-                category = client_repo.retrieveCategory(pkg_id)
-                version = client_repo.retrieveVersion(pkg_id)
-                name = client_repo.retrieveName(pkg_id)
-                ebuild_path = self._root+"/var/db/pkg/%s/%s-%s" % (
-                    category, name, version)
-                if os.path.isdir(ebuild_path):
-                    shutil.rmtree(ebuild_path, True)
-                #"""
-                ### XXX
-
-                self.remove_package(None, match = (pkg_id,0), silent = True)
-                frac = float(current_counter)/total_counter
-                self._progress.set_fraction(frac)
-                self._progress.set_text("%s: %s" % (
-                    _("Cleaning package"), atom,))
-                self._entropy.oldcount = [current_counter, total_counter]
-
-        while 1:
-            change = False
-            mydirs = set()
-            try:
-                mydirs = self._files_db.retrieveContent(None, contentType = "dir")
-            except TypeError:
-                mydirs = set([x for x, y in self._files_db.retrieveContent(None,
-                    extended = True) if y == "dir"])
-            for mydir in mydirs:
-                mytree = os.path.join(self._root,mydir)
-                if os.path.isdir(mytree) and not client_repo.isFileAvailable(
-                    mydir):
-                    try:
-                        os.rmdir(mytree)
-                        change = True
-                    except OSError:
-                        pass
-            if not change:
-                break
+            self.remove_packages(self._package_identifiers_to_remove)
 
         # list installed packages and setup a package set
         inst_packages = ['%s:%s\n' % (entropy.dep.dep_getkey(atom),slot,) \
@@ -1216,6 +1178,38 @@ blacklist nouveau
         self._progress.set_fraction(1)
         self._progress.set_text(_("Installation complete"))
 
+    def _copy_live_image(self):
+        action = _("System Installation")
+        image_dir = self._prod_root
+        # the manifest gives us the byte counters and the copy work list
+        # without walking the live image
+        manifest = livecopy.load_manifest(image_dir, LIVE_MANIFEST,
+            LIVE_MANIFEST_CACHE, prune = livecopy.PRUNED_DIRS)
+        total_bytes = manifest.total_bytes
+
+        self._progress.set_fraction(0.0)
+        self._progress.set_text(action)
+
+        # skip whole directories only containing stuff going away
+        self._files_to_ignore.prune_subtrees(manifest,
+            can_prune = self._can_skip_dir)
+        log.info("live_install: ignoring %d files and %d directories" % (
+            len(self._files_to_ignore),
+            len(self._files_to_ignore.pruned_dirs),))
+
+        def _update_progress(copied_bytes):
+            if total_bytes:
+                self._progress.set_fraction(float(copied_bytes) / total_bytes)
+
+        copier = livecopy.LiveCopier(image_dir, self._root,
+            exclude = self._files_to_ignore, prune = livecopy.PRUNED_DIRS,
+            manifest = manifest)
+        copier.run(_update_progress)
+        log.info("live_install: copied %s files, %s bytes" % (
+            copier.copied_files, copier.copied_bytes,))
+
+        self._progress.set_fraction(1)
+
     def language_packs_install(self):
         langpacks = []
 
@@ -1532,6 +1526,8 @@ blacklist nouveau
             self._progress.set_fraction(current_counter)
             self._progress.set_text(_("Generating list of files to copy"))
 
+            files = set()
+            dirs = set()
             for pkg in self._package_identifiers_to_remove:
                 current_counter += 1
                 self._progress.set_fraction(
@@ -1539,34 +1535,39 @@ blacklist nouveau
                 # get its files
                 mycontent = self._live_repo.retrieveContent(pkg,
                     extended = True)
-                mydirs = [x[0] for x in mycontent if x[1] == "dir"]
-                for x in mydirs:
-                    if x.find("/usr/lib64") != -1:
-                        x = x.replace("/usr/lib64","/usr/lib")
-                    elif x.find("/lib64") != -1:
-                        x = x.replace("/lib64","/lib")
-                    self._add_file_to_ignore(x, "dir")
-                mycontent = [x[0] for x in mycontent if x[1] == "obj"]
-                for x in mycontent:
-                    if x.find("/usr/lib64") != -1:
-                        x = x.replace("/usr/lib64","/usr/lib")
-                    elif x.find("/lib64") != -1:
-                        x = x.replace("/lib64","/lib")
-                    self._add_file_to_ignore(x, "obj")
+                for path, ctype in mycontent:
+                    live_path = self._live_path(path)
+                    if ctype == "dir":
+                        dirs.add(live_path)
+                        self._ignored_dirs_origin.setdefault(
+                            live_path, set()).add(path)
+                    elif ctype in ("obj", "sym"):
+                        files.add(live_path)
                 del mycontent
 
+            self._files_to_ignore.update(files = files, dirs = dirs)
             self._progress.set_fraction(1)
 
-        if hasattr(self._files_db, "commit"):
-            self._files_db.commit()
-        else:
-            self._files_db.commitChanges()
-        if hasattr(self._files_db, "setIndexing"):
-            self._files_db.setIndexing(True)
-        else:
-            self._files_db.indexing = True
-        self._files_db.createAllIndexes()
-
-    def _add_file_to_ignore(self, f_path, ctype):
-        self._files_db._cursor().execute(
-            'INSERT into content VALUES (?,?,?)' , ( None, f_path, ctype, ))
+    def _live_path(self, path):
+        """
+        Map a package database path to the live image one.
+        """
+        if path.find("/usr/lib64") != -1:
+            path = path.replace("/usr/lib64","/usr/lib")
+        elif path.find("/lib64") != -1:
+            path = path.replace("/lib64","/lib")
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        return path
+
+    def _can_skip_dir(self, live_path):
+        """
+        Tell whether the given live image directory, whose content is
+        all going away, can be skipped altogether: it must not be owned
+        by any package we keep.
+        """
+        for path in self._ignored_dirs_origin.get(live_path, ()):
+            owners = self._live_repo.searchBelongs(path)
+            if not self._package_identifiers_to_remove.issuperset(owners):
+                return False
+        return True
@@ -263,6 +263,8 @@ class Storage(object):
         self.protectedDevSpecs = []
         self.autoPartitionRequests = []
         self.eddDict = {}
+        # name of the partitioning.allocators entry that places partitions
+        self.partitionAllocator = flags.cmdline.get("partallocator", "greedy")
 
         self.__luksDevs = {}
 
@@ -192,9 +192,10 @@ class DASD:
         if not callback_data:
             return
 
-        if data == '\n':
-            # each newline we see in this output means one more cylinder done
-            self._completedCylinders += 1.0
+        # each newline we see in this output means one more cylinder done
+        cylinders = data.count('\n')
+        if cylinders:
+            self._completedCylinders += cylinders
             callback_data.set(self._completedCylinders / self.totalCylinders)
 
     @property
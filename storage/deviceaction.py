@@ -266,6 +266,14 @@ class ActionCreateFormat(DeviceAction):
             self.origFormat = getFormat(None)
 
     def execute(self, intf=None):
+        self.prepare()
+        self.createFormat(intf=intf)
+        # Get the UUID now that the format is created
+        udev_settle()
+        self.updateFormat()
+
+    def prepare(self):
+        """ Get the device ready for the new format. """
         self.device.setup()
 
         if isinstance(self.device, PartitionDevice):
@@ -283,11 +291,19 @@ class ActionCreateFormat(DeviceAction):
 
             self.device.disk.format.commitToDisk()
 
+    def createFormat(self, intf=None):
+        """ Write the new format to the prepared device.
+
+            This only touches the device itself, so for formats whose
+            parallelCreate is set it can run while other formats are
+            being created.
+        """
         self.device.format.create(intf=intf,
                                   device=self.device.path,
                                   options=self.device.formatArgs)
-        # Get the UUID now that the format is created
-        udev_settle()
+
+    def updateFormat(self):
+        """ Read back the new format's UUID once udev has settled. """
         self.device.updateSysfsPath()
         info = udev_get_block_device(self.device.sysfsPath)
         self.device.format.uuid = udev_device_get_uuid(info)
@@ -313,10 +329,31 @@ class ActionDestroyFormat(DeviceAction):
 
     def execute(self, intf=None):
         """ wipe the filesystem signature from the device """
+        self.prepare()
+        self.destroyFormat()
         if self.origFormat:
+            udev_settle()
+        self.finish()
+
+    def prepare(self):
+        if self.origFormat:
+            # the device may have been renumbered since the action was
+            # registered
+            self.origFormat.device = self.device.path
             self.device.setup(orig=True)
+
+    def destroyFormat(self):
+        """ Wipe the old format from the prepared device.
+
+            For formats whose parallelDestroy is set this can run while
+            other formats are being destroyed.
+        """
+        if self.origFormat:
             self.origFormat.destroy()
-            udev_settle()
+
+    def finish(self):
+        """ Tear the device down again once udev has settled. """
+        if self.origFormat:
             self.device.teardown()
 
     def cancel(self):
@@ -374,3 +411,172 @@ class ActionMigrateFormat(DeviceAction):
     def cancel(self):
         self.device.format.migrate = False
 
+
+
+# the phases actions are carried out in, in order
+action_phases = (ACTION_TYPE_DESTROY, ACTION_TYPE_RESIZE,
+                 ACTION_TYPE_CREATE, ACTION_TYPE_MIGRATE)
+
+class ActionScheduler(object):
+    """ Orders a set of DeviceActions by the dependencies between them.
+
+        Actions run in phases by type: all destroys, then resizes, then
+        creates, then migrations. Within a phase a dependency graph is
+        built from the following rules:
+
+            - on the same device, a format is destroyed before the device,
+              a device is created before its format, and a device is grown
+              before (shrunk after) its format
+            - devices are destroyed and shrunk before the devices they
+              depend on (see DeviceTree.getAncestors), and created, grown
+              and migrated after them
+            - partition device actions on the same disk are serialized by
+              partition number (descending for destroy and shrink)
+
+        The graph is emitted in layers. Each action only depends on
+        actions in earlier layers, so the actions within a layer do not
+        conflict and could be carried out concurrently. Within a layer the
+        actions are ordered by a fixed per-phase key, which makes the
+        resulting order deterministic.
+    """
+    def __init__(self, actions, tree):
+        self._tree = tree
+        self._index = {}
+        for (i, action) in enumerate(actions):
+            self._index[action] = i
+
+        phases = dict((phase, []) for phase in action_phases)
+        others = []
+        for action in actions:
+            phases.get(action.type, others).append(action)
+
+        self.layers = []
+        for phase in action_phases:
+            self.layers.extend(self._schedule(phases[phase]))
+
+        if others:
+            self.layers.append(others)
+
+    @property
+    def actions(self):
+        """ All of the actions, in the order they should be executed. """
+        return [action for layer in self.layers for action in layer]
+
+    def _sortKey(self, action):
+        """ Tie-breaking key for actions with no dependency between them. """
+        device = action.device
+        isPartition = isinstance(device, PartitionDevice)
+        if isPartition and device.partedPartition:
+            number = device.partedPartition.number
+        else:
+            number = 0
+
+        if action.isDestroy():
+            # generally destroy partitions after lvs, vgs, &c
+            key = (isPartition, -number)
+        elif action.isResize():
+            # partitions grow before and shrink after other devices
+            key = (isPartition != action.isGrow(), number)
+        elif action.isCreate():
+            # generally create partitions before other device types
+            key = (not isPartition, number)
+        else:
+            key = ()
+
+        return key + (device.name, self._index[action])
+
+    def _edges(self, actions):
+        """ Return a list of (before, after) pairs for a phase's actions. """
+        edges = []
+        byDevice = {}
+        byPath = {}
+        for action in actions:
+            device = action.device
+            byDevice.setdefault(device, []).append(action)
+            byPath.setdefault(device.path, []).append(action)
+
+        # actions on the same device
+        for sameDevice in byPath.values():
+            formats = [a for a in sameDevice if a.isFormat()]
+            devices = [a for a in sameDevice if a.isDevice()]
+            for fmt in formats:
+                for dev in devices:
+                    if dev.isDestroy():
+                        edges.append((fmt, dev))
+                    elif dev.isResize() and dev.isShrink():
+                        edges.append((fmt, dev))
+                    elif dev.isResize() or dev.isCreate():
+                        edges.append((dev, fmt))
+
+        # actions on devices the device depends on
+        for action in actions:
+            for ancestor in self._tree.getAncestors(action.device):
+                for other in byDevice.get(ancestor, []):
+                    if action.isDestroy() or action.isShrink():
+                        edges.append((action, other))
+                    else:
+                        edges.append((other, action))
+
+        # partition table changes on the same disk
+        byDisk = {}
+        for action in actions:
+            if action.isDevice() and \
+               isinstance(action.device, PartitionDevice):
+                byDisk.setdefault(action.device.disk, []).append(action)
+
+        for diskActions in byDisk.values():
+            shrinks = [a for a in diskActions if a.isShrink()]
+            others = [a for a in diskActions if not a.isShrink()]
+            if diskActions[0].isDestroy():
+                chain = sorted(diskActions, key=self._partNumber,
+                               reverse=True)
+            else:
+                chain = sorted(shrinks, key=self._partNumber,
+                               reverse=True)
+                chain.extend(sorted(others, key=self._partNumber))
+
+            edges.extend(zip(chain, chain[1:]))
+
+        return edges
+
+    def _partNumber(self, action):
+        partedPartition = action.device.partedPartition
+        if partedPartition:
+            return (partedPartition.number, self._index[action])
+        return (0, self._index[action])
+
+    def _schedule(self, actions):
+        """ Return a phase's actions grouped into dependency layers. """
+        successors = dict((action, set()) for action in actions)
+        indegree = dict((action, 0) for action in actions)
+        for (before, after) in self._edges(actions):
+            if before is after or after in successors[before]:
+                continue
+
+            successors[before].add(after)
+            indegree[after] += 1
+
+        layers = []
+        current = [a for a in actions if not indegree[a]]
+        while current:
+            current.sort(key=self._sortKey)
+            layers.append(current)
+            ready = []
+            for action in current:
+                for successor in successors[action]:
+                    indegree[successor] -= 1
+                    if not indegree[successor]:
+                        ready.append(successor)
+
+            current = ready
+
+        scheduled = sum([len(layer) for layer in layers])
+        if scheduled < len(actions):
+            # there is a cycle; run whatever is left in key order rather
+            # than dropping actions
+            remaining = [a for a in actions if indegree[a] > 0]
+            log.warning("dependency cycle among actions: %s"
+                        % [str(a) for a in remaining])
+            layers.append(sorted(remaining, key=self._sortKey))
+
+        return layers
@@ -0,0 +1,249 @@
+#
+# broker.py
+# running of the external storage tools
+#
+# Copyright (C) 2009  Red Hat, Inc.  All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import subprocess
+import threading
+import time
+
+import iutil
+
+import logging
+log = logging.getLogger("storage")
+
+# upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+class CommandStats(object):
+    """ Call counts and latency histograms of the external commands.
+
+        Commands are keyed by the program and its first argument, eg.
+        "lvm pvs" or "mdadm --examine", so that each kind of query or
+        mutation can be profiled separately.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.times = {}
+        self.histograms = {}
+
+    def record(self, key, seconds):
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.times[key] = self.times.get(key, 0.0) + seconds
+
+        if key not in self.histograms:
+            self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1)
+
+        ms = seconds * 1000
+        bucket = len(LATENCY_BUCKETS)
+        for (i, bound) in enumerate(LATENCY_BUCKETS):
+            if ms <= bound:
+                bucket = i
+                break
+
+        self.histograms[key][bucket] += 1
+
+    def summary(self):
+        """ Return one line per command, the most frequent first. """
+        labels = ["<=%dms" % b for b in LATENCY_BUCKETS] + \
+                 [">%dms" % LATENCY_BUCKETS[-1]]
+        keys = sorted(self.counts, key=lambda k: (-self.counts[k], k))
+
+        lines = []
+        for key in keys:
+            buckets = ["%s:%d" % (label, n)
+                       for (label, n) in zip(labels, self.histograms[key])
+                       if n]
+            lines.append("%s: %d calls, %.3fs total, %s"
+                         % (key, self.counts[key], self.times[key],
+                            " ".join(buckets)))
+
+        return lines
+
+    def log(self):
+        for line in self.summary():
+            log.debug("command stats: %s" % line)
+
+stats = CommandStats()
+
+class LVMShell(object):
+    """ A long-running lvm shell that LVM queries are sent to.
+
+        lvm prints its prompt when it is ready for the next command, so
+        everything before the prompt is the output of the previous one.
+        The shell does not report exit statuses, so only queries go
+        through it. It also splits its input on whitespace and passes
+        quotes through as they are, so commands with an argument that
+        contains whitespace are left to capture to run the usual way.
+
+        The shell is stopped whenever lvm is run to change something, and
+        whenever the lvm report is flushed, so that it never works from a
+        stale view of the devices.
+    """
+    prompt = "lvm> "
+
+    def __init__(self):
+        self._proc = None
+        self._lock = threading.Lock()
+        self.available = True
+
+    def _start(self, stderr):
+        # a dumb, very wide terminal keeps readline from redrawing or
+        # scrolling the command lines it echoes
+        env = os.environ.copy()
+        env.update({"LC_ALL": "C", "TERM": "dumb", "COLUMNS": "65535"})
+        try:
+            errfd = os.open(stderr, os.O_RDWR|os.O_CREAT)
+        except OSError:
+            errfd = os.open("/dev/null", os.O_RDWR)
+
+        try:
+            self._proc = subprocess.Popen(["lvm"], stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=errfd, env=env,
+                                          close_fds=True)
+        except OSError as e:
+            log.info("cannot start the lvm shell: %s" % (e,))
+            self._proc = None
+        finally:
+            os.close(errfd)
+
+        # lvm built without readline has no shell and just exits
+        if self._proc is None or self._read() is None:
+            log.info("lvm shell not available, running lvm for each command")
+            self._stop()
+            self.available = False
+            return False
+
+        return True
+
+    def _read(self):
+        """ Return the output up to the next prompt, or None at EOF. """
+        buf = ""
+        fd = self._proc.stdout.fileno()
+        while not buf.endswith(self.prompt):
+            data = os.read(fd, 65536)
+            if not data:
+                return None
+            buf += data
+
+        return buf[:-len(self.prompt)]
+
+    def capture(self, argv, stderr="/dev/tty5"):
+        """ Return the output of an lvm command, or None if it has to be
+            run the usual way.
+        """
+        if not self.available:
+            return None
+
+        for arg in argv:
+            if not arg or [c for c in arg if c.isspace() or c == "#"]:
+                return None
+
+        line = " ".join(argv)
+        self._lock.acquire()
+        try:
+            if self._proc is None and not self._start(stderr):
+                return None
+
+            try:
+                self._proc.stdin.write(line + "\n")
+                self._proc.stdin.flush()
+                buf = self._read()
+            except (IOError, OSError):
+                buf = None
+
+            if buf is None:
+                # the shell is gone, the next command starts a new one
+                log.info("lvm shell exited unexpectedly")
+                self._stop()
+                return None
+        finally:
+            self._lock.release()
+
+        # readline echoes the command line before the output
+        (first, newline, rest) = buf.partition("\n")
+        if first.rstrip("\r").endswith(line):
+            buf = rest
+
+        return buf
+
+    def stop(self):
+        """ Stop the shell, if it is running. """
+        self._lock.acquire()
+        try:
+            self._stop()
+        finally:
+            self._lock.release()
+
+    def _stop(self):
+        proc = self._proc
+        self._proc = None
+        if proc is None:
+            return
+
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+
+lvm_shell = LVMShell()
+
+def _key(command, argv):
+    if argv:
+        return "%s %s" % (command, argv[0])
+
+    return command
+
+def capture(command, argv, stderr="/dev/tty5"):
+    """ Run a query and return its output, see iutil.execWithCapture.
+
+        lvm queries are sent to the lvm shell if possible.
+    """
+    start = time.time()
+    try:
+        if command == "lvm":
+            buf = lvm_shell.capture(argv, stderr=stderr)
+            if buf is not None:
+                return buf
+
+        return iutil.execWithCapture(command, argv, stderr=stderr)
+    finally:
+        stats.record(_key(command, argv), time.time() - start)
+
+def run(command, argv, progress=None,
+        stdout="/dev/tty5", stderr="/dev/tty5"):
+    """ Run a mutation and return its exit status, see
+        iutil.execWithPulseProgress.
+    """
+    if command == "lvm":
+        lvm_shell.stop()
+
+    start = time.time()
+    try:
+        return iutil.execWithPulseProgress(command, argv,
+                                           stdout=stdout,
+                                           stderr=stderr,
+                                           progress=progress)
+    finally:
+        stats.record(_key(command, argv), time.time() - start)
@@ -23,7 +23,7 @@
 import os
 
 import block
-import iutil
+import broker
 from ..errors import *
 
 import gettext
@@ -32,19 +32,57 @@ _ = lambda x: gettext.ldgettext("anaconda", x)
 import logging
 log = logging.getLogger("storage")
 
+# Since 2.6.29 the kernel exports each map's name in /sys/block/dm-*/dm/name,
+# so the lookups below only need dmsetup on older kernels.
+def _sysfs_read(path):
+    try:
+        return open(path).read().strip()
+    except (IOError, OSError):
+        return None
+
+def _sysfs_dm_name(dm_node):
+    return _sysfs_read("/sys/block/%s/dm/name" % dm_node)
+
+def _sysfs_dm_node(map_name):
+    # the map's device node tells us its minor, and dm-N uses minor N
+    try:
+        st = os.stat("/dev/mapper/%s" % map_name)
+    except OSError:
+        st = None
+
+    if st is not None:
+        dm_node = "dm-%d" % os.minor(st.st_rdev)
+        if _sysfs_dm_name(dm_node) == map_name:
+            return dm_node
+
+    try:
+        dm_nodes = os.listdir("/sys/block")
+    except OSError:
+        return None
+
+    for dm_node in dm_nodes:
+        if dm_node.startswith("dm-") and _sysfs_dm_name(dm_node) == map_name:
+            return dm_node
+
+    return None
+
 def name_from_dm_node(dm_node):
     name = block.getNameFromDmNode(dm_node)
     if name is not None:
         return name
 
+    name = _sysfs_dm_name(dm_node)
+    if name:
+        return name
+
     st = os.stat("/dev/%s" % dm_node)
     major = os.major(st.st_rdev)
     minor = os.minor(st.st_rdev)
-    name = iutil.execWithCapture("dmsetup",
-                                 ["info", "--columns",
-                                  "--noheadings", "-o", "name",
-                                  "-j", str(major), "-m", str(minor)],
-                                 stderr="/dev/tty5")
+    name = broker.capture("dmsetup",
+                          ["info", "--columns",
+                           "--noheadings", "-o", "name",
+                           "-j", str(major), "-m", str(minor)],
+                          stderr="/dev/tty5")
     log.debug("name_from_dm(%s) returning '%s'" % (dm_node, name.strip()))
     return name.strip()
 
@@ -53,12 +91,16 @@ def dm_node_from_name(map_name):
     if dm_node is not None:
         return dm_node
 
-    devnum = iutil.execWithCapture("dmsetup",
-                                   ["info", "--columns",
-                                    "--noheadings",
-                                    "-o", "devno",
-                                    map_name],
-                                    stderr="/dev/tty5")
+    dm_node = _sysfs_dm_node(map_name)
+    if dm_node is not None:
+        return dm_node
+
+    devnum = broker.capture("dmsetup",
+                            ["info", "--columns",
+                             "--noheadings",
+                             "-o", "devno",
+                             map_name],
+                            stderr="/dev/tty5")
     (major, sep, minor) = devnum.strip().partition(":")
     if not sep:
         raise DMError("dm device does not exist")
@@ -91,13 +133,20 @@ def dm_is_multipath(info):
                     return True
 
 def _get_backing_devnums_from_map(map_name):
+    dm_node = _sysfs_dm_node(map_name)
+    if dm_node is not None:
+        try:
+            return get_backing_devnums(dm_node)
+        except (IOError, OSError, ValueError):
+            pass
+
     ret = []
-    buf = iutil.execWithCapture("dmsetup",
-                                ["info", "--columns",
-                                 "--noheadings",
-                                 "-o", "devnos_used",
-                                 map_name],
-                                stderr="/dev/tty5")
+    buf = broker.capture("dmsetup",
+                         ["info", "--columns",
+                          "--noheadings",
+                          "-o", "devnos_used",
+                          map_name],
+                         stderr="/dev/tty5")
     dev_nums = buf.split()
     for dev_num in dev_nums:
         (major, colon, minor) = dev_num.partition(":")
@@ -25,6 +25,7 @@ import math
 import re
 
 import iutil
+import broker
 
 from ..errors import *
 from constants import *
@@ -77,7 +78,8 @@ def _composeConfig():
             filter_string = filter_string + ("\"r|%s|\"," % rejects[i])
 
 
-    filter_string = " filter=[%s] " % filter_string.strip(",")
+    # no whitespace, so the lvm shell takes the string as one argument
+    filter_string = "filter=[%s]" % filter_string.strip(",")
 
     # As we add config strings we should check them all.
     if filter_string == "":
@@ -87,7 +89,7 @@ def _composeConfig():
     # devices_string can have (inside the brackets) "dir", "scan",
     # "preferred_names", "filter", "cache_dir", "write_cache_state",
     # "types", "sysfs_scan", "md_component_detection".  see man lvm.conf.
-    devices_string = " devices {%s} " % (filter_string) # strings can be added
+    devices_string = "devices{%s}" % (filter_string) # strings can be added
     config_string = devices_string # more strings can be added.
     config_args = ["--config", config_string]
 
@@ -98,14 +100,118 @@ def lvm_cc_addFilterRejectRegexp(regexp):
 
     # compoes config once more.
     _composeConfig()
+    flush_report()
 
 def lvm_cc_resetFilter():
     global config_args, config_args_data
     config_args_data["filterRejects"] = []
     config_args_data["filterAccepts"] = []
     config_args = []
+    flush_report()
 # End config_args handling code.
 
+# Start report handling code
+#
+# Instead of asking lvm about one PV, VG or LV at a time we run a single
+# pvs and a single lvs for the whole system and keep the result until
+# something changes.  The fields are requested with --nameprefixes and in
+# KB, so they look just like the LVM2_* properties our udev rules add to
+# PVs and can be used with the same udev_device_get_* helpers.
+PV_REPORT_FIELDS = ["pv_name", "pv_uuid", "pe_start", "vg_name", "vg_uuid",
+                    "vg_size", "vg_free", "vg_extent_size",
+                    "vg_extent_count", "vg_free_count", "pv_count"]
+LV_REPORT_FIELDS = ["vg_name", "lv_name", "lv_uuid", "lv_size", "lv_attr",
+                    "origin"]
+LV_LIST_PROPERTIES = ["LVM2_LV_NAME", "LVM2_LV_UUID", "LVM2_LV_SIZE",
+                      "LVM2_LV_ATTR"]
+
+_report = None
+
+def _parse_report(buf):
+    """ Return a list of dicts, one per line of --nameprefixes output. """
+    entries = []
+    for line in buf.splitlines():
+        entry = {}
+        for field in line.split():
+            (key, equals, value) = field.partition("=")
+            if equals:
+                entry[key] = value
+
+        if entry:
+            entries.append(entry)
+
+    return entries
+
+def _run_report(command, fields, extra=[]):
+    args = [command, "--noheadings", "--nosuffix", "--nameprefixes",
+            "--unquoted", "--units", "k"] + \
+            extra + \
+            ["-o", ",".join(fields)] + \
+            config_args
+
+    buf = broker.capture("lvm", args, stderr="/dev/tty5")
+    return _parse_report(buf)
+
+def report():
+    """ Return the LVM metadata of the whole system.
+
+        The result is a dict with these keys:
+
+            pvs -- PV path to a dict of the PV's and its VG's properties
+            pv_uuids -- PV UUID to the same dicts
+            lvs -- VG name to a list of dicts of its LVs' properties,
+                   including hidden mirror images and logs
+
+        It is cached until flush_report is called or an lvm command
+        modifies the metadata.
+    """
+    global _report
+    if _report is None:
+        rep = {"pvs": {}, "pv_uuids": {}, "lvs": {}}
+        for pv in _run_report("pvs", PV_REPORT_FIELDS):
+            rep["pvs"][pv.get("LVM2_PV_NAME")] = pv
+            if pv.get("LVM2_PV_UUID"):
+                rep["pv_uuids"][pv["LVM2_PV_UUID"]] = pv
+
+        for lv in _run_report("lvs", LV_REPORT_FIELDS, extra=["-a"]):
+            rep["lvs"].setdefault(lv.get("LVM2_VG_NAME"), []).append(lv)
+
+        _report = rep
+
+    return _report
+
+def flush_report():
+    """ Forget the cached report so the next one rereads the metadata. """
+    global _report
+    _report = None
+    broker.lvm_shell.stop()
+
+def pvreport(device, uuid=None):
+    """ Return the LVM2_* properties for a PV, or None if lvm has none.
+
+        Like the properties our udev rules add, the LV properties are
+        lists covering every LV in the PV's VG.
+    """
+    rep = report()
+    pv = rep["pvs"].get(device)
+    if pv is None and uuid:
+        pv = rep["pv_uuids"].get(uuid)
+    if pv is None:
+        return None
+
+    info = pv.copy()
+    if not info.get("LVM2_VG_NAME"):
+        # not part of any vg
+        info.pop("LVM2_VG_NAME", None)
+        return info
+
+    lvs = rep["lvs"].get(pv.get("LVM2_VG_NAME"), [])
+    for key in LV_LIST_PROPERTIES:
+        info[key] = [lv.get(key, "") for lv in lvs]
+
+    return info
+# End report handling code.
+
 # Names that should not be used int the creation of VGs
 lvm_vg_blacklist = []
 def blacklistVG(name):
@@ -159,10 +265,11 @@ def clampSize(size, pesize, roundup=None):
     return long(round(float(size)/float(pesize)) * pesize)
 
 def lvm(args, progress=None):
-    rc = iutil.execWithPulseProgress("lvm", args,
-                                     stdout = "/dev/tty5",
-                                     stderr = "/dev/tty5",
-                                     progress=progress)
+    # (de)activation leaves the metadata alone, anything else may change it
+    if args[0] not in ("vgchange", "lvchange") or args[1] != "-a":
+        flush_report()
+
+    rc = broker.run("lvm", args, progress=progress)
     if not rc:
         return
 
@@ -222,8 +329,8 @@ def pvinfo(device):
             config_args + \
             [device]
 
-    rc = iutil.execWithCapture("lvm", args,
-                                stderr = "/dev/tty5")
+    rc = broker.capture("lvm", args,
+                        stderr = "/dev/tty5")
     vals = rc.split()
     if not vals:
         raise LVMError("pvinfo failed for %s" % device)
@@ -309,9 +416,9 @@ def vginfo(vg_name):
             config_args + \
             [vg_name]
 
-    buf = iutil.execWithCapture("lvm",
-                                args,
-                                stderr="/dev/tty5")
+    buf = broker.capture("lvm",
+                         args,
+                         stderr="/dev/tty5")
     info = buf.split()
     if len(info) != 7:
         raise LVMError(_("vginfo failed for %s" % vg_name))
@@ -328,9 +435,9 @@ def lvs(vg_name):
             config_args + \
             [vg_name]
 
-    buf = iutil.execWithCapture("lvm",
-                                args,
-                                stderr="/dev/tty5")
+    buf = broker.capture("lvm",
+                         args,
+                         stderr="/dev/tty5")
 
     lvs = {}
     for line in buf.splitlines():
@@ -348,13 +455,18 @@ def lvs(vg_name):
     return lvs
 
 def lvorigin(vg_name, lv_name):
+    if _report is not None:
+        for lv in _report["lvs"].get(vg_name, []):
+            if lv.get("LVM2_LV_NAME") == lv_name:
+                return lv.get("LVM2_ORIGIN", "")
+
     args = ["lvs", "--noheadings", "-o", "origin"] + \
             config_args + \
             ["%s/%s" % (vg_name, lv_name)]
 
-    buf = iutil.execWithCapture("lvm",
-                                args,
-                                stderr="/dev/tty5")
+    buf = broker.capture("lvm",
+                         args,
+                         stderr="/dev/tty5")
 
     try:
         origin = buf.splitlines()[0].strip()
@@ -396,24 +508,32 @@ def lvresize(vg_name, lv_name, size):
     except LVMError as msg:
         raise LVMError("lvresize failed for %s: %s" % (lv_name, msg))
 
-def lvactivate(vg_name, lv_name):
+def _lv_paths(vg_name, lv_names):
+    if isinstance(lv_names, basestring):
+        lv_names = [lv_names]
+
+    return ["%s/%s" % (vg_name, lv_name) for lv_name in lv_names]
+
+def lvactivate(vg_name, lv_names):
+    """ Activate one LV, or a list of LVs of the same VG in one go. """
     # see if lvchange accepts paths of the form 'mapper/$vg-$lv'
     args = ["lvchange", "-a", "y"] + \
             config_args + \
-            ["%s/%s" % (vg_name, lv_name)]
+            _lv_paths(vg_name, lv_names)
 
     try:
         lvm(args)
     except LVMError as msg:
-        raise LVMError("lvactivate failed for %s: %s" % (lv_name, msg))
+        raise LVMError("lvactivate failed for %s: %s" % (lv_names, msg))
 
-def lvdeactivate(vg_name, lv_name):
+def lvdeactivate(vg_name, lv_names):
+    """ Deactivate one LV, or a list of LVs of the same VG in one go. """
     args = ["lvchange", "-a", "n"] + \
             config_args + \
-            ["%s/%s" % (vg_name, lv_name)]
+            _lv_paths(vg_name, lv_names)
 
     try:
         lvm(args)
     except LVMError as msg:
-        raise LVMError("lvdeactivate failed for %s: %s" % (lv_name, msg))
+        raise LVMError("lvdeactivate failed for %s: %s" % (lv_names, msg))
 
@@ -22,7 +22,7 @@
 
 import os
 
-import iutil
+import broker
 from ..errors import *
 
 import gettext
@@ -125,10 +125,7 @@ def get_raid_max_spares(raidlevel, nummembers):
     raise ValueError, "invalid raid level %d" % raidlevel
 
 def mdadm(args, progress=None):
-    rc = iutil.execWithPulseProgress("mdadm", args,
-                                     stdout = "/dev/tty5",
-                                     stderr = "/dev/tty5",
-                                     progress=progress)
+    rc = broker.run("mdadm", args, progress=progress)
     if not rc:
         return
 
@@ -142,7 +139,7 @@ def mdadm(args, progress=None):
     raise MDRaidError(msg)
 
 def mdcreate(device, level, disks, spares=0, metadataVer=None, bitmap=False,
-             progress=None):
+             assumeClean=False, progress=None):
     argv = ["--create", device, "--run", "--level=%s" % level]
     raid_devs = len(disks) - spares
     argv.append("--raid-devices=%d" % raid_devs)
@@ -152,6 +149,9 @@ def mdcreate(device, level, disks, spares=0, metadataVer=None, bitmap=False,
         argv.append("--metadata=%s" % metadataVer)
     if bitmap:
         argv.append("--bitmap=internal")
+    if assumeClean:
+        # skip the initial resync, see MDRaidArrayDevice.assumeClean
+        argv.append("--assume-clean")
     argv.extend(disks)
     
     try:
@@ -203,10 +203,83 @@ def mddeactivate(device):
     except MDRaidError as msg:
         raise MDRaidError("mddeactivate failed for %s: %s" % (device, msg))
 
+# Resync speed limits, in KiB/s per member, used while installing.  The
+# initial resync of new arrays would otherwise compete with mkfs and the
+# package copy for the same disks; it runs at full speed once the limits
+# are restored at the end of the install.
+RESYNC_SPEED_LIMIT_MIN = 100
+RESYNC_SPEED_LIMIT_MAX = 10000
+
+_saved_speed_limits = None
+
+def _speed_limit_path(which):
+    return "/proc/sys/dev/raid/speed_limit_%s" % which
+
+def mdthrottle_resync(minimum=RESYNC_SPEED_LIMIT_MIN,
+                      maximum=RESYNC_SPEED_LIMIT_MAX):
+    """ Lower the resync speed limits until mdrestore_resync is called. """
+    global _saved_speed_limits
+    try:
+        limits = {}
+        for which in ("min", "max"):
+            limits[which] = open(_speed_limit_path(which)).read().strip()
+
+        if _saved_speed_limits is None:
+            _saved_speed_limits = limits
+
+        for (which, value) in (("min", minimum), ("max", maximum)):
+            open(_speed_limit_path(which), "w").write("%d\n" % value)
+    except IOError as e:
+        log.warning("failed to throttle md resync: %s" % e)
+        return
+
+    log.info("md resync limited to %d-%d KiB/s" % (minimum, maximum))
+
+def mdrestore_resync():
+    """ Put back the resync speed limits mdthrottle_resync changed. """
+    global _saved_speed_limits
+    if _saved_speed_limits is None:
+        return
+
+    try:
+        # raise max before min so that min never exceeds max
+        for which in ("max", "min"):
+            open(_speed_limit_path(which), "w").write(
+                                "%s\n" % _saved_speed_limits[which])
+    except IOError as e:
+        log.warning("failed to restore md resync speed: %s" % e)
+        return
+
+    log.info("md resync limits restored to %s-%s KiB/s"
+             % (_saved_speed_limits["min"], _saved_speed_limits["max"]))
+    _saved_speed_limits = None
+
+def mdresync_progress(name):
+    """ Return the sync action of an array and how far along it is.
+
+        The action is eg. "resync", "recover" or "idle"; the progress is a
+        fraction between 0 and 1, or None when no sync is running.  None is
+        returned for arrays the kernel does not know about.
+    """
+    sysdir = "/sys/block/%s/md" % name
+    try:
+        action = open("%s/sync_action" % sysdir).read().strip()
+        completed = open("%s/sync_completed" % sysdir).read().strip()
+    except IOError:
+        return None
+
+    (done, slash, total) = completed.partition("/")
+    try:
+        progress = float(done) / float(total)
+    except (ValueError, ZeroDivisionError):
+        progress = None
+
+    return (action, progress)
+
 def mdexamine(device):
-    vars = iutil.execWithCapture("mdadm",
-                                 ["--examine", "--brief", device],
-                                 stderr="/dev/tty5").split()
+    vars = broker.capture("mdadm",
+                          ["--examine", "--brief", device],
+                          stderr="/dev/tty5").split()
 
     info = {}
     if vars:
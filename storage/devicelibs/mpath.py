@@ -1,5 +1,7 @@
+import re
+
 from ..udev import *
-import iutil
+import broker
 
 def parseMultipathOutput(output):
     # this function parses output from "multipath -d", so we can use its
@@ -50,7 +52,90 @@ def parseMultipathOutput(output):
 
     return mpaths
 
-def identifyMultipaths(devices):
+# the devices multipath ignores, as in the blacklist section
+# MultipathConfigWriter writes
+BLACKLIST_DEVNODES = [re.compile(r"^(ram|raw|loop|fd|md|dm-|sr|scd|st)[0-9]*"),
+                      re.compile(r"^hd[a-z]"),
+                      re.compile(r"^dcssblk[0-9]*")]
+BLACKLIST_DEVICES = [(re.compile(r"DGC"), re.compile(r"LUNZ")),
+                     (re.compile(r"IBM"), re.compile(r"S/390.*")),
+                     (re.compile(r"ATA"), None),
+                     (re.compile(r"3ware"), None),
+                     (re.compile(r"AMCC"), None),
+                     (re.compile(r"HPT"), None)]
+
+def _multipath_wwid(info):
+    """ Return the WWID multipath would group a path by, or None.
+
+        This is ID_SERIAL, multipath's default uid_attribute, which
+        MultipathDevice also takes its identity and wwid alias from.
+    """
+    return info.get("ID_SERIAL")
+
+def _multipath_blacklisted(info, wwids=None, models=None):
+    """ Return True if multipath.conf keeps multipath off the device.
+
+        wwids and models hold the serials and (vendor, model) pairs of the
+        devices MultipathConfigWriter blacklists in addition to the static
+        entries.
+    """
+    if wwids is None:
+        wwids = set()
+    if models is None:
+        models = set()
+
+    for devnode in BLACKLIST_DEVNODES:
+        if devnode.match(info['name']):
+            return True
+
+    if udev_device_get_serial(info) in wwids or \
+       _multipath_wwid(info) in wwids:
+        return True
+
+    if (udev_device_get_vendor(info), udev_device_get_model(info)) in models:
+        return True
+
+    vendor = info.get("ID_VENDOR", "").strip()
+    model = info.get("ID_MODEL", "").strip()
+    for (vendor_re, model_re) in BLACKLIST_DEVICES:
+        if vendor_re.match(vendor) and (not model_re or model_re.match(model)):
+            return True
+
+    return False
+
+def _multipath_name(index):
+    """ Return the user friendly name of the index'th multipath, ie.
+        mpatha to mpathz, then mpathaa and so on.
+    """
+    suffix = ""
+    index += 1
+    while index:
+        (index, letter) = divmod(index - 1, 26)
+        suffix = chr(ord("a") + letter) + suffix
+
+    return "mpath" + suffix
+
+def verifyMultipaths(multipaths):
+    """ Compare multipath sets with what "multipath -d" makes of the paths.
+
+        Logs a warning for every set the two do not agree on and returns
+        True if they agree on all of them.
+    """
+    topology = parseMultipathOutput(broker.capture("multipath", ["-d",]))
+    theirs = set([frozenset(disks) for disks in topology.values()
+                    if len(disks) > 1])
+    ours = set([frozenset([d['name'] for d in mpath]) for mpath in multipaths])
+
+    for disks in ours - theirs:
+        log.warning("multipath -d does not agree on multipath set %s"
+                    % sorted(disks))
+    for disks in theirs - ours:
+        log.warning("multipath -d has multipath set %s that was not found"
+                    % sorted(disks))
+
+    return ours == theirs
+
+def identifyMultipaths(devices, blacklist=None, verify=False):
     # this function does a couple of things
     # 1) identifies multipath disks
     # 2) sets their ID_FS_TYPE to multipath_member
@@ -59,94 +144,92 @@ def identifyMultipaths(devices):
     # [sr0, sda, sda1, sdb, sdb1, sdb2, sdc, sdc1, sdd, sdd1, sdd2]
     # sample output:
     # [sda, sdd], [[sdb, sdc]], [sr0, sda1, sdd1, sdd2]]
+    #
+    # Disks are grouped by their WWIDs, the same way multipath does it, and
+    # the groups are named the way it would with user_friendly_names. With
+    # verify set, "multipath -d" is run to check the result. The names
+    # only hold once they are in multipath.conf as aliases, so they have
+    # to be written there before any of the maps is set up.
+    #
+    # blacklist is MultipathConfigWriter.blacklist_devices.
     log.info("devices to scan for multipath: %s" % [d['name'] for d in devices])
+    if blacklist is None:
+        blacklist = []
 
-    topology = parseMultipathOutput(iutil.execWithCapture("multipath", ["-d",]))
-    # find the devices that aren't in topology, and add them into it...
-    topodevs = reduce(lambda x,y: x.union(y), topology.values(), set())
-    for name in set([d['name'] for d in devices]).difference(topodevs):
-        topology[name] = [name]
-    
-    devmap = {}
-    non_disk_devices = {}
+    blacklist_wwids = set()
+    blacklist_models = set()
+    for device in blacklist:
+        if device.serial:
+            blacklist_wwids.add(device.serial)
+        elif device.vendor and device.model:
+            blacklist_models.add((device.vendor, device.model))
+
+    groups = {}         # wwid -> the disks with that wwid
+    wwids = []          # the wwids, in order of their first disk
+    singles = set()     # sysfs paths of the singlepath disks
+    non_disks = []
     for d in devices:
         if not udev_device_is_disk(d):
-            non_disk_devices[d['name']] = d
             log.info("adding %s to non_disk_device list" % (d['name'],))
+            non_disks.append(d)
             continue
-        devmap[d['name']] = d
 
-    singlepath_disks = []
-    multipaths = []
+        wwid = _multipath_wwid(d)
+        if not wwid or \
+           _multipath_blacklisted(d, blacklist_wwids, blacklist_models):
+            singles.add(d['sysfs_path'])
+            continue
 
-    for name, disks in topology.items():
+        if wwid not in groups:
+            groups[wwid] = []
+            wwids.append(wwid)
+        groups[wwid].append(d)
+
+    multipaths = []
+    mpath_serials = set()
+    for wwid in wwids:
+        disks = groups[wwid]
+        names = [d['name'] for d in disks]
         if len(disks) == 1:
-            if not non_disk_devices.has_key(disks[0]):
-                log.info("adding %s to singlepath_disks" % (disks[0],))
-                singlepath_disks.append(devmap[disks[0]])
-        else:
-            # some usb cardreaders use multiple lun's (for different slots)
-            # and report a fake disk serial which is the same for all the
-            # lun's (#517603)
-            all_usb = True
-            # see if we've got any non-disk devices on our mpath list.
-            # If so, they're probably false-positives.
-            non_disks = False
-            for disk in disks:
-                d = devmap[disk]
-                if d.get("ID_USB_DRIVER") != "usb-storage":
-                    all_usb = False
-                if (not devmap.has_key(disk)) and non_disk_devices.has_key(disk):
-                    log.warning("non-disk device %s is part of an mpath" %
-                                (disk,))
-                    non_disks = True
-
-            if all_usb:
-                log.info("adding multi lun usb mass storage device to singlepath_disks: %s" %
-                         (disks,))
-                singlepath_disks.extend([devmap[d] for d in disks])
-                continue
-
-            if non_disks:
-                for disk in disks:
-                    if devmap.has_key(disk):
-                        del devmap[disk]
-                    if topology.has_key(disk):
-                        del topology[disk]
-                continue
-
-            log.info("found multipath set: %s" % (disks,))
-            for disk in disks:
-                d = devmap[disk]
-                log.info("adding %s to multipath_disks" % (disk,))
-                d["ID_FS_TYPE"] = "multipath_member"
-                d["ID_MPATH_NAME"] = name
-            
-            multipaths.append([devmap[d] for d in disks])
-
-    non_disk_serials = {}
-    for name,device in non_disk_devices.items():
-        serial = udev_device_get_serial(device)
-        non_disk_serials.setdefault(serial, [])
-        non_disk_serials[serial].append(device)
+            log.info("adding %s to singlepath_disks" % (names[0],))
+            singles.add(disks[0]['sysfs_path'])
+            continue
 
-    for mpath in multipaths:
-        for serial in [d.get('ID_SERIAL_SHORT') for d in mpath]:
-            if non_disk_serials.has_key(serial):
-                log.info("filtering out non disk devices [%s]" % [d['name'] for d in non_disk_serials[serial]])
-                for name in [d['name'] for d in non_disk_serials[serial]]:
-                    if non_disk_devices.has_key(name):
-                        del non_disk_devices[name]
+        # some usb cardreaders use multiple lun's (for different slots)
+        # and report a fake disk serial which is the same for all the
+        # lun's (#517603)
+        usb = [d for d in disks if d.get("ID_USB_DRIVER") == "usb-storage"]
+        if len(usb) == len(disks):
+            log.info("adding multi lun usb mass storage device to singlepath_disks: %s" %
+                     (names,))
+            singles.update([d['sysfs_path'] for d in disks])
+            continue
+
+        name = _multipath_name(len(multipaths))
+        log.info("found multipath set %s: %s" % (name, names))
+        for d in disks:
+            d["ID_FS_TYPE"] = "multipath_member"
+            d["ID_MPATH_NAME"] = name
+            mpath_serials.add(d.get('ID_SERIAL_SHORT'))
 
+        multipaths.append(disks)
+
+    # the partitions of the paths show up as non-disk devices with the
+    # serial of their disk
+    mpath_serials.discard(None)
     partition_devices = []
-    for device in non_disk_devices.values():
-        partition_devices.append(device)
+    for d in non_disks:
+        if udev_device_get_serial(d) in mpath_serials:
+            log.info("filtering out non disk device %s" % (d['name'],))
+            continue
+
+        partition_devices.append(d)
+
+    # keep the order of the original device list
+    singlepath_disks = [d for d in devices if d['sysfs_path'] in singles]
 
-    # this is the list of devices we want to keep from the original
-    # device list, but we want to maintain its original order.
-    singlepath_disks = filter(lambda d: d in devices, singlepath_disks)
-    #multipaths = filter(lambda d: d in devices, multipaths)
-    partition_devices = filter(lambda d: d in devices, partition_devices)
+    if verify:
+        verifyMultipaths(multipaths)
 
     mpathStr = "["
     for mpath in multipaths:
@@ -172,7 +255,7 @@ class MultipathConfigWriter:
 
     def write(self):
         # if you add anything here, be sure and also add it to anaconda's
-        # multipath.conf
+        # multipath.conf and to BLACKLIST_DEVNODES or BLACKLIST_DEVICES
         ret = ''
         ret += """\
 # multipath.conf written by anaconda
@@ -0,0 +1,153 @@
+#
+# wipe.py
+# removal of metadata signatures from block devices
+#
+# Copyright (C) 2009  Red Hat, Inc.  All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import errno
+import fcntl
+import struct
+import time
+
+import logging
+log = logging.getLogger("storage")
+
+MB = 1024 * 1024
+
+# from linux/fs.h
+BLKDISCARD = 0x1277
+BLKDISCARDZEROES = 0x127c
+BLKZEROOUT = 0x127f
+
+# errors meaning the device or kernel does not do an ioctl at all
+UNSUPPORTED = (errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS)
+
+# what we write when the kernel cannot zero a range for us; one buffer is
+# shared by every wipe
+_zeroes = "\0" * MB
+
+def _spans(ranges, size):
+    """ Turn (offset, length) ranges into sorted, merged (start, end) spans
+        within a device of the given size.
+
+        Negative offsets count from the end of the device.
+    """
+    spans = []
+    for (offset, length) in ranges:
+        if offset < 0:
+            offset = max(0, size + offset)
+        if offset >= size:
+            continue
+
+        spans.append((offset, min(offset + length, size)))
+
+    spans.sort()
+    merged = []
+    for (start, end) in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+def _discard_zeroes_data(fd):
+    try:
+        buf = fcntl.ioctl(fd, BLKDISCARDZEROES, struct.pack("I", 0))
+    except IOError:
+        return False
+
+    return struct.unpack("I", buf)[0] == 1
+
+def _write_zeroes(fd, start, end):
+    os.lseek(fd, start, 0)
+    while start < end:
+        start += os.write(fd, buffer(_zeroes, 0, min(len(_zeroes),
+                                                      end - start)))
+
+def discard(device):
+    """ Discard all of a block device if discarded blocks read back as
+        zeroes.
+
+        Returns True if the device was discarded, in which case it reads
+        back as all zeroes.
+    """
+    fd = os.open(device, os.O_RDWR)
+    try:
+        if not _discard_zeroes_data(fd):
+            return False
+
+        size = os.lseek(fd, 0, 2)
+        try:
+            fcntl.ioctl(fd, BLKDISCARD, struct.pack("QQ", 0, size))
+        except IOError as e:
+            if e.errno in UNSUPPORTED:
+                return False
+            raise
+    finally:
+        os.close(fd)
+
+    log.debug("discarded all of %s" % (device,))
+    return True
+
+def wipe(device, ranges):
+    """ Zero out the given (offset, length) ranges of a block device.
+
+        Negative offsets count from the end of the device and ranges that
+        do not fit on the device are cut short. Devices that read back
+        zeroes after a discard have the ranges discarded, others are
+        zeroed with BLKZEROOUT, and only if the kernel cannot do either is
+        the data written out.
+
+        Returns the number of bytes wiped.
+    """
+    start_time = time.time()
+    fd = os.open(device, os.O_RDWR)
+    try:
+        size = os.lseek(fd, 0, 2)
+
+        requests = [BLKZEROOUT]
+        if _discard_zeroes_data(fd):
+            requests.insert(0, BLKDISCARD)
+
+        wiped = 0
+        written = False
+        for (start, end) in _spans(ranges, size):
+            for request in requests[:]:
+                try:
+                    fcntl.ioctl(fd, request,
+                                struct.pack("QQ", start, end - start))
+                except IOError as e:
+                    if e.errno in UNSUPPORTED:
+                        requests.remove(request)
+                else:
+                    break
+            else:
+                _write_zeroes(fd, start, end)
+                written = True
+
+            wiped += end - start
+
+        if written:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    log.debug("wiped %d bytes of %s in %.3fs" % (wiped, device,
+                                                  time.time() - start_time))
+    return wiped
@@ -97,12 +97,14 @@ import os
 import math
 import copy
 import time
+import weakref
 
 # device backend modules
 from devicelibs import mdraid
 from devicelibs import lvm
 from devicelibs import dm
 from devicelibs import crypto
+from devicelibs import wipe
 import parted
 import _ped
 import block
@@ -171,6 +173,39 @@ def deviceNameToDiskByPath(deviceName=None):
     return ""
 
 
+def _notifying(method):
+    """ Wrap a list method so that it reports changes to the owning device. """
+    def wrapper(self, *args):
+        ret = method(self, *args)
+        device = self._device()
+        if device is not None:
+            device._reindex()
+        return ret
+    return wrapper
+
+class ParentList(list):
+    """ A device's list of parent devices.
+
+        The device tree indexes devices by their parents, so in-place
+        changes to the list are reported to the owning device the same
+        way a reassignment of its parents attribute is.
+    """
+    def __init__(self, device, parents=None):
+        list.__init__(self, parents or [])
+        self._device = weakref.ref(device)
+
+    append = _notifying(list.append)
+    extend = _notifying(list.extend)
+    insert = _notifying(list.insert)
+    remove = _notifying(list.remove)
+    pop = _notifying(list.pop)
+    __setitem__ = _notifying(list.__setitem__)
+    __delitem__ = _notifying(list.__delitem__)
+    __setslice__ = _notifying(list.__setslice__)
+    __delslice__ = _notifying(list.__delslice__)
+    __iadd__ = _notifying(list.__iadd__)
+
+
 class Device(object):
     """ A generic device.
 
@@ -208,6 +243,12 @@ class Device(object):
     # This is a counter for generating unique ids for Devices.
     _id = 0
 
+    # weak reference to the DeviceTree this device has been added to
+    _tree = None
+
+    # attributes the DeviceTree looks devices up by
+    _indexedAttrs = ("_name", "_parents", "_format", "uuid", "sysfsPath")
+
     _type = "generic device"
     _packages = []
 
@@ -253,11 +294,39 @@ class Device(object):
                 setattr(new, attr, value)
             elif attr in shallow_copy_attrs:
                 setattr(new, attr, copy.copy(value))
+            elif attr == "_parents":
+                setattr(new, attr,
+                        ParentList(new, copy.deepcopy(list(value), memo)))
             else:
                 setattr(new, attr, copy.deepcopy(value, memo))
 
+        # deepcopy keeps weak references as they are; the copy is in no
+        # tree and its format belongs to it, not to this device
+        new._tree = None
+        format = getattr(new, "_format", None)
+        if format is not None:
+            format._owner = weakref.ref(new)
+
         return new
 
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+        if attr in self._indexedAttrs:
+            self._reindex()
+
+    def _reindex(self):
+        """ Tell the DeviceTree containing this device that it changed. """
+        tree = self._tree and self._tree()
+        if tree is not None:
+            tree._reindexDevice(self)
+
+    def _setParents(self, parents):
+        self._parents = ParentList(self, parents)
+
+    parents = property(lambda d: d._parents,
+                       lambda d,p: d._setParents(p),
+                       doc="The devices this device depends on.")
+
     def __str__(self):
         s = ("%(type)s instance (%(id)s) --\n"
              "  name = %(name)s  status = %(status)s"
@@ -323,6 +392,11 @@ class Device(object):
 
     def dependsOn(self, dep):
         """ Return True if this device depends on dep. """
+        # devices in a tree can use its memoized ancestor sets
+        tree = self._tree and self._tree()
+        if tree is not None and dep._tree and dep._tree() is tree:
+            return dep in tree.getAncestors(self)
+
         # XXX does a device depend on itself?
         if dep in self.parents:
             return True
@@ -703,6 +777,7 @@ class StorageDevice(Device):
             # FIXME: self.format.status doesn't mean much
             raise DeviceError("cannot replace active format", self.name)
 
+        format._owner = weakref.ref(self)
         self._format = format
 
     def _getFormat(self):
@@ -755,6 +830,21 @@ class StorageDevice(Device):
         finally:
             rem_f.close()
 
+    @property
+    def rotational(self):
+        """ Is this spinning media, or does it sit on top of any? """
+        devpath = os.path.normpath("/sys/%s" % self.sysfsPath)
+        try:
+            return open("%s/queue/rotational" % devpath).read().strip() != "0"
+        except IOError:
+            pass
+
+        # partitions and the like have no queue of their own
+        if self.parents:
+            return True in [p.rotational for p in self.parents]
+
+        return True
+
     @property
     def isDisk(self):
         return self._isDisk
@@ -1999,6 +2089,51 @@ class LVMVolumeGroupDevice(DMDevice):
         finally:
             self.exists = False
 
+    def setupLVs(self, lvs=None, orig=False):
+        """ Activate several of this VG's LVs with a single lvm command.
+
+            By default all of the VG's LVs are activated.
+        """
+        log_method_call(self, self.name, orig=orig, status=self.status)
+        if lvs is None:
+            lvs = self.lvs
+
+        lvs = [lv for lv in lvs if lv.exists and not lv.status]
+        if not lvs:
+            return
+
+        self.setup(orig=orig)
+        lvm.lvactivate(self.name, [lv.lvname for lv in lvs])
+
+        # we always probe since the device may not be set up when we want
+        # information about it
+        for lv in lvs:
+            lv._size = lv.currentSize
+
+    def teardownLVs(self, lvs=None, recursive=None):
+        """ Deactivate several of this VG's LVs with a single lvm command.
+
+            By default all of the VG's LVs are deactivated.
+        """
+        log_method_call(self, self.name, status=self.status)
+        if lvs is None:
+            lvs = self.lvs
+
+        udev_settle()
+        for lv in lvs:
+            lv.teardownFormats()
+
+        active = [lv for lv in lvs if lv.status]
+        if active:
+            lvm.lvdeactivate(self.name, [lv.lvname for lv in active])
+
+        if recursive:
+            # see LVMLogicalVolumeDevice.teardown
+            try:
+                self.teardown(recursive=recursive)
+            except Exception as e:
+                log.debug("vg %s teardown failed; continuing" % self.name)
+
     def reduce(self, pv_list):
         """ Remove the listed PVs from the VG. """
         log_method_call(self, self.name, status=self.status)
@@ -2022,6 +2157,30 @@ class LVMVolumeGroupDevice(DMDevice):
 
         self._lvs.append(lv)
 
+    def growLVs(self, growth):
+        """ Grow LVs by the given numbers of extents.
+
+            Arguments:
+
+                growth -- a dict of LVMLogicalVolumeDevice to extent count
+
+            The space needed is checked against the free space once for
+            all of the LVs instead of once for each LV, as setting their
+            sizes one at a time would.
+        """
+        needed = sum([n * self.peSize * lv.stripes
+                      for (lv, n) in growth.items()])
+        if needed > self.freeSpace:
+            raise ValueError("not enough free space in volume group")
+
+        for (lv, n) in growth.items():
+            if lv.vg != self:
+                raise ValueError("lv %s is not part of this vg" % lv.name)
+
+            # the free space was checked for all of them above
+            size = lv._size + n * self.peSize
+            lv._resize(size, size)
+
     def _removeLogVol(self, lv):
         """ Remove an LV from this VG. """
         if lv not in self.lvs:
@@ -2261,13 +2420,20 @@ class LVMLogicalVolumeDevice(DMDevice):
         return self.stripes > 1
 
     def _setSize(self, size):
+        self._resize(size, self.vg.freeSpace + self._size)
+
+    def _resize(self, size, available):
+        """ Set the LV's size, aligned to the VG's extents.
+
+            available is the largest size, in MB, the LV can have.
+        """
         size = self.vg.align(numeric_type(size))
         log.debug("trying to set lv %s size to %dMB" % (self.name, size))
-        if size <= (self.vg.freeSpace + self._size):
+        if size <= available:
             self._size = size
             self.targetSize = size
         else:
-            log.debug("failed to set size: %dMB short" % (size - (self.vg.freeSpace + self._size),))
+            log.debug("failed to set size: %dMB short" % (size - available,))
             raise ValueError("not enough free space in volume group")
 
     size = property(StorageDevice._getSize, _setSize)
@@ -2338,12 +2504,7 @@ class LVMLogicalVolumeDevice(DMDevice):
             raise DeviceError("device has not been created", self.name)
 
         udev_settle()
-        if self.status:
-            if self.originalFormat.exists:
-                self.originalFormat.teardown()
-            if self.format.exists:
-                self.format.teardown()
-            udev_settle()
+        self.teardownFormats()
 
         if self.status:
             lvm.lvdeactivate(self.vg.name, self._name)
@@ -2357,6 +2518,15 @@ class LVMLogicalVolumeDevice(DMDevice):
             except Exception as e:
                 log.debug("vg %s teardown failed; continuing" % self.vg.name)
 
+    def teardownFormats(self):
+        """ Tear down the formats of an active LV before deactivating it. """
+        if self.status:
+            if self.originalFormat.exists:
+                self.originalFormat.teardown()
+            if self.format.exists:
+                self.format.teardown()
+            udev_settle()
+
     def create(self, intf=None):
         """ Create the device. """
         log_method_call(self, self.name, status=self.status)
@@ -2479,6 +2649,10 @@ class MDRaidArrayDevice(StorageDevice):
         # It can be internal or external. External requires a filename.
         self.bitmap = bitmap
 
+        # whether to skip the initial resync, None to skip it only if the
+        # members can be zeroed by discarding them, see _zeroMembers
+        self.assumeClean = None
+
         self.formatClass = get_device_format_class("mdmember")
         if not self.formatClass:
             raise DeviceError("cannot find class for 'mdmember'", self.name)
@@ -2775,6 +2949,38 @@ class MDRaidArrayDevice(StorageDevice):
         """ Return a list of this array's member device instances. """
         return self.parents
 
+    def _zeroMembers(self):
+        """ Discard the members of a new mirror so that it can be created
+            without the initial resync.
+
+            Only mirrors whose members all read back zeroes after a
+            discard qualify. Arrays with parity always need the resync
+            unless the members are known to be zeroed; whoever zeroed them
+            can say so by setting assumeClean. Returns True if the members
+            were zeroed.
+        """
+        if self.level not in (mdraid.RAID1, mdraid.RAID10):
+            return False
+
+        if True in [m.rotational for m in self.devices]:
+            return False
+
+        for member in self.devices:
+            if not wipe.discard(member.path):
+                return False
+
+        return True
+
+    @property
+    def resyncProgress(self):
+        """ The array's sync action and its progress, see
+            mdraid.mdresync_progress.
+        """
+        if not self.exists:
+            return None
+
+        return mdraid.mdresync_progress(self.name)
+
     def setup(self, intf=None, orig=False):
         """ Open, or set up, a device. """
         log_method_call(self, self.name, orig=orig, status=self.status)
@@ -2841,45 +3047,65 @@ class MDRaidArrayDevice(StorageDevice):
                                     % (self.path,),
                                     100, pulse = True)
         try:
-            self.createParents()
-            self.setupParents()
-
-            disks = [disk.path for disk in self.devices]
-            spares = len(self.devices) - self.memberDevices
-
-            # Figure out format specific options
-            metadata="1.1"
-            # bitmaps are not meaningful on raid0 according to mdadm-3.0.3
-            bitmap = self.level != 0
-            if getattr(self.format, "mountpoint", None) == "/boot":
-                metadata="1.0"
-                bitmap=False
-            elif self.format.type == "swap":
-                bitmap=False
-
-            mdraid.mdcreate(self.path,
-                            self.level,
-                            disks,
-                            spares,
-                            metadataVer=metadata,
-                            bitmap=bitmap,
-                            progress=w)
+            self.prepareCreate()
+            self.createArray(progress=w)
         except Exception:
             raise
         else:
-            self.exists = True
-            # the array is automatically activated upon creation, but...
-            self.setup()
-            udev_settle()
-            self.updateSysfsPath()
-            info = udev_get_block_device(self.sysfsPath)
-            self.uuid = udev_device_get_md_uuid(info)
-            for member in self.devices:
-                member.mdUuid = self.uuid
+            self.finishCreate()
         finally:
             if w:
                 w.pop()
 
+    def prepareCreate(self):
+        """ Set up the members of the array before createArray. """
+        self.createParents()
+        self.setupParents()
+
+    def createArray(self, progress=None):
+        """ Create the array on its prepared members.
+
+            This only touches the members, so the arrays of a batch can be
+            created concurrently. finishCreate has to be called afterwards.
+        """
+        disks = [disk.path for disk in self.devices]
+        spares = len(self.devices) - self.memberDevices
+
+        # Figure out format specific options
+        metadata="1.1"
+        # bitmaps are not meaningful on raid0 according to mdadm-3.0.3
+        bitmap = self.level != 0
+        if getattr(self.format, "mountpoint", None) == "/boot":
+            metadata="1.0"
+            bitmap=False
+        elif self.format.type == "swap":
+            bitmap=False
+
+        assumeClean = self.assumeClean
+        if assumeClean is None:
+            assumeClean = self._zeroMembers()
+
+        mdraid.mdcreate(self.path,
+                        self.level,
+                        disks,
+                        spares,
+                        metadataVer=metadata,
+                        bitmap=bitmap,
+                        assumeClean=assumeClean,
+                        progress=progress)
+
+    def finishCreate(self):
+        """ Activate the new array and read back its UUID. """
+        self.exists = True
+        # the array is automatically activated upon creation, but...
+        self.setup()
+        udev_settle()
+        self.updateSysfsPath()
+        info = udev_get_block_device(self.sysfsPath)
+        self.uuid = udev_device_get_md_uuid(info)
+        for member in self.devices:
+            member.mdUuid = self.uuid
+
     @property
     def formatArgs(self):
         formatArgs = []
@@ -22,6 +22,11 @@
 
 import os
 import stat
+import sys
+import threading
+import time
+import Queue
+import weakref
 import block
 import re
 
@@ -31,11 +36,13 @@ from deviceaction import *
 from partitioning import shouldClear
 from pykickstart.constants import *
 import formats
+import devicelibs.broker
 import devicelibs.mdraid
 import devicelibs.dm
 import devicelibs.lvm
 import devicelibs.mpath
 from udev import *
+from flags import flags
 from .storage_log import log_method_call
 import iutil
 
@@ -45,6 +52,14 @@ _ = lambda x: gettext.ldgettext("anaconda", x)
 import logging
 log = logging.getLogger("storage")
 
+# seconds to wait for udev events once udev has settled before populate
+# decides that no more devices are going to show up
+POPULATE_QUIET_TIME = 0.5
+
+# how many formats (those with parallelCreate set, ie. filesystems and swap)
+# processActions creates at the same time; 1 runs all actions in sequence
+FORMAT_WORKERS = 4
+
 def getLUKSPassphrase(intf, device, globalPassphrase):
     """ Obtain a passphrase for a LUKS encrypted block device.
 
@@ -149,6 +164,10 @@ class DeviceTree(object):
         except for resize actions.
     """
 
+    # the attributes devices are indexed by for the getDeviceBy* lookups;
+    # "children" maps each parent device to the devices that depend on it
+    _indexKinds = ("name", "path", "sysfsPath", "uuid", "label", "children")
+
     def __init__(self, intf=None, ignored=[], exclusive=[], type=CLEARPART_TYPE_NONE,
                  clear=[], zeroMbr=None, reinitializeDisks=None, protected=[],
                  passphrase=None, luksDict=None, iscsi=None, dasd=None):
@@ -156,6 +175,25 @@ class DeviceTree(object):
         self._devices = []
         self._actions = []
 
+        # lookup indexes, maintained by _addDevice, _removeDevice and, for
+        # changes to devices already in the tree, _reindexDevice
+        self._indexes = dict((kind, {}) for kind in self._indexKinds)
+        self._indexedKeys = {}
+        self._deviceOrder = {}
+        self._deviceCounter = 0
+
+        # snapshot returned by the devices property, dropped whenever the
+        # device list or a device's path changes
+        self._devicesCache = None
+        self.devicesRebuildCount = 0
+
+        # memoized sets of the devices each device depends on
+        self._ancestors = {}
+
+        # VGs whose LVs are to be activated once the current batch of udev
+        # devices has been handled, see _activatePendingVGs
+        self._pendingVGs = []
+
         # indicates whether or not the tree has been fully populated
         self.populated = False
 
@@ -485,152 +523,14 @@ class DeviceTree(object):
                 log.debug(" removing action '%s' (%s)" % (rem, id(rem)))
                 self._actions.remove(rem)
 
-    def processActions(self, dryRun=None):
-        """ Execute all registered actions. """
-        # in most cases the actions will already be sorted because of the
-        # rules for registration, but let's not rely on that
-        def cmpActions(a1, a2):
-            ret = 0
-            if a1.isDestroy() and a2.isDestroy():
-                if a1.device.path == a2.device.path:
-                    # if it's the same device, destroy the format first
-                    if a1.isFormat() and a2.isFormat():
-                        ret = 0
-                    elif a1.isFormat() and not a2.isFormat():
-                        ret = -1
-                    elif not a1.isFormat() and a2.isFormat():
-                        ret = 1
-                elif a1.device.dependsOn(a2.device):
-                    ret = -1
-                elif a2.device.dependsOn(a1.device):
-                    ret = 1
-                # generally destroy partitions after lvs, vgs, &c
-                elif isinstance(a1.device, PartitionDevice) and \
-                     isinstance(a2.device, PartitionDevice):
-                    if a1.device.disk == a2.device.disk:
-                        ret = cmp(a2.device.partedPartition.number,
-                                  a1.device.partedPartition.number)
-                    else:
-                        ret = cmp(a2.device.name, a1.device.name)
-                elif isinstance(a1.device, PartitionDevice) and \
-                     a2.device.partitioned:
-                    ret = 1
-                elif isinstance(a2.device, PartitionDevice) and \
-                     a1.device.partitioned:
-                    ret = -1
-                else:
-                    ret = 0
-            elif a1.isDestroy():
-                ret = -1
-            elif a2.isDestroy():
-                ret = 1
-            elif a1.isResize() and a2.isResize():
-                if a1.device.path == a2.device.path:
-                    if a1.obj == a2.obj:
-                        ret = 0
-                    elif a1.isFormat() and not a2.isFormat():
-                        # same path, one device, one format
-                        if a1.isGrow():
-                            ret = 1
-                        else:
-                            ret = -1
-                    elif not a1.isFormat() and a2.isFormat():
-                        # same path, one device, one format
-                        if a1.isGrow():
-                            ret = -1
-                        else:
-                            ret = 1
-                    else:
-                        ret = cmp(a1.device.name, a2.device.name)
-                elif a1.device.dependsOn(a2.device):
-                    if a1.isGrow():
-                        ret = 1
-                    else:
-                        ret = -1
-                elif a2.device.dependsOn(a1.device):
-                    if a1.isGrow():
-                        ret = -1
-                    else:
-                        ret = 1
-                elif isinstance(a1.device, PartitionDevice) and \
-                     isinstance(a2.device, PartitionDevice):
-                    ret = cmp(a1.device.name, a2.device.name)
-                elif isinstance(a1.device, PartitionDevice) and \
-                     a2.device.partitioned:
-                    if a1.isGrow():
-                        ret = -1
-                    else:
-                        ret = 1
-                elif isinstance(a2.device, PartitionDevice) and \
-                     a1.device.partitioned:
-                    if a2.isGrow():
-                        ret = 1
-                    else:
-                        ret = -1
-                else:
-                    ret = 0
-            elif a1.isResize():
-                ret = -1
-            elif a2.isResize():
-                ret = 1
-            elif a1.isCreate() and a2.isCreate():
-                if a1.device.path == a2.device.path:
-                    if a1.obj == a2.obj:
-                        ret = 0
-                    if a1.isFormat():
-                        ret = 1
-                    elif a2.isFormat():
-                        ret = -1
-                    else:
-                        ret = 0
-                elif a1.device.dependsOn(a2.device):
-                    ret = 1
-                elif a2.device.dependsOn(a1.device):
-                    ret = -1
-                # generally create partitions before other device types
-                elif isinstance(a1.device, PartitionDevice) and \
-                     isinstance(a2.device, PartitionDevice):
-                    if a1.device.disk == a2.device.disk:
-                        ret = cmp(a1.device.partedPartition.number,
-                                  a2.device.partedPartition.number)
-                    else:
-                        ret = cmp(a1.device.name, a2.device.name)
-                elif isinstance(a1.device, PartitionDevice) and \
-                     a2.device.partitioned:
-                    ret = 1
-                elif isinstance(a2.device, PartitionDevice) and \
-                     a1.device.partitioned:
-                    ret = -1
-                elif isinstance(a1.device, PartitionDevice) and \
-                     not isinstance(a2.device, PartitionDevice):
-                    ret = -1
-                elif isinstance(a2.device, PartitionDevice) and \
-                     not isinstance(a1.device, PartitionDevice):
-                    ret = 1
-                else:
-                    ret = 0
-            elif a1.isCreate():
-                ret = -1
-            elif a2.isCreate():
-                ret = 1
-            elif a1.isMigrate() and a2.isMigrate():
-                if a1.device.path == a2.device.path:
-                    ret = 0
-                elif a1.device.dependsOn(a2.device):
-                    ret = 1
-                elif a2.device.dependsOn(a1.device):
-                    ret = -1
-                elif isinstance(a1.device, PartitionDevice) and \
-                     isinstance(a2.device, PartitionDevice):
-                    ret = cmp(a1.device.name, a2.device.name)
-                else:
-                    ret = cmp(a1.device.name, a2.device.name)
-            else:
-                ret = 0
-
-            log.debug("cmp: %d -- %s | %s" % (ret, a1, a2))
-            return ret
+    def processActions(self, dryRun=None, workers=FORMAT_WORKERS):
+        """ Execute all registered actions.
 
+            With more than one worker, the destruction of formats and the
+            creation of md arrays, filesystems and swap are put off until
+            another action needs them done. The actions put off are then
+            carried out by up to workers threads at a time.
+        """
         log.debug("resetting parted disks...")
         for device in self.devices:
             if device.partitioned:
@@ -671,28 +571,476 @@ class DeviceTree(object):
         for action in self._actions:
             log.debug("action: %s" % action)
 
+        # in most cases the actions will already be sorted because of the
+        # rules for registration, but let's not rely on that
         log.debug("sorting actions...")
-        self._actions.sort(cmp=cmpActions)
+        scheduler = ActionScheduler(self._actions, self)
+        self._actions = scheduler.actions
+        for (i, layer) in enumerate(scheduler.layers):
+            for action in layer:
+                log.debug("action: %s (layer %d)" % (action, i))
+
+        # the initial resync of new arrays is not to compete with the rest
+        # of the install for the disks, see mdraid.mdthrottle_resync
+        if not dryRun and [a for a in self._actions
+                           if isinstance(a, ActionCreateDevice) and
+                              a.device.type == "mdarray"]:
+            devicelibs.mdraid.mdthrottle_resync()
+
+        def needs(action, pending):
+            return pending and (action.type != ACTION_TYPE_CREATE or
+                                [a for a in pending
+                                 if action.device.dependsOn(a.device)])
+
+        def renumbers(action, pending):
+            # partitions can be renumbered when another partition on the
+            # same disk is destroyed, created or resized, so the wipes of
+            # the devices on that disk have to be done first
+            if not isinstance(action.device, PartitionDevice) or \
+               action.obj != ACTION_OBJECT_DEVICE or \
+               action.device.disk is None:
+                return []
+
+            disk = action.device.disk
+            return [a for a in pending
+                    if a.device is disk or a.device.dependsOn(disk)]
+
+        def blocks(action, pending):
+            # destroy actions run top down, so here it is the other way round
+            return pending and (renumbers(action, pending) or
+                                action.type != ACTION_TYPE_DESTROY or
+                                [a for a in pending
+                                 if a.device is action.device or
+                                    a.device.dependsOn(action.device)])
+
+        destroys = []
+        arrays = []
+        formats = []
         for action in self._actions:
-            log.debug("action: %s" % action)
+            if blocks(action, destroys):
+                self._destroyFormats(destroys, workers, dryRun=dryRun)
+                destroys = []
 
-        for action in self._actions:
+            if workers > 1 and isinstance(action, ActionDestroyFormat) and \
+               action.origFormat and action.origFormat.parallelDestroy:
+                destroys.append(action)
+                continue
+
+            if needs(action, arrays):
+                self._createArrays(arrays, workers, dryRun=dryRun)
+                arrays = []
+
+            if workers > 1 and isinstance(action, ActionCreateDevice) and \
+               action.device.type == "mdarray":
+                arrays.append(action)
+                continue
+
+            if workers > 1 and isinstance(action, ActionCreateFormat) and \
+               action.format.parallelCreate:
+                formats.append(action)
+                continue
+
+            if needs(action, formats):
+                self._createFormats(formats, workers, dryRun=dryRun)
+                formats = []
+
+            self._executeAction(action, dryRun=dryRun)
+
+        if destroys:
+            self._destroyFormats(destroys, workers, dryRun=dryRun)
+
+        if arrays:
+            self._createArrays(arrays, workers, dryRun=dryRun)
+
+        if formats:
+            self._createFormats(formats, workers, dryRun=dryRun)
+
+        log.debug("device list rebuilt %d times" % self.devicesRebuildCount)
+        devicelibs.broker.stats.log()
+
+    def _executeAction(self, action, dryRun=None):
+        log.info("executing action: %s" % action)
+        if dryRun:
+            return
+
+        try:
+            action.execute(intf=self.intf)
+        except DiskLabelCommitError:
+            # it's likely that a previous format destroy action
+            # triggered setup of an lvm or md device.
+            self.teardownAll()
+            action.execute(intf=self.intf)
+
+        udev_settle()
+        self._updatePartitionNames()
+
+    def _updatePartitionNames(self):
+        for device in self._devices:
+            # make sure we catch any renumbering parted does
+            if device.exists and isinstance(device, PartitionDevice):
+                device.updateName()
+                device.format.device = device.path
+
+    def _createFormats(self, actions, workers, dryRun=None):
+        """ Carry out format create actions using a pool of threads.
+
+            The devices are prepared one after the other, since that may
+            commit disklabels, and then up to workers of the formats are
+            created at a time. udev is only settled once for all of them.
+        """
+        if len(actions) == 1:
+            self._executeAction(actions[0], dryRun=dryRun)
+            return
+
+        for action in actions:
+            log.info("executing action: %s" % action)
+            if dryRun:
+                continue
+
+            try:
+                action.prepare()
+            except DiskLabelCommitError:
+                # see _executeAction
+                self.teardownAll()
+                action.prepare()
+
+        if dryRun:
+            return
+
+        self._runActions(actions, workers, lambda a: a.createFormat(),
+                         _("Formatting"),
+                         _("Creating file systems on %d devices")
+                         % len(actions))
+
+        # Get the UUIDs now that the formats are created
+        udev_settle()
+        for action in actions:
+            action.updateFormat()
+
+        self._updatePartitionNames()
+
+    def _destroyFormats(self, actions, workers, dryRun=None):
+        """ Carry out format destroy actions using a pool of threads.
+
+            The devices are set up one after the other and then up to
+            workers of them are wiped at a time.
+        """
+        if len(actions) == 1:
+            self._executeAction(actions[0], dryRun=dryRun)
+            return
+
+        for action in actions:
             log.info("executing action: %s" % action)
             if not dryRun:
+                action.prepare()
+
+        if dryRun:
+            return
+
+        self._runActions(actions, workers, lambda a: a.destroyFormat(),
+                         _("Wiping"),
+                         _("Removing old data from %d devices")
+                         % len(actions))
+
+        udev_settle()
+        for action in actions:
+            action.finish()
+
+        self._updatePartitionNames()
+
+    def _createArrays(self, actions, workers, dryRun=None):
+        """ Carry out md array create actions using a pool of threads.
+
+            The members are set up and the arrays activated one after the
+            other; only the arrays themselves are created concurrently.
+        """
+        if dryRun:
+            for action in actions:
+                log.info("executing action: %s" % action)
+            return
+
+        if len(actions) == 1:
+            self._executeAction(actions[0])
+        else:
+            # only mdadm runs in the threads, the devices and the tree are
+            # updated from here
+            for action in actions:
+                log.info("executing action: %s" % action)
+                action.device.prepareCreate()
+
+            self._runActions(actions, workers,
+                             lambda a: a.device.createArray(),
+                             _("Creating"),
+                             _("Creating %d RAID devices") % len(actions))
+            udev_settle()
+            for action in actions:
+                action.device.finishCreate()
+
+            self._updatePartitionNames()
+
+        for action in actions:
+            log.info("%s resync: %s" % (action.device.name,
+                                        action.device.resyncProgress))
+
+    def _runActions(self, actions, workers, run, title, text):
+        """ Call run on each of actions using up to workers threads.
+
+            Progress is shown in a window with the given title and text.
+            The first exception raised by run is raised again here once
+            all of the threads are done.
+        """
+        queue = Queue.Queue()
+        for action in actions:
+            queue.put(action)
+
+        # each worker reports every action it ran and then None once it is
+        # done; after a failure no more actions are started
+        results = Queue.Queue()
+        failed = threading.Event()
+        def worker():
+            while not failed.isSet():
                 try:
-                    action.execute(intf=self.intf)
-                except DiskLabelCommitError:
-                    # it's likely that a previous format destroy action
-                    # triggered setup of an lvm or md device.
-                    self.teardownAll()
-                    action.execute(intf=self.intf)
+                    action = queue.get_nowait()
+                except Queue.Empty:
+                    break
 
-                udev_settle()
-                for device in self._devices:
-                    # make sure we catch any renumbering parted does
-                    if device.exists and isinstance(device, PartitionDevice):
-                        device.updateName()
-                        device.format.device = device.path
+                start = time.time()
+                try:
+                    run(action)
+                except Exception:
+                    failed.set()
+                    results.put((action, sys.exc_info(), time.time() - start))
+                else:
+                    results.put((action, None, time.time() - start))
+
+            results.put(None)
+
+        threads = []
+        for i in range(min(workers, len(actions))):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            threads.append(thread)
+
+        w = None
+        if self.intf:
+            w = self.intf.progressWindow(title, text, len(actions))
+
+        error = None
+        done = 0
+        running = len(threads)
+        try:
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+
+                (action, exc_info, elapsed) = result
+                done += 1
+                if exc_info:
+                    log.error("%s failed after %.1fs: %s"
+                              % (action, elapsed, exc_info[1]))
+                    if not error:
+                        error = exc_info
+                else:
+                    log.info("%s done in %.1fs" % (action, elapsed))
+
+                if w:
+                    w.set(done)
+        finally:
+            for thread in threads:
+                thread.join()
+
+            if w:
+                w.pop()
+
+        if error:
+            raise error[0], error[1], error[2]
+
+    def _deviceKeys(self, device):
+        """ Return a dict of the keys device is indexed under, by kind. """
+        format = getattr(device, "format", None)
+        keys = {"name": [device.name],
+                "path": [device.path],
+                "sysfsPath": [getattr(device, "sysfsPath", None)],
+                "uuid": [getattr(device, "uuid", None),
+                         getattr(format, "uuid", None)],
+                "label": [getattr(format, "label", None)],
+                "children": device.parents}
+        for (kind, values) in keys.items():
+            unique = []
+            for value in values:
+                if value is None or value == "" or value in unique:
+                    continue
+                unique.append(value)
+            keys[kind] = unique
+
+        return keys
+
+    def _indexDevice(self, device, keys):
+        """ Add device to the lookup indexes under the given keys.
+
+            Each index entry lists its devices in tree order so that
+            lookups return the same device a scan of the tree would.
+        """
+        order = self._deviceOrder
+        for (kind, values) in keys.items():
+            index = self._indexes[kind]
+            for key in values:
+                devices = index.setdefault(key, [])
+                i = len(devices)
+                while i and order[devices[i - 1]] > order[device]:
+                    i -= 1
+                devices.insert(i, device)
+
+        self._indexedKeys[device] = keys
+        self._forgetExtendedPartition(device, keys)
+
+    def _unindexDevice(self, device):
+        """ Remove device from the lookup indexes and return its keys. """
+        keys = self._indexedKeys.pop(device)
+        for (kind, values) in keys.items():
+            index = self._indexes[kind]
+            for key in values:
+                devices = index[key]
+                devices.remove(device)
+                if not devices:
+                    del index[key]
+
+        self._forgetExtendedPartition(device, keys)
+        return keys
+
+    def _reindexDevice(self, device):
+        """ Update the lookup indexes for a device that has changed.
+
+            Devices in the tree call this when one of the attributes they
+            are looked up by (name, parents, format, uuid, sysfsPath, or
+            the format's uuid or label) is modified.
+        """
+        if device not in self._indexedKeys:
+            return
+
+        old = self._unindexDevice(device)
+        new = self._deviceKeys(device)
+        self._indexDevice(device, new)
+        if new["path"] != old["path"]:
+            self._devicesCache = None
+
+        if new["children"] != old["children"] or \
+           (isinstance(device, PartitionDevice) and
+            new["name"] != old["name"]):
+            # a partition is renamed along with its parted partition,
+            # which may make it a logical partition or no longer one
+            self._forgetAncestors(device)
+
+        if new["name"] != old["name"] or new["path"] != old["path"]:
+            # some devices, eg: lvm lvs, derive their names from a parent's
+            for child in self._indexes["children"].get(device, [])[:]:
+                self._reindexDevice(child)
+
+    def _getDescendants(self, device):
+        """ Return the set of devices in the tree that depend on device. """
+        descendants = set()
+        pending = [device]
+        while pending:
+            for child in self._indexes["children"].get(pending.pop(), []):
+                if child not in descendants:
+                    descendants.add(child)
+                    pending.append(child)
+
+        return descendants
+
+    def _forgetAncestors(self, device):
+        """ Drop the memoized ancestors of device and its dependents. """
+        self._ancestors.pop(device, None)
+        for descendant in self._getDescendants(device):
+            self._ancestors.pop(descendant, None)
+
+    def getAncestors(self, device):
+        """ Return a frozenset of the devices device depends on.
+
+            Both direct and indirect dependencies are included, and logical
+            partitions also depend on their disk's extended partition (see
+            PartitionDevice.dependsOn). The sets of devices in the tree are
+            memoized until a device's parents change or an extended
+            partition is added to or removed from its disk; devices outside
+            the tree, eg: ones that are being destroyed, are walked each
+            time.
+        """
+        if device in self._indexedKeys:
+            ancestors = self._ancestors.get(device)
+            if ancestors is not None:
+                return ancestors
+
+        ancestors = set(self._getExtendedPartitions(device))
+        memoize = device in self._indexedKeys
+        for parent in device.parents:
+            ancestors.add(parent)
+            if parent in self._indexedKeys:
+                ancestors.update(self.getAncestors(parent))
+                continue
+
+            # changes to devices outside the tree are not tracked
+            memoize = False
+            pending = [parent]
+            while pending:
+                ancestor = pending.pop()
+                ancestors.update(self._getExtendedPartitions(ancestor))
+                for grandparent in ancestor.parents:
+                    if grandparent not in ancestors:
+                        ancestors.add(grandparent)
+                        pending.append(grandparent)
+
+        ancestors = frozenset(ancestors)
+        if memoize:
+            self._ancestors[device] = ancestors
+
+        return ancestors
+
+    def _getExtendedPartitions(self, device):
+        """ Return the extended partitions in the tree a logical partition
+            depends on.
+        """
+        if not isinstance(device, PartitionDevice) or not device.disk or \
+           not device.isLogical:
+            return []
+
+        return [d for d in self._indexes["children"].get(device.disk, [])
+                if isinstance(d, PartitionDevice) and d.isExtended]
+
+    def _forgetExtendedPartition(self, device, keys):
+        """ Drop the memoized ancestors that include an extended partition
+            when it is added to or removed from the tree's indexes.
+        """
+        if isinstance(device, PartitionDevice) and device.isExtended:
+            for disk in keys["children"]:
+                self._forgetAncestors(disk)
+
+    def _indexLookup(self, kind, key, last=False):
+        """ Return the first (or last) device in the tree indexed by key. """
+        devices = self._indexes[kind].get(key)
+        if not devices:
+            return None
+
+        if last:
+            return devices[-1]
+        return devices[0]
+
+    def _lvmLookup(self, kind, key):
+        """ Look up a device by name or path the way lvm may spell it.
+
+            LVM doubles the dashes in vg and lv names within device-mapper
+            names, so lvm devices also match the key with "--" collapsed.
+        """
+        candidates = self._indexes[kind].get(key, [])[:]
+        for device in self._indexes[kind].get(key.replace("--","-"), []):
+            if device.type == "lvmlv" or device.type == "lvmvg":
+                candidates.append(device)
+
+        if not candidates:
+            return None
+
+        return min(candidates, key=self._deviceOrder.get)
 
     def _addDevice(self, newdev):
         """ Add a device to the tree.
@@ -700,16 +1048,21 @@ class DeviceTree(object):
             Raise ValueError if the device's identifier is already
             in the list.
         """
-        if newdev.path in [d.path for d in self._devices] and \
+        if newdev.path in self._indexes["path"] and \
            not isinstance(newdev, NoDevice):
             raise ValueError("device is already in tree")
 
         # make sure this device's parent devices are in the tree already
         for parent in newdev.parents:
-            if parent not in self._devices:
+            if parent not in self._indexedKeys:
                 raise DeviceTreeError("parent device not in tree")
 
         self._devices.append(newdev)
+        self._devicesCache = None
+        self._deviceCounter += 1
+        self._deviceOrder[newdev] = self._deviceCounter
+        self._indexDevice(newdev, self._deviceKeys(newdev))
+        newdev._tree = weakref.ref(self)
         log.debug("added %s %s (id %d) to device tree" % (newdev.type,
                                                           newdev.name,
                                                           newdev.id))
@@ -719,7 +1072,7 @@ class DeviceTree(object):
 
             Only leaves may be removed.
         """
-        if dev not in self._devices:
+        if dev not in self._indexedKeys:
             raise ValueError("Device '%s' not in tree" % dev.name)
 
         if not dev.isleaf and not force:
@@ -747,6 +1100,12 @@ class DeviceTree(object):
                     device.updateName()
 
         self._devices.remove(dev)
+        self._devicesCache = None
+        self._forgetAncestors(dev)
+        self._unindexDevice(dev)
+        del self._deviceOrder[dev]
+        if dev._tree and dev._tree() is self:
+            dev._tree = None
         log.debug("removed %s %s (id %d) from device tree" % (dev.type,
                                                               dev.name,
                                                               dev.id))
@@ -764,17 +1123,16 @@ class DeviceTree(object):
         """
         if (action.isDestroy() or action.isResize() or \
             (action.isCreate() and action.isFormat())) and \
-           action.device not in self._devices:
+           action.device not in self._indexedKeys:
             raise DeviceTreeError("device is not in the tree")
         elif (action.isCreate() and action.isDevice()):
             # this allows multiple create actions w/o destroy in between;
             # we will clean it up before processing actions
             #raise DeviceTreeError("device is already in the tree")
-            if action.device in self._devices:
+            if action.device in self._indexedKeys:
                 self._removeDevice(action.device)
-            for d in self._devices:
-                if d.path == action.device.path:
-                    self._removeDevice(d)
+            for d in self._indexes["path"].get(action.device.path, [])[:]:
+                self._removeDevice(d)
 
         if action.isCreate() and action.isDevice():
             self._addDevice(action.device)
@@ -855,28 +1213,19 @@ class DeviceTree(object):
 
             The list includes both direct and indirect dependents.
         """
-        dependents = []
+        dependents = self._getDescendants(dep)
 
         # special handling for extended partitions since the logical
         # partitions and their deps effectively depend on the extended
-        logicals = []
         if isinstance(dep, PartitionDevice) and dep.partType and \
            dep.isExtended:
             # collect all of the logicals on the same disk
             for part in self.getDevicesByInstance(PartitionDevice):
                 if part.partType and part.isLogical and part.disk == dep.disk:
-                    logicals.append(part)
-
-        for device in self.devices:
-            if device.dependsOn(dep):
-                dependents.append(device)
-            else:
-                for logical in logicals:
-                    if device.dependsOn(logical):
-                        dependents.append(device)
-                        break
+                    dependents.add(part)
+                    dependents.update(self._getDescendants(part))
 
-        return dependents
+        return sorted(dependents, key=self._deviceOrder.get)
 
     def isIgnored(self, info):
         """ Return True if info is a device we should ignore.
@@ -1435,6 +1784,13 @@ class DeviceTree(object):
 
     def handleUdevLVMPVFormat(self, info, device):
         log_method_call(self, name=device.name, type=device.format.type)
+        # the system-wide lvm report, read once per populate, is more
+        # current than what the udev rules recorded for this pv
+        pv_info = devicelibs.lvm.pvreport(device.path, device.format.uuid)
+        if pv_info:
+            info = info.copy()
+            info.update(pv_info)
+
         # lookup/create the VG and LVs
         try:
             vg_name = udev_device_get_vg_name(info)
@@ -1445,11 +1801,7 @@ class DeviceTree(object):
         vg_device = self.getDeviceByName(vg_name)
         if vg_device:
             vg_device._addDevice(device)
-            for lv in vg_device.lvs:
-                try:
-                    lv.setup()
-                except DeviceError as (msg, name):
-                    log.info("setup of %s failed: %s" % (lv.name, msg))
+            self._queueVGActivation(vg_device)
         else:
             try:
                 vg_uuid = udev_device_get_vg_uuid(info)
@@ -1546,11 +1898,36 @@ class DeviceTree(object):
                                                        exists=True)
                     self._addDevice(lv_device)
 
+                self._queueVGActivation(vg_device)
+
+    def _queueVGActivation(self, vg):
+        if vg not in self._pendingVGs:
+            self._pendingVGs.append(vg)
+
+    def _activatePendingVGs(self):
+        """ Activate the LVs of the VGs queued by handleUdevLVMPVFormat.
+
+            All of a VG's LVs are activated by a single lvm command instead
+            of one per LV each time another of the VG's PVs shows up.
+        """
+        pending = self._pendingVGs
+        self._pendingVGs = []
+        for vg in pending:
+            if vg not in self._indexedKeys:
+                continue
+
+            try:
+                vg.setupLVs()
+            except DeviceError as (msg, name):
+                log.info("setup of %s's lvs failed: %s" % (vg.name, msg))
+            except LVMError as e:
+                # one bad lv fails the whole batch, so retry them one by one
+                log.info("setup of %s's lvs failed: %s" % (vg.name, e))
+                for lv in vg.lvs:
                     try:
-                        lv_device.setup()
-                    except DeviceError as (msg, name):
-                        log.info("setup of %s failed: %s"
-                                            % (lv_device.name, msg))
+                        lv.setup()
+                    except StorageError as e:
+                        log.info("setup of %s failed: %s" % (lv.name, e))
 
     def handleUdevMDMemberFormat(self, info, device):
         log_method_call(self, name=device.name, type=device.format.type)
@@ -1856,7 +2233,7 @@ class DeviceTree(object):
 
             elif device.type == "lvmlv":
                 # we might have already fixed this.
-                if device not in self._devices or \
+                if device not in self._indexedKeys or \
                         device.name in self._ignoredDisks:
                     return
                 if device.complete:
@@ -1922,6 +2299,9 @@ class DeviceTree(object):
         # exception originated while finding storage devices
         self.populated = False
 
+        # lvm metadata is read at most once per populate
+        devicelibs.lvm.flush_report()
+
         # resolve the protected device specs to device names
         for spec in self.protectedDevSpecs:
             name = udev_resolve_devspec(spec)
@@ -1949,24 +2329,38 @@ class DeviceTree(object):
         open("/etc/multipath.conf", "w+").write(cfg)
         del cfg
 
-        (singles, mpaths, partitions) = devicelibs.mpath.identifyMultipaths(devices)
+        # mpathverify checks the multipath sets against "multipath -d"
+        verify = flags.cmdline.has_key("mpathverify")
+        blacklist = self.__multipathConfigWriter.blacklist_devices
+        (singles, mpaths, partitions) = \
+            devicelibs.mpath.identifyMultipaths(devices, blacklist=blacklist,
+                                                verify=verify)
         devices = singles + reduce(list.__add__, mpaths, []) + partitions
         log.info("devices to scan: %s" % [d['name'] for d in devices])
         for dev in devices:
             self.addUdevDevice(dev)
+        self._activatePendingVGs()
 
         # Having found all the disks, we can now find all the multipaths built
         # upon them.
         whitelist = []
         mpaths = self.__multipaths.values()
         mpaths.sort(key=lambda d: d.name)
+
+        # the names were picked by identifyMultipaths, so multipath has to
+        # have them as aliases before it sets up any of the maps
+        for mp in mpaths:
+            self.__multipathConfigWriter.addMultipathDevice(mp)
+        cfg = self.__multipathConfigWriter.write()
+        open("/etc/multipath.conf", "w+").write(cfg)
+        del cfg
+
         for mp in mpaths:
             log.info("adding mpath device %s" % mp.name)
             mp.setup()
             whitelist.append(mp.name)
             for p in mp.parents:
                 whitelist.append(p.name)
-            self.__multipathConfigWriter.addMultipathDevice(mp)
             self._addDevice(mp)
         for d in self.devices:
             if not d.name in whitelist:
@@ -1975,11 +2369,11 @@ class DeviceTree(object):
         open("/etc/multipath.conf", "w+").write(cfg)
         del cfg
 
-        # Now, loop and scan for devices that have appeared since the two above
-        # blocks or since previous iterations.
+        # Now, handle the devices that have appeared since the two above
+        # blocks or since previous iterations, as udev tells us about them.
         while True:
             devices = []
-            new_devices = udev_get_block_devices()
+            new_devices = udev_wait_for_block_devices(timeout=POPULATE_QUIET_TIME)
 
             for new_device in new_devices:
                 if not old_devices.has_key(new_device['name']):
@@ -1993,8 +2387,11 @@ class DeviceTree(object):
             log.info("devices to scan: %s" % [d['name'] for d in devices])
             for dev in devices:
                 self.addUdevDevice(dev)
+            self._activatePendingVGs()
 
         self.populated = True
+        log.debug("device list rebuilt %d times" % self.devicesRebuildCount)
+        devicelibs.broker.stats.log()
 
         # After having the complete tree we make sure that the system
         # inconsistencies are ignored or resolved.
@@ -2008,12 +2405,30 @@ class DeviceTree(object):
 
     def teardownAll(self):
         """ Run teardown methods on all devices. """
+        # deactivate each VG's leaf LVs with a single lvm command
+        lvs = {}
         for device in self.leaves:
+            if isinstance(device, LVMLogicalVolumeDevice):
+                lvs.setdefault(device.vg, []).append(device)
+                continue
+
             try:
                 device.teardown(recursive=True)
             except StorageError as e:
                 log.info("teardown of %s failed: %s" % (device.name, e))
 
+        for (vg, vg_lvs) in lvs.items():
+            try:
+                vg.teardownLVs(vg_lvs, recursive=True)
+            except StorageError as e:
+                log.info("teardown of %s's lvs failed: %s" % (vg.name, e))
+                for device in vg_lvs:
+                    try:
+                        device.teardown(recursive=True)
+                    except StorageError as e:
+                        log.info("teardown of %s failed: %s"
+                                 % (device.name, e))
+
     def setupAll(self):
         """ Run setup methods on all devices. """
         for device in self.leaves:
@@ -2026,28 +2441,13 @@ class DeviceTree(object):
         if not path:
             return None
 
-        found = None
-        for device in self._devices:
-            if device.sysfsPath == path:
-                found = device
-                break
-
-        return found
+        return self._indexLookup("sysfsPath", path)
 
     def getDeviceByUuid(self, uuid):
         if not uuid:
             return None
 
-        found = None
-        for device in self._devices:
-            if device.uuid == uuid:
-                found = device
-                break
-            elif device.format.uuid == uuid:
-                found = device
-                break
-
-        return found
+        return self._indexLookup("uuid", uuid)
 
     def getDevicesBySerial(self, serial):
         devices = []
@@ -2063,33 +2463,14 @@ class DeviceTree(object):
         if not label:
             return None
 
-        found = None
-        for device in self._devices:
-            _label = getattr(device.format, "label", None)
-            if not _label:
-                continue
-
-            if _label == label:
-                found = device
-                break
-
-        return found
+        return self._indexLookup("label", label)
 
     def getDeviceByName(self, name):
         log.debug("looking for device '%s'..." % name)
         if not name:
             return None
 
-        found = None
-        for device in self._devices:
-            if device.name == name:
-                found = device
-                break
-            elif (device.type == "lvmlv" or device.type == "lvmvg") and \
-                    device.name == name.replace("--","-"):
-                found = device
-                break
-
+        found = self._lvmLookup("name", name)
         log.debug("found %s" % found)
         return found
 
@@ -2098,16 +2479,7 @@ class DeviceTree(object):
         if not path:
             return None
 
-        found = None
-        for device in self._devices:
-            if device.path == path:
-                found = device
-                break
-            elif (device.type == "lvmlv" or device.type == "lvmvg") and \
-                    device.path == path.replace("--","-"):
-                found = device
-                break
-
+        found = self._lvmLookup("path", path)
         log.debug("found %s" % found)
         return found
 
@@ -2120,16 +2492,24 @@ class DeviceTree(object):
 
     @property
     def devices(self):
-        """ List of device instances """
-        devices = []
-        for device in self._devices:
-            if device.path in [d.path for d in devices] and \
-               not isinstance(device, NoDevice):
-                raise DeviceTreeError("duplicate paths in device tree")
+        """ List of device instances
 
-            devices.append(device)
+            The list is built once and then reused until a device is
+            added, removed or has its path changed.
+        """
+        if self._devicesCache is None:
+            self.devicesRebuildCount += 1
+            paths = set()
+            for device in self._devices:
+                if device.path in paths and \
+                   not isinstance(device, NoDevice):
+                    raise DeviceTreeError("duplicate paths in device tree")
 
-        return devices
+                paths.add(device.path)
+
+            self._devicesCache = self._devices[:]
+
+        return self._devicesCache[:]
 
     @property
     def filesystems(self):
@@ -2145,25 +2525,8 @@ class DeviceTree(object):
     @property
     def uuids(self):
         """ Dict with uuid keys and Device values. """
-        uuids = {}
-        for dev in self._devices:
-            try:
-                uuid = dev.uuid
-            except AttributeError:
-                uuid = None
-
-            if uuid:
-                uuids[uuid] = dev
-
-            try:
-                uuid = dev.format.uuid
-            except AttributeError:
-                uuid = None
-
-            if uuid:
-                uuids[uuid] = dev
-
-        return uuids
+        return dict((uuid, devices[-1])
+                    for (uuid, devices) in self._indexes["uuid"].items())
 
     @property
     def labels(self):
@@ -2171,12 +2534,8 @@ class DeviceTree(object):
 
             FIXME: duplicate labels are a possibility
         """
-        labels = {}
-        for dev in self._devices:
-            if dev.format and getattr(dev.format, "label", None):
-                labels[dev.format.label] = dev
-
-        return labels
+        return dict((label, devices[-1])
+                    for (label, devices) in self._indexes["label"].items())
 
     @property
     def leaves(self):
@@ -2186,7 +2545,11 @@ class DeviceTree(object):
 
     def getChildren(self, device):
         """ Return a list of a device's children. """
-        return [c for c in self._devices if device in c.parents]
+        try:
+            return self._indexes["children"].get(device, [])[:]
+        except TypeError:
+            # unhashable, so certainly not a device in the tree
+            return []
 
     def resolveDevice(self, devspec, blkidTab=None, cryptTab=None):
         # find device in the tree
@@ -2194,13 +2557,13 @@ class DeviceTree(object):
         if devspec.startswith("UUID="):
             # device-by-uuid
             uuid = devspec.partition("=")[2]
-            device = self.uuids.get(uuid)
+            device = self._indexLookup("uuid", uuid, last=True)
             if device is None:
                 log.error("failed to resolve device %s" % devspec)
         elif devspec.startswith("LABEL="):
             # device-by-label
             label = devspec.partition("=")[2]
-            device = self.labels.get(label)
+            device = self._indexLookup("label", label, last=True)
             if device is None:
                 log.error("failed to resolve device %s" % devspec)
         elif devspec.startswith("/dev/"):
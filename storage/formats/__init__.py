@@ -26,6 +26,7 @@ from iutil import notify_kernel, get_sysfs_path_by_name
 from ..storage_log import log_method_call
 from ..errors import *
 from ..devicelibs.dm import dm_node_from_name
+from ..devicelibs import wipe
 
 import gettext
 _ = lambda x: gettext.ldgettext("anaconda", x)
@@ -153,6 +154,12 @@ class DeviceFormat(object):
     _dump = False
     _check = False
     _hidden = False                     # hide devices with this formatting?
+    _parallelCreate = False             # can be created alongside others
+    _parallelDestroy = True             # can be destroyed alongside others
+    # (offset, length) byte ranges holding the format's signatures, wiped
+    # by destroy; negative offsets count from the end of the device
+    _signatureRanges = [(0, 1024 * 1024), (-1024 * 1024, 1024 * 1024)]
+    _owner = None                       # weakref to the containing device
 
     def __init__(self, *args, **kwargs):
         """ Create a DeviceFormat instance.
@@ -174,6 +181,14 @@ class DeviceFormat(object):
         #if self.__class__ is DeviceFormat:
         #    self.exists = True
 
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+        if attr in ("uuid", "label"):
+            # the device tree looks devices up by their formats' uuid/label
+            device = self._owner and self._owner()
+            if device is not None:
+                device._reindex()
+
     def __str__(self):
         s = ("%(classname)s instance (%(id)s) --\n"
              "  type = %(type)s  name = %(name)s  status = %(status)s\n"
@@ -267,31 +282,15 @@ class DeviceFormat(object):
     def destroy(self, *args, **kwargs):
         log_method_call(self, device=self.device,
                         type=self.type, status=self.status)
-        # zero out the 1MB at the beginning and end of the device in the
-        # hope that it will wipe any metadata from filesystems that
+        # zero out the areas where this format keeps its signatures, which
+        # by default are the 1MB at the beginning and end of the device,
+        # in the hope that it will wipe any metadata from filesystems that
         # previously occupied this device
-        log.debug("zeroing out beginning and end of %s..." % self.device)
-        fd = None
-
+        log.debug("wiping signatures from %s..." % self.device)
         try:
-            fd = os.open(self.device, os.O_RDWR)
-            buf = '\0' * 1024 * 1024
-            os.write(fd, buf)
-            os.lseek(fd, -1024 * 1024, 2)
-            os.write(fd, buf)
-            os.close(fd)
-        except OSError as e:
-            if getattr(e, "errno", None) == 28: # No space left in device
-                pass
-            else:
-                log.error("error zeroing out %s: %s" % (self.device, e))
-
-            if fd:
-                os.close(fd)
+            wipe.wipe(self.device, self.signatureRanges)
         except Exception as e:
             log.error("error zeroing out %s: %s" % (self.device, e))
-            if fd:
-                os.close(fd)
 
         self.exists = False
 
@@ -330,6 +329,21 @@ class DeviceFormat(object):
         """ Can we create formats of this type? """
         return self._formattable
 
+    @property
+    def parallelCreate(self):
+        """ Can this format be created while others are being created? """
+        return self._parallelCreate
+
+    @property
+    def parallelDestroy(self):
+        """ Can this format be destroyed while others are being destroyed? """
+        return self._parallelDestroy
+
+    @property
+    def signatureRanges(self):
+        """ The (offset, length) ranges destroy wipes. """
+        return self._signatureRanges
+
     @property
     def supported(self):
         """ Is this format a supported type? """
@@ -43,6 +43,7 @@ class DiskLabel(DeviceFormat):
     _name = "partition table"
     _formattable = True                # can be formatted
     _supported = False                 # is supported
+    _parallelDestroy = False           # destroy does more than wipe
 
     def __init__(self, *args, **kwargs):
         """ Create a DiskLabel instance.
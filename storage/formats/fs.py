@@ -126,6 +126,7 @@ class FS(DeviceFormat):
     _migrationTarget = None
     _existingSizeFields = []
     _fsProfileSpecifier = None           # mkfs option specifying fsprofile
+    _parallelCreate = True               # mkfs only touches its own device
 
     def __init__(self, *args, **kwargs):
         """ Create a FS instance.
@@ -1098,6 +1099,10 @@ class BTRFS(FS):
     _check = True
     _packages = ["btrfs-progs"]
     _maxSize = 16 * 1024 * 1024
+    # superblock mirrors live at 64MB and 256GB
+    _signatureRanges = FS._signatureRanges + \
+                       [(64 * 1024 * 1024, 64 * 1024),
+                        (256 * 1024 * 1024 * 1024, 64 * 1024)]
     # FIXME parted needs to be thaught about btrfs so that we can set the
     # partition table type correctly for btrfs partitions
     # partedSystem = fileSystemType["btrfs"]
@@ -51,6 +51,8 @@ class LUKS(DeviceFormat):
     _supported = False                  # is supported
     _linuxNative = True                 # for clearpart
     _packages = ["cryptsetup-luks"]     # required packages
+    # the header and key material of LUKS1 take up to 2MB
+    _signatureRanges = [(0, 2 * 1024 * 1024), (-1024 * 1024, 1024 * 1024)]
 
     def __init__(self, *args, **kwargs):
         """ Create a LUKS instance.
@@ -45,6 +45,7 @@ class LVMPhysicalVolume(DeviceFormat):
     _supported = True                   # is supported
     _linuxNative = True                 # for clearpart
     _packages = ["lvm2"]                # required packages
+    _parallelDestroy = False            # destroy does more than wipe
 
     def __init__(self, *args, **kwargs):
         """ Create an LVMPhysicalVolume instance.
@@ -44,6 +44,7 @@ class SwapSpace(DeviceFormat):
     _formattable = True                # can be formatted
     _supported = True                  # is supported
     _linuxNative = True                # for clearpart
+    _parallelCreate = True             # mkswap only touches its own device
 
     def __init__(self, *args, **kwargs):
         """ Create a SwapSpace instance.
@@ -22,7 +22,9 @@
 
 import sys
 import os
+import time
 from operator import add, sub, gt, lt
+from bisect import bisect_left
 
 import parted
 from pykickstart.constants import *
@@ -40,6 +42,11 @@ _ = lambda x: gettext.ldgettext("anaconda", x)
 import logging
 log = logging.getLogger("storage")
 
+# time budget, in seconds, of the search partition allocator
+SEARCH_TIMEOUT = 5
+# disk layouts the search partition allocator keeps the growth of
+SEARCH_GROWTH_CACHE = 4096
+
 def _createFreeSpacePartitions(anaconda):
     # get a list of disks that have at least one free space region of at
     # least 100MB
@@ -554,35 +561,8 @@ def getBestFreeSpaceRegion(disk, part_type, req_size,
     log.debug("getBestFreeSpaceRegion: disk=%s part_type=%d req_size=%dMB "
               "boot=%s best=%s grow=%s" %
               (disk.device.path, part_type, req_size, boot, best_free, grow))
-    extended = disk.getExtendedPartition()
-
-    for _range in disk.getFreeSpaceRegions():
-        if extended:
-            # find out if there is any overlap between this region and the
-            # extended partition
-            log.debug("looking for intersection between extended (%d-%d) and free (%d-%d)" %
-                    (extended.geometry.start, extended.geometry.end, _range.start, _range.end))
-
-            # parted.Geometry.overlapsWith can handle this
-            try:
-                free_geom = extended.geometry.intersect(_range)
-            except ArithmeticError, e:
-                # this freespace region does not lie within the extended
-                # partition's geometry
-                free_geom = None
-
-            if (free_geom and part_type == parted.PARTITION_NORMAL) or \
-               (not free_geom and part_type == parted.PARTITION_LOGICAL):
-                log.debug("free region not suitable for request")
-                continue
-
-            if part_type == parted.PARTITION_NORMAL:
-                # we're allocating a primary and the region is not within
-                # the extended, so we use the original region
-                free_geom = _range
-        else:
-            free_geom = _range
 
+    for free_geom in getFreeRegionsForType(disk, part_type):
         log.debug("current free range is %d-%d (%dMB)" % (free_geom.start,
                                                           free_geom.end,
                                                           free_geom.getSize()))
@@ -608,6 +588,138 @@ def getBestFreeSpaceRegion(disk, part_type, req_size,
 
     return best_free
 
+def getFreeRegionsForType(disk, part_type):
+    """ Return the free regions of a disk a partition type can use.
+
+        Primary partitions can only be allocated from free space outside of
+        the extended partition and logical partitions only from free space
+        inside of it.
+
+        Arguments:
+
+            disk -- the disk (a parted.Disk instance)
+            part_type -- the type of partition we want to allocate
+                         (one of parted's partition type constants)
+
+        Return value is a list of parted.Geometry instances, in the order
+        of their start sectors.
+    """
+    extended = disk.getExtendedPartition()
+
+    regions = []
+    for _range in disk.getFreeSpaceRegions():
+        if not extended:
+            regions.append(_range)
+            continue
+
+        # find out if there is any overlap between this region and the
+        # extended partition
+        try:
+            free_geom = extended.geometry.intersect(_range)
+        except ArithmeticError, e:
+            # this freespace region does not lie within the extended
+            # partition's geometry
+            free_geom = None
+
+        if (free_geom and part_type == parted.PARTITION_NORMAL) or \
+           (not free_geom and part_type == parted.PARTITION_LOGICAL):
+            continue
+
+        if part_type == parted.PARTITION_NORMAL:
+            # we're allocating a primary and the region is not within
+            # the extended, so we use the original region
+            free_geom = _range
+
+        if free_geom:
+            regions.append(free_geom)
+
+    return regions
+
+class FreeSpaceIndex(object):
+    """ The free regions of a set of disks, by disk and partition type.
+
+        The regions a disk has for each type of partition are read from
+        parted the first time they are asked for and kept sorted by start
+        sector and by size until the disk is invalidated, which has to
+        happen whenever a partition is added to or removed from it.
+    """
+    def __init__(self):
+        self._regions = {}  # (disk path, type) -> (by start, by size, sizes)
+        self._types = {}    # (disk path, no_primary) -> next partition type
+
+    def invalidate(self, disk):
+        """ Forget the free regions of a disk (a parted.Disk instance). """
+        path = disk.device.path
+        for cache in (self._regions, self._types):
+            for key in [k for k in cache if k[0] == path]:
+                del cache[key]
+
+    def getNextPartitionType(self, disk, no_primary=None):
+        """ Indexed version of getNextPartitionType. """
+        key = (disk.device.path, bool(no_primary))
+        if key not in self._types:
+            self._types[key] = getNextPartitionType(disk,
+                                                    no_primary=no_primary)
+
+        return self._types[key]
+
+    def getFreeRegions(self, disk, part_type):
+        """ Indexed version of getFreeRegionsForType. """
+        return self._getRegions(disk, part_type)[0]
+
+    def _getRegions(self, disk, part_type):
+        key = (disk.device.path, part_type)
+        if key not in self._regions:
+            by_start = getFreeRegionsForType(disk, part_type)
+            by_size = sorted(by_start, key=lambda g: (g.length, g.start))
+            sizes = [g.getSize() for g in by_size]
+            self._regions[key] = (by_start, by_size, sizes)
+
+        return self._regions[key]
+
+    def getBestFreeSpaceRegion(self, disk, part_type, req_size,
+                               boot=None, best_free=None, grow=None):
+        """ Indexed version of getBestFreeSpaceRegion.
+
+            Returns the same region getBestFreeSpaceRegion would, but looks
+            up the smallest or largest region by size instead of walking
+            all of them.
+        """
+        (by_start, by_size, sizes) = self._getRegions(disk, part_type)
+        if grow or part_type == parted.PARTITION_EXTENDED:
+            op = gt
+        else:
+            op = lt
+
+        if boot:
+            # the first region large enough, as seen from the disk's start
+            for free_geom in by_start:
+                if req_size <= free_geom.getSize() and \
+                   (not best_free or op(free_geom.length, best_free.length)):
+                    return free_geom
+
+            return best_free
+
+        if not by_size:
+            return best_free
+
+        if op is gt:
+            # the largest region, the one nearest the disk's start if
+            # there are several of that size
+            i = bisect_left(sizes, sizes[-1])
+        else:
+            # the smallest region large enough
+            i = bisect_left(sizes, req_size)
+
+        if i == len(sizes) or req_size > sizes[i]:
+            return best_free
+
+        free_geom = by_size[i]
+        if not best_free or op(free_geom.length, best_free.length):
+            best_free = free_geom
+
+        return best_free
+
 def sectorsToSize(sectors, sectorSize):
     """ Convert length in sectors to size in MB.
 
@@ -753,20 +865,149 @@ def doPartitioning(storage, exclusiveDisks=None):
             exclusiveDisks -- list of names of disks to use
 
     """
-    anaconda = storage.anaconda
     disks = storage.partitioned
     if exclusiveDisks:
         disks = [d for d in disks if d.name in exclusiveDisks]
 
+    _planPartitions(storage, disks, storage.partitions)
+
+def _isFixedPartition(storage, part):
+    """ Return True if a partition's placement is not up to the allocator.
+
+        Preexisting partitions and partitions that are part of a complex
+        device are left where they are.
+    """
+    return part.exists or \
+           (storage.deviceImmutable(part) and part.partedPartition)
+
+def _requestDiskNames(storage, part):
+    """ Return the names of the disks a partition request may end up on. """
+    names = set()
+    if part.disk:
+        names.add(part.disk.name)
+
+    if _isFixedPartition(storage, part):
+        return names
+
+    if part.req_disks:
+        names.update([d.name for d in part.req_disks])
+    else:
+        # no disks specified means any disk will do
+        names.update([d.name for d in storage.partitioned])
+
+    return names
+
+def getAffectedDisks(storage, devices, fixed=None):
+    """ Return the disks whose layout may change along with the given devices.
+
+        A changed partition request affects the disk it is on and every
+        disk it may be allocated to. Any other request that may be
+        allocated to one of those disks competes with it for space, so its
+        disks are affected too, and so on until no more requests overlap.
+        Requests outside of that set never share a disk with the changed
+        ones and keep their current allocation.
+
+        Arguments:
+
+            storage - Main anaconda Storage instance
+            devices - list of changed PartitionDevice instances or disks
+
+        Keyword arguments:
+
+            fixed - list of requests that keep their current allocation
+
+        Return value is a list of disks, in the order of storage.partitioned.
+    """
+    if fixed is None:
+        fixed = []
+
+    affected = set()
+    for device in devices:
+        if isinstance(device, PartitionDevice):
+            affected.update(_requestDiskNames(storage, device))
+        elif device.partitioned:
+            affected.add(device.name)
+
+    requests = [_requestDiskNames(storage, p) for p in storage.partitions
+                    if p not in fixed and not _isFixedPartition(storage, p)]
+    while True:
+        competing = [names for names in requests if names & affected]
+        if not competing:
+            break
+
+        requests = [names for names in requests if not names & affected]
+        for names in competing:
+            affected.update(names)
+
+    return [d for d in storage.partitioned if d.name in affected]
+
+def doIncrementalPartitioning(storage, devices):
+    """ Allocate and grow only the partitions a change can affect.
+
+        This is doPartitioning for the interactive editor, which changes
+        one request at a time. Only the disks returned by getAffectedDisks
+        are re-planned, along with the requests that may be allocated to
+        them; everything else keeps its current allocation.
+
+        Arguments:
+
+            storage - Main anaconda Storage instance
+            devices - list of changed PartitionDevice instances or disks
+
+        Return value is the list of disks that were re-planned.
+    """
+    # a change of boot device changes the allocation of both the old and
+    # the new boot partition; the old one is the partition the last plan
+    # marked bootable
+    try:
+        bootDev = storage.anaconda.platform.bootDevice()
+    except DeviceError:
+        bootDev = None
+
+    newBoot = [d for d in [bootDev] if isinstance(d, PartitionDevice)]
+    oldBoot = [p for p in storage.partitions if p.req_bootable]
+    if [p for p in oldBoot if p not in newBoot] or \
+       [p for p in newBoot if p not in oldBoot]:
+        log.debug("boot partition changed from %s to %s"
+                    % ([p.name for p in oldBoot], [p.name for p in newBoot]))
+        devices = devices + oldBoot + newBoot
+        fixed = []
+    else:
+        # the boot partition is allocated first, so the other requests do
+        # not move it unless it grows into the space they leave
+        fixed = [p for p in newBoot if p.partedPartition and
+                                       not p.req_grow and p not in devices]
+
+    disks = getAffectedDisks(storage, devices, fixed=fixed)
+    log.debug("re-planning disks %s" % [d.name for d in disks])
+    if not disks:
+        return disks
+    elif len(disks) == len(storage.partitioned):
+        _planPartitions(storage, disks, storage.partitions)
+        return disks
+
+    names = set([d.name for d in disks])
+    partitions = [p for p in storage.partitions
+                    if p not in fixed and
+                       not _isFixedPartition(storage, p) and
+                       _requestDiskNames(storage, p) <= names]
+    _planPartitions(storage, disks, partitions)
+    return disks
+
+def _planPartitions(storage, disks, partitions):
+    """ Allocate and grow the new partitions among the given partitions on
+        the given disks, see doPartitioning.
+    """
+    anaconda = storage.anaconda
+
     for disk in disks:
         disk.setup()
 
-    partitions = storage.partitions[:]
-    for part in storage.partitions:
+    partitions = partitions[:]
+    for part in partitions[:]:
         part.req_bootable = False
 
-        if part.exists or \
-           (storage.deviceImmutable(part) and part.partedPartition):
+        if _isFixedPartition(storage, part):
             # if the partition is preexisting or part of a complex device
             # then we shouldn't modify it
             partitions.remove(part)
@@ -787,7 +1028,13 @@ def doPartitioning(storage, exclusiveDisks=None):
 
     removeNewPartitions(disks, partitions)
     free = getFreeRegions(disks)
-    allocatePartitions(storage, disks, partitions, free)
+    allocate = allocators.get(storage.partitionAllocator)
+    if not allocate:
+        log.warning("unknown partition allocator %s, using greedy"
+                    % storage.partitionAllocator)
+        allocate = allocatePartitions
+
+    allocate(storage, disks, partitions, free)
     growPartitions(disks, partitions, free)
 
     # The number and thus the name of partitions may have changed now,
@@ -866,6 +1113,12 @@ def allocatePartitions(storage, disks, partitions, freespace):
 
     removeNewPartitions(disks, new_partitions)
 
+    free_index = FreeSpaceIndex()
+    growth_cache = DiskGrowthCache(freespace)
+    disk_parts = {}     # new partitions allocated so far on each disk
+    for disk_path in disklabels.keys():
+        disk_parts[disk_path] = []
+
     for _part in new_partitions:
         if _part.partedPartition and _part.isExtended:
             # ignore new extendeds as they are implicit requests
@@ -910,7 +1163,7 @@ def allocatePartitions(storage, disks, partitions, freespace):
 
             log.debug("checking freespace on %s" % _disk.name)
 
-            new_part_type = getNextPartitionType(disklabel.partedDisk)
+            new_part_type = free_index.getNextPartitionType(disklabel.partedDisk)
             if new_part_type is None:
                 # can't allocate any more partitions on this disk
                 log.debug("no free partition slots on %s" % _disk.name)
@@ -927,84 +1180,68 @@ def allocatePartitions(storage, disks, partitions, freespace):
                     log.debug("no primary slots available on %s" % _disk.name)
                     continue
 
-            best = getBestFreeSpaceRegion(disklabel.partedDisk,
-                                          new_part_type,
-                                          _part.req_size,
-                                          best_free=current_free,
-                                          boot=_part.req_bootable,
-                                          grow=_part.req_grow)
+            best = free_index.getBestFreeSpaceRegion(disklabel.partedDisk,
+                                                     new_part_type,
+                                                     _part.req_size,
+                                                     best_free=current_free,
+                                                     boot=_part.req_bootable,
+                                                     grow=_part.req_grow)
 
             if best == free and not _part.req_primary and \
                new_part_type == parted.PARTITION_NORMAL:
                 # see if we can do better with a logical partition
                 log.debug("not enough free space for primary -- trying logical")
-                new_part_type = getNextPartitionType(disklabel.partedDisk,
-                                                     no_primary=True)
+                new_part_type = free_index.getNextPartitionType(
+                                                    disklabel.partedDisk,
+                                                    no_primary=True)
                 if new_part_type:
-                    best = getBestFreeSpaceRegion(disklabel.partedDisk,
-                                                  new_part_type,
-                                                  _part.req_size,
-                                                  best_free=current_free,
-                                                  boot=_part.req_bootable,
-                                                  grow=_part.req_grow)
+                    best = free_index.getBestFreeSpaceRegion(
+                                                disklabel.partedDisk,
+                                                new_part_type,
+                                                _part.req_size,
+                                                best_free=current_free,
+                                                boot=_part.req_bootable,
+                                                grow=_part.req_grow)
 
             if best and free != best:
                 update = True
                 if _part.req_grow:
                     log.debug("evaluating growth potential for new layout")
-                    new_growth = 0
-                    for disk_path in disklabels.keys():
-                        log.debug("calculating growth for disk %s" % disk_path)
-                        # Now we check, for growable requests, which of the two
-                        # free regions will allow for more growth.
-
-                        # set up chunks representing the disks' layouts
-                        temp_parts = []
-                        for _p in new_partitions[:new_partitions.index(_part)]:
-                            if _p.disk.path == disk_path:
-                                temp_parts.append(_p)
-
-                        # add the current request to the temp disk to set up
-                        # its partedPartition attribute with a base geometry
-                        if disk_path == _disk.path:
-                            temp_part = addPartition(disklabel,
-                                                     best,
-                                                     new_part_type,
-                                                     _part.req_size)
-                            _part.partedPartition = temp_part
-                            _part.disk = _disk
-                            temp_parts.append(_part)
-
-                        chunks = getDiskChunks(all_disks[disk_path],
-                                               temp_parts, freespace)
-
-                        # grow all growable requests
-                        disk_growth = 0
-                        disk_sector_size = disklabels[disk_path].partedDevice.sectorSize
-                        for chunk in chunks:
-                            chunk.growRequests()
-                            # record the growth for this layout
-                            new_growth += chunk.growth
-                            disk_growth += chunk.growth
-                            for req in chunk.requests:
-                                log.debug("request %d (%s) growth: %d (%dMB) "
-                                          "size: %dMB" %
-                                          (req.partition.id,
-                                           req.partition.name,
-                                           req.growth,
-                                           sectorsToSize(req.growth,
-                                                         disk_sector_size),
-                                           sectorsToSize(req.growth + req.base,
-                                                         disk_sector_size)))
-                        log.debug("disk %s growth: %d (%dMB)" %
-                                        (disk_path, disk_growth,
-                                         sectorsToSize(disk_growth,
-                                                       disk_sector_size)))
+                    # Now we check, for growable requests, which of the free
+                    # regions will allow for more growth. Only the layout of
+                    # this disk changes, so the other disks allow for the
+                    # same growth as before.
+
+                    # add the current request to the temp disk to set up
+                    # its partedPartition attribute with a base geometry
+                    temp_part = addPartition(disklabel,
+                                             best,
+                                             new_part_type,
+                                             _part.req_size)
+                    _part.partedPartition = temp_part
+                    _part.disk = _disk
+
+                    new_disk_growth = getDiskGrowth(_disk,
+                                                    disk_parts[_disk.path] +
+                                                    [_part],
+                                                    freespace)
 
                     disklabel.partedDisk.removePartition(temp_part)
                     _part.partedPartition = None
                     _part.disk = None
 
+                    log.debug("disk %s growth: %d (%dMB)" %
+                                    (_disk.path, new_disk_growth,
+                                     sectorsToSize(new_disk_growth,
+                                                   sectorSize)))
+                    new_growth = new_disk_growth - \
+                                 growth_cache.getGrowth(_disk,
+                                                disk_parts[_disk.path])
+                    for disk_path in disklabels.keys():
+                        new_growth += growth_cache.getGrowth(
+                                                all_disks[disk_path],
+                                                disk_parts[disk_path])
+
                     log.debug("total growth: %d sectors" % new_growth)
 
                     # update the chosen free region unless the previous
@@ -1058,14 +1295,15 @@ def allocatePartitions(storage, disks, partitions, freespace):
 
             # now the extended partition exists, so set type to logical
             part_type = parted.PARTITION_LOGICAL
+            free_index.invalidate(disklabel.partedDisk)
 
             # recalculate freespace
             log.debug("recalculating free space")
-            free = getBestFreeSpaceRegion(disklabel.partedDisk,
-                                          part_type,
-                                          _part.req_size,
-                                          boot=_part.req_bootable,
-                                          grow=_part.req_grow)
+            free = free_index.getBestFreeSpaceRegion(disklabel.partedDisk,
+                                                     part_type,
+                                                     _part.req_size,
+                                                     boot=_part.req_bootable,
+                                                     grow=_part.req_grow)
             if not free:
                 raise PartitioningError("not enough free space after "
                                         "creating extended partition")
@@ -1083,6 +1321,10 @@ def allocatePartitions(storage, disks, partitions, freespace):
         # the disk, so we need to grab the latest version...
         _part.partedPartition = disklabel.partedDisk.getPartitionByPath(_part.path)
 
+        free_index.invalidate(disklabel.partedDisk)
+        disk_parts[_disk.path].append(_part)
+        growth_cache.invalidate(_disk)
+
 
 class Request(object):
     """ A partition request.
@@ -1292,6 +1534,48 @@ class Chunk(object):
                     break
 
 
+def getDiskGrowth(disk, partitions, free):
+    """ Return the growth in sectors the partitions on a disk allow for.
+
+        Arguments:
+
+            disk -- a StorageDevice with a DiskLabel format
+            partitions -- list of PartitionDevice instances
+            free -- list of parted.Geometry instances representing free space
+
+        Partitions and free regions not on the specified disk are ignored.
+
+    """
+    growth = 0
+    for chunk in getDiskChunks(disk, partitions, free):
+        chunk.growRequests()
+        growth += chunk.growth
+
+    return growth
+
+class DiskGrowthCache(object):
+    """ The growth the new partitions on each disk allow for.
+
+        Adding a partition to a disk only changes the growth of that disk,
+        so the growth of each disk is kept until the disk is invalidated,
+        which has to happen whenever a partition is allocated on it.
+    """
+    def __init__(self, free):
+        self.free = free
+        self._growth = {}   # disk path -> growth in sectors
+
+    def invalidate(self, disk):
+        """ Forget the growth of a disk (a StorageDevice). """
+        self._growth.pop(disk.path, None)
+
+    def getGrowth(self, disk, partitions):
+        """ Cached version of getDiskGrowth. """
+        if disk.path not in self._growth:
+            self._growth[disk.path] = getDiskGrowth(disk, partitions,
+                                                    self.free)
+
+        return self._growth[disk.path]
+
 def getDiskChunks(disk, partitions, free):
     """ Return a list of Chunk instances representing a disk.
 
@@ -1324,6 +1608,294 @@ def getDiskChunks(disk, partitions, free):
 
     return chunks
 
+class PartitionSearch(object):
+    """ A bounded search for the placement of new partitions.
+
+        Requests are placed in the order given by partitionCompare, as in
+        allocatePartitions. The greedy allocator commits each request to
+        the disk that looks best at that point. This search instead tries
+        every candidate disk and partition type for every request, depth
+        first and with the most promising choice first. Disks that are
+        interchangeable are only tried once.
+
+        Complete layouts are scored by the total growth they allow for and
+        then by the smallest growth of any growable request relative to its
+        base size, so space is not left unused and is shared evenly. The
+        search ends when all layouts have been tried or the time budget is
+        used up, and the best layout found is applied.
+    """
+    def __init__(self, storage, disks, partitions, freespace, timeout):
+        self.storage = storage
+        self.disks = disks
+        self.freespace = freespace
+        self.deadline = time.time() + timeout
+        self.index = FreeSpaceIndex()
+
+        self.requests = [p for p in partitions
+                            if not p.exists and
+                               not (p.partedPartition and p.isExtended)]
+        self.requests.sort(cmp=partitionCompare)
+
+        self.candidates = [self._getCandidateDisks(p) for p in self.requests]
+
+        # the requests each disk is a candidate for, which tells apart
+        # disks that otherwise look the same
+        self.users = {}
+        for disk in disks:
+            self.users[disk.path] = tuple([i for (i, c)
+                                              in enumerate(self.candidates)
+                                              if disk in c])
+
+        self.placed = {}        # disk path -> requests placed on it
+        for disk in disks:
+            self.placed[disk.path] = []
+
+        self.choices = []       # (request, disk, type) for each placement
+        self.best = None        # the choices of the best complete layout
+        self.bestScore = None
+        self.growth = {}        # growth results of disk layouts seen
+        self.layouts = 0
+        self.timedOut = False
+
+    def _getCandidateDisks(self, part):
+        if part.req_disks:
+            disks = [d for d in part.req_disks if d in self.disks]
+        else:
+            disks = self.disks[:]
+
+        disks.sort(key=lambda d: d.name, cmp=self.storage.compareDisks)
+        return disks
+
+    def _getPartitionTypes(self, part, disk):
+        """ Return the partition types a request can have on a disk. """
+        partedDisk = disk.format.partedDisk
+        part_type = self.index.getNextPartitionType(partedDisk)
+        if part_type is None:
+            return []
+
+        if part.req_primary and part_type != parted.PARTITION_NORMAL:
+            if (partedDisk.primaryPartitionCount <
+                partedDisk.maxPrimaryPartitionCount):
+                part_type = parted.PARTITION_NORMAL
+            else:
+                return []
+
+        types = [part_type]
+        if not part.req_primary and part_type == parted.PARTITION_NORMAL:
+            logical = self.index.getNextPartitionType(partedDisk,
+                                                      no_primary=True)
+            if logical and logical != part_type:
+                types.append(logical)
+
+        return types
+
+    def _getOptions(self, i):
+        """ Return the (disk, type) choices for request i, best first. """
+        part = self.requests[i]
+        options = []
+        seen = set()
+        for disk in self.candidates[i]:
+            partedDisk = disk.format.partedDisk
+            for part_type in self._getPartitionTypes(part, disk):
+                free = self.index.getBestFreeSpaceRegion(partedDisk,
+                                                 part_type,
+                                                 part.req_size,
+                                                 boot=part.req_bootable,
+                                                 grow=part.req_grow)
+                if not free:
+                    continue
+
+                # disks in the same state that the same requests can use
+                # lead to the same layouts
+                key = (part_type, partedDisk.device.sectorSize,
+                       self.users[disk.path],
+                       tuple([(g.start, g.end) for g in
+                              self.index.getFreeRegions(partedDisk,
+                                                        part_type)]),
+                       tuple([p.id for p in self.placed[disk.path]]))
+                if key in seen:
+                    continue
+
+                seen.add(key)
+                options.append((free.length, disk, part_type))
+
+            if options and part.req_bootable:
+                # the boot partition goes on the first disk it fits on
+                return [options[0][1:]]
+
+        if part.req_grow:
+            # the most room to grow first
+            options.sort(key=lambda o: -o[0])
+        else:
+            # the tightest fit first
+            options.sort(key=lambda o: o[0])
+
+        return [o[1:] for o in options]
+
+    def _place(self, part, disk, part_type):
+        """ Add a request to a disk, return False if it does not fit. """
+        disklabel = disk.format
+        partedDisk = disklabel.partedDisk
+        choice = (part, disk, part_type)
+        extended = None
+        try:
+            if part_type == parted.PARTITION_EXTENDED:
+                free = self.index.getBestFreeSpaceRegion(partedDisk,
+                                                 part_type,
+                                                 part.req_size,
+                                                 boot=part.req_bootable,
+                                                 grow=part.req_grow)
+                if not free:
+                    raise PartitioningError("no free space for extended "
+                                            "partition")
+
+                extended = addPartition(disklabel, free, part_type, None)
+                self.index.invalidate(partedDisk)
+                part_type = parted.PARTITION_LOGICAL
+
+            free = self.index.getBestFreeSpaceRegion(partedDisk,
+                                                     part_type,
+                                                     part.req_size,
+                                                     boot=part.req_bootable,
+                                                     grow=part.req_grow)
+            if not free:
+                raise PartitioningError("not enough free space after "
+                                        "creating extended partition")
+
+            partition = addPartition(disklabel, free, part_type,
+                                     part.req_size)
+        except PartitioningError, msg:
+            log.debug("cannot place request %d on %s: %s" % (part.id,
+                                                            disk.name,
+                                                            msg))
+            if extended:
+                partedDisk.removePartition(extended)
+                self.index.invalidate(partedDisk)
+            return False
+
+        self.index.invalidate(partedDisk)
+        part.partedPartition = partition
+        part.disk = disk
+        part.partedPartition = partedDisk.getPartitionByPath(part.path)
+        self.placed[disk.path].append(part)
+        self.choices.append((choice, extended))
+        return True
+
+    def _unplace(self):
+        """ Remove the request placed last. """
+        ((part, disk, part_type), extended) = self.choices.pop()
+        partedDisk = disk.format.partedDisk
+        partedDisk.removePartition(part.partedPartition)
+        if extended:
+            partedDisk.removePartition(extended)
+
+        self.index.invalidate(partedDisk)
+        self.placed[disk.path].remove(part)
+        part.partedPartition = None
+        part.disk = None
+
+    def _getDiskGrowth(self, disk):
+        """ Return the growth of each request placed on a disk. """
+        parts = self.placed[disk.path]
+        key = (disk.path,
+               tuple([(p.id, p.partedPartition.geometry.start,
+                       p.partedPartition.geometry.length) for p in parts]))
+        if key not in self.growth:
+            if len(self.growth) >= SEARCH_GROWTH_CACHE:
+                self.growth.clear()
+
+            growth = {}
+            for chunk in getDiskChunks(disk, parts, self.freespace):
+                chunk.growRequests()
+                for req in chunk.requests:
+                    if req.growable:
+                        growth[req.id] = (req.base, req.growth)
+
+            self.growth[key] = growth
+
+        return self.growth[key]
+
+    def _score(self):
+        total = 0
+        shares = []
+        for disk in self.disks:
+            for (base, growth) in self._getDiskGrowth(disk).values():
+                total += growth
+                shares.append(float(base + growth) / base)
+
+        return (total, min(shares or [0]))
+
+    def _search(self, i):
+        if time.time() > self.deadline:
+            self.timedOut = True
+            return
+
+        if i == len(self.requests):
+            self.layouts += 1
+            score = self._score()
+            if self.bestScore is None or score > self.bestScore:
+                self.bestScore = score
+                self.best = [c[0] for c in self.choices]
+            return
+
+        part = self.requests[i]
+        for (disk, part_type) in self._getOptions(i):
+            if not self._place(part, disk, part_type):
+                continue
+
+            self._search(i + 1)
+            self._unplace()
+            if self.timedOut:
+                return
+
+    def run(self):
+        """ Search for the best layout and apply it.
+
+            Returns False if the time ran out before any layout was found.
+        """
+        self._search(0)
+        log.debug("partition search scored %d layouts%s, best %s" %
+                    (self.layouts, ["", " (timed out)"][self.timedOut],
+                     self.bestScore))
+        if self.best is None:
+            if self.timedOut:
+                return False
+
+            raise PartitioningError("not enough free space on disks")
+
+        for (part, disk, part_type) in self.best:
+            if not self._place(part, disk, part_type):
+                raise PartitioningError("failed to apply partition layout")
+
+        return True
+
+def allocatePartitionsSearch(storage, disks, partitions, freespace,
+                             timeout=SEARCH_TIMEOUT):
+    """ Allocate partitions with a bounded search, see PartitionSearch.
+
+        This is an alternative to allocatePartitions with the same
+        arguments and results. If the search finds no layout at all within
+        the time budget the greedy allocator is used instead.
+
+        Keyword arguments:
+
+            timeout -- the time budget of the search, in seconds
+
+    """
+    log.debug("allocatePartitionsSearch: disks=%s ; partitions=%s" %
+                ([d.name for d in disks],
+                 ["%s(id %d)" % (p.name, p.id) for p in partitions]))
+    removeNewPartitions(disks, partitions)
+    search = PartitionSearch(storage, disks, partitions, freespace, timeout)
+    if not search.run():
+        log.info("partition search timed out, falling back to greedy "
+                 "allocation")
+        allocatePartitions(storage, disks, partitions, freespace)
+
+# the partition allocators Storage.partitionAllocator can name
+allocators = {"greedy": allocatePartitions,
+              "search": allocatePartitionsSearch}
+
 def growPartitions(disks, partitions, free):
     """ Grow all growable partition requests.
 
@@ -1492,40 +2064,69 @@ def hasFreeDiskSpace(storage, exclusiveDisks=None):
     # storage state after seeing a warning message.
     return True
 
+def allocateExtents(free, weights, caps):
+    """ Share free extents among requests in proportion to their weights.
 
-def lvCompare(lv1, lv2):
-    """ More specifically defined lvs come first.
-
-        < 1 => x < y
-          0 => x == y
-        > 1 => x > y
-    """
-    ret = 0
-
-    # larger requests go to the front of the list
-    ret -= cmp(lv1.size, lv2.size) * 100
+        Arguments:
 
-    # fixed size requests to the front
-    ret += cmp(lv1.req_grow, lv2.req_grow) * 50
+            free -- the number of extents to share
+            weights -- list of the requests' weights
+            caps -- list of the most extents each request can take, or
+                    None for requests without a maximum
 
-    # potentially larger growable requests go to the front
-    if lv1.req_grow and lv2.req_grow:
-        if not lv1.req_max_size and lv2.req_max_size:
-            ret -= 25
-        elif lv1.req_max_size and not lv2.req_max_size:
-            ret += 25
-        else:
-            ret -= cmp(lv1.req_max_size, lv2.req_max_size) * 25
+        Requests whose share would pass their cap get their cap and the
+        rest is shared among the others, so the extents are handed out in
+        one pass in the order in which the requests reach their caps. Each
+        remaining request gets its share rounded down and the extents that
+        leaves go one each to the requests with the largest remainders,
+        so unless every request is capped all of the extents are used.
 
-    if ret > 0:
-        ret = 1
-    elif ret < 0:
-        ret = -1
-
-    return ret
+        Return value is a list of extent counts, one for each request.
+    """
+    growth = [0] * len(weights)
+    active = [i for i in range(len(weights))
+                if weights[i] > 0 and caps[i] != 0]
+
+    # requests in the order in which they reach their caps as the free
+    # space is shared out
+    capped = [i for i in active if caps[i] is not None]
+    capped.sort(key=lambda i: float(caps[i]) / weights[i])
+
+    total = float(sum([weights[i] for i in active]))
+    done = set()
+    for i in capped:
+        if free * weights[i] / total < caps[i]:
+            break
+
+        growth[i] = caps[i]
+        free -= caps[i]
+        total -= weights[i]
+        done.add(i)
+
+    active = [i for i in active if i not in done]
+    if not active or free <= 0:
+        return growth
+
+    shares = [free * weights[i] / total for i in active]
+    whole = [long(share) for share in shares]
+    for (i, n) in zip(active, whole):
+        growth[i] = n
+
+    left = free - sum(whole)
+    remainders = range(len(active))
+    remainders.sort(key=lambda k: whole[k] - shares[k])
+    for k in remainders[:left]:
+        growth[active[k]] += 1
+
+    return growth
 
 def growLVM(storage):
-    """ Grow LVs according to the sizes of the PVs. """
+    """ Grow LVs according to the sizes of the PVs.
+
+        The free extents of each VG go first to LVs requesting a
+        percentage of them and the rest is shared among the other growable
+        LVs in proportion to their requested sizes, see allocateExtents.
+    """
     for vg in storage.vgs:
         total_free = vg.freeSpace
         if total_free < 0:
@@ -1536,112 +2137,58 @@ def growLVM(storage):
             log.debug("vg %s has no free space" % vg.name)
             continue
 
-        log.debug("vg %s: %dMB free ; lvs: %s" % (vg.name, vg.freeSpace,
-                                                  [l.lvname for l in vg.lvs]))
+        lvs = [lv for lv in vg.lvs if lv.req_grow]
+        if not lvs:
+            log.debug("no growable lvs in vg %s" % vg.name)
+            continue
 
-        # figure out how much to grow each LV
-        grow_amounts = {}
-        lv_total = vg.size - total_free
-        log.debug("used: %dMB ; vg.size: %dMB" % (lv_total, vg.size))
+        # everything below is in extents of vg space, which for mirrored
+        # lvs is a multiple of their size
+        free = long(total_free // vg.peSize)
+        log.debug("vg %s: %d extents free ; growable lvs: %s"
+                  % (vg.name, free, [l.lvname for l in lvs]))
 
-        # This first loop is to calculate percentage-based growth
-        # amounts. These are based on total free space.
-        lvs = vg.lvs
-        lvs.sort(cmp=lvCompare)
+        caps = []
         for lv in lvs:
-            if not lv.req_grow or not lv.req_percent:
-                continue
-
-            portion = (lv.req_percent * 0.01)
-            grow = portion * vg.vgFree
-            new_size = lv.req_size + grow
-            if lv.req_max_size and new_size > lv.req_max_size:
-                grow -= (new_size - lv.req_max_size)
-
-            if lv.format.maxSize and lv.format.maxSize < new_size:
-                grow -= (new_size - lv.format.maxSize)
-
-            # clamp growth amount to a multiple of vg extent size
-            grow_amounts[lv.name] = vg.align(grow)
-            total_free -= grow
-            lv_total += grow
-
-        # This second loop is to calculate non-percentage-based growth
-        # amounts. These are based on free space remaining after
-        # calculating percentage-based growth amounts.
+            max_size = min(filter(None, [lv.req_max_size, lv.format.maxSize])
+                           or [0])
+            if max_size:
+                cap = long((max_size - lv.size) // vg.peSize)
+                caps.append(max(0, cap) * lv.stripes)
+            else:
+                caps.append(None)
 
-        # keep a tab on space not allocated due to format or requested
-        # maximums -- we'll dole it out to subsequent requests
-        leftover = 0
-        for lv in lvs:
-            log.debug("checking lv %s: req_grow: %s ; req_percent: %s"
-                      % (lv.name, lv.req_grow, lv.req_percent))
-            if not lv.req_grow or lv.req_percent:
+        # percentage-based growth amounts are based on total free space
+        growth = [0] * len(lvs)
+        for (i, lv) in enumerate(lvs):
+            if not lv.req_percent:
                 continue
 
-            portion = float(lv.req_size) / float(lv_total)
-            grow = portion * total_free
-            log.debug("grow is %dMB" % grow)
-
-            todo = lvs[lvs.index(lv):]
-            unallocated = reduce(lambda x,y: x+y,
-                                 [l.req_size for l in todo
-                                  if l.req_grow and not l.req_percent])
-            extra_portion = float(lv.req_size) / float(unallocated)
-            extra = extra_portion * leftover
-            log.debug("%s getting %dMB (%d%%) of %dMB leftover space"
-                      % (lv.name, extra, extra_portion * 100, leftover))
-            leftover -= extra
-            grow += extra
-            log.debug("grow is now %dMB" % grow)
-            max_size = lv.req_size + grow
-            if lv.req_max_size and max_size > lv.req_max_size:
-                max_size = lv.req_max_size
-
-            if lv.format.maxSize and max_size > lv.format.maxSize:
-                max_size = lv.format.maxSize
-
-            log.debug("max size is %dMB" % max_size)
-            max_size = max_size
-            leftover += (lv.req_size + grow) - max_size
-            grow = max_size - lv.req_size
-            log.debug("lv %s gets %dMB" % (lv.name, vg.align(grow)))
-            grow_amounts[lv.name] = vg.align(grow)
-
-        if not grow_amounts:
-            log.debug("no growable lvs in vg %s" % vg.name)
-            continue
-
-        # now grow the lvs by the amounts we've calculated above
-        for lv in lvs:
-            if lv.name not in grow_amounts.keys():
+            n = long(lv.req_percent * 0.01 * total_free // vg.peSize)
+            if caps[i] is not None:
+                n = min(n, caps[i])
+
+            growth[i] = min(n, free)
+            free -= growth[i]
+
+        # the others share what is left after that
+        others = [i for (i, lv) in enumerate(lvs) if not lv.req_percent]
+        shares = allocateExtents(free,
+                                 [lvs[i].req_size * lvs[i].stripes
+                                  for i in others],
+                                 [caps[i] for i in others])
+        for (i, n) in zip(others, shares):
+            growth[i] = n
+
+        amounts = {}
+        for (lv, n) in zip(lvs, growth):
+            n //= lv.stripes
+            if not n:
                 continue
-            lv.size += grow_amounts[lv.name]
-
-        # now there shouldn't be any free space left, but if there is we
-        # should allocate it to one of the LVs
-        vg_free = vg.freeSpace
-        log.debug("vg %s has %dMB free" % (vg.name, vg_free))
-        if vg_free:
-            for lv in lvs:
-                if not lv.req_grow:
-                    continue
-
-                if lv.req_max_size and lv.size == lv.req_max_size:
-                    continue
-
-                if lv.format.maxSize and lv.size == lv.format.maxSize:
-                    continue
-
-                # first come, first served
-                projected = lv.size + vg.freeSpace
-                if lv.req_max_size and projected > lv.req_max_size:
-                    projected = lv.req_max_size
-
-                if lv.format.maxSize and projected > lv.format.maxSize:
-                    projected = lv.format.maxSize
 
-                log.debug("giving leftover %dMB to %s" % (projected - lv.size,
-                                                          lv.name))
-                lv.size = projected
+            log.debug("lv %s gets %d extents (%dMB)"
+                      % (lv.name, n, n * vg.peSize))
+            amounts[lv] = n
 
+        vg.growLVs(amounts)
+        log.debug("vg %s has %dMB free" % (vg.name, vg.freeSpace))
@@ -21,9 +21,11 @@
 #
 
 import os
+import copy
 
 import iutil
 from errors import *
+import baseudev
 from baseudev import *
 
 import logging
@@ -34,25 +36,7 @@ def udev_resolve_devspec(devspec):
         return None
 
     import devices as _devices
-    ret = None
-    for dev in udev_get_block_devices():
-        if devspec.startswith("LABEL="):
-            if udev_device_get_label(dev) == devspec[6:]:
-                ret = dev
-                break
-        elif devspec.startswith("UUID="):
-            if udev_device_get_uuid(dev) == devspec[5:]:
-                ret = dev
-                break
-        elif udev_device_get_name(dev) == _devices.devicePathToName(devspec):
-            ret = dev
-            break
-        else:
-            for link in dev["symlinks"]:
-                if devspec == link:
-                    ret = dev
-                    break
-
+    ret = global_snapshot.resolve(devspec, _devices.devicePathToName(devspec))
     del _devices
     if ret:
         return udev_device_get_name(ret)
@@ -64,7 +48,14 @@ def udev_resolve_glob(glob):
     if not glob:
         return ret
 
-    for dev in udev_get_block_devices():
+    # settle and skip stopped md arrays, as udev_get_block_devices does
+    global_snapshot.refresh()
+    if not any(c in glob for c in "*?["):
+        # no wildcards, so the indexes can answer it
+        return [udev_device_get_name(dev) for dev in
+                _usable_block_devices(global_snapshot.lookup(glob))]
+
+    for dev in _usable_block_devices(global_snapshot.devices):
         name = udev_device_get_name(dev)
 
         if fnmatch.fnmatch(name, glob):
@@ -76,27 +67,237 @@ def udev_resolve_glob(glob):
 
     return ret
 
+def _usable_block_devices(entries):
+    usable = []
+    for entry in entries:
+        if entry["name"].startswith("md"):
+            # mdraid is really braindead, when a device is stopped
+            # it is no longer usefull in anyway (and we should not
+            # probe it) yet it still sticks around, see bug rh523387
+            state = None
+            state_file = "/sys/%s/md/array_state" % entry["sysfs_path"]
+            if os.access(state_file, os.R_OK):
+                with open(state_file) as state_f:
+                    state = state_f.read().strip()
+            if state == "clear":
+                continue
+        # callers are free to modify their entries
+        usable.append(copy.copy(entry))
+    return usable
+
 def udev_get_block_devices():
-    udev_settle()
-    entries = []
-    for path in udev_enumerate_block_devices():
+    global_snapshot.refresh()
+    return _usable_block_devices(global_snapshot.devices)
+
+def udev_wait_for_block_devices(timeout=0):
+    """ Return the block devices added or changed since the last call.
+
+        Wait for udev to settle, then wait up to timeout seconds for
+        further events. An empty list means udev has gone quiet.
+    """
+    return _usable_block_devices(global_snapshot.wait(timeout))
+
+class UdevSnapshot(object):
+    """ A cached copy of the udev database entries for block devices.
+
+        The first refresh waits for udev to settle and reads every block
+        device.  After that a udev event monitor tells us which devices
+        were added, changed or removed, so a refresh only rereads those.
+        The list of block devices in sysfs is still compared on each
+        refresh so that devices whose events were missed are picked up.
+
+        Entries are keyed by sysfs path and also indexed by name, symlink,
+        filesystem UUID and filesystem label.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._order = []
+        self._ignored = set()
+        self._monitor = None
+        self._scanned = False
+
+        # devices (re)read since the last wait, whichever call read them
+        self._pending = set()
+        self._triggers = None
+        self._indexes = {"name": {}, "symlink": {}, "uuid": {}, "label": {}}
+
+        # how often the snapshot had to be read from scratch and how many
+        # entries were (re)read, for the logs
+        self.scans = 0
+        self.reads = 0
+
+    @property
+    def devices(self):
+        """ The block device entries, in udev enumeration order. """
+        return [self._entries[path] for path in self._order]
+
+    def _entryKeys(self, entry):
+        keys = {"name": [udev_device_get_name(entry)],
+                "symlink": entry.get("symlinks", []),
+                "uuid": [udev_device_get_uuid(entry)],
+                "label": [udev_device_get_label(entry)]}
+        return keys
+
+    def _add(self, path):
+        """ (Re)read the entry for a sysfs path. """
+        self._remove(path)
+        if _is_blacklisted_blockdev(os.path.basename(path)):
+            self._ignored.add(path)
+            return
+
         entry = udev_get_block_device(path)
-        if entry:
-            if entry["name"].startswith("md"):
-                # mdraid is really braindead, when a device is stopped
-                # it is no longer usefull in anyway (and we should not
-                # probe it) yet it still sticks around, see bug rh523387
-                state = None
-                state_file = "/sys/%s/md/array_state" % entry["sysfs_path"]
-                if os.access(state_file, os.R_OK):
-                    with open(state_file) as state_f:
-                        state = state_f.read().strip()
-                if state == "clear":
-                    continue
-            entries.append(entry)
-    return entries
-
-def __is_blacklisted_blockdev(dev_name):
+        self.reads += 1
+        if not entry:
+            return
+
+        self._entries[path] = entry
+        self._pending.add(path)
+        for (kind, keys) in self._entryKeys(entry).items():
+            for key in keys:
+                if key:
+                    self._indexes[kind].setdefault(key, set()).add(path)
+
+    def _remove(self, path):
+        self._ignored.discard(path)
+        self._pending.discard(path)
+        entry = self._entries.pop(path, None)
+        if not entry:
+            return
+
+        for (kind, keys) in self._entryKeys(entry).items():
+            for key in keys:
+                paths = self._indexes[kind].get(key)
+                if paths:
+                    paths.discard(path)
+                    if not paths:
+                        del self._indexes[kind][key]
+
+    def _scan(self):
+        """ Read all of the block devices from scratch. """
+        if not self._scanned:
+            self._monitor = baseudev.global_udev.create_monitor("block")
+            self._scanned = True
+
+        self.scans += 1
+        udev_settle()
+        if self._monitor:
+            # everything queued so far is covered by the scan below
+            self._monitor.receive_events()
+
+        self._entries = {}
+        self._ignored = set()
+        for index in self._indexes.values():
+            index.clear()
+
+        self._order = udev_enumerate_devices(deviceClass="block")
+        for path in self._order:
+            self._add(path)
+
+        self._order = [p for p in self._order if p in self._entries]
+        self._pending.clear()
+
+    def refresh(self, settle=True):
+        """ Bring the snapshot up to date with the udev database.
+
+            Unless settle is False, wait for udev to finish processing
+            the events already queued first. Running udev_trigger always
+            makes the next refresh wait.
+        """
+        if baseudev.trigger_count != self._triggers:
+            settle = True
+            self._triggers = baseudev.trigger_count
+
+        if not self._scanned or not self._monitor:
+            self._scan()
+            return
+
+        if settle:
+            udev_settle()
+
+        self._update(self._receive(self._monitor.receive_events()))
+
+    def _update(self, changed):
+        """ Reread the changed paths and compare the snapshot with the
+            block devices in sysfs.
+
+            Events are lost when the monitor's socket buffer overflows, so
+            devices the monitor did not tell us about are picked up here.
+        """
+        order = udev_enumerate_devices(deviceClass="block")
+        for path in order:
+            if path in changed or \
+               (path not in self._entries and path not in self._ignored):
+                self._add(path)
+
+        current = set(order)
+        for path in self._entries.keys():
+            if path not in current:
+                self._remove(path)
+
+        self._order = [p for p in order if p in self._entries]
+
+    def _receive(self, events):
+        """ Drop removed devices and return the paths of the others. """
+        changed = set()
+        for (action, syspath) in events:
+            path = syspath[4:]
+            if action == "remove":
+                self._remove(path)
+                changed.discard(path)
+            else:
+                changed.add(path)
+
+        return changed
+
+    def wait(self, timeout=0):
+        """ Apply the udev events that arrive after udev settles.
+
+            Wait up to timeout seconds for the first event. Return the
+            entries of the devices that were added or changed since the
+            last wait, including those picked up by refreshes since, in
+            enumeration order.
+        """
+        if not self._scanned or not self._monitor:
+            # nothing to wait on, so compare full scans the old way
+            self._scan()
+            return self.devices
+
+        udev_settle()
+        self._update(self._receive(self._monitor.receive_events(timeout)))
+        changed = [self._entries[p] for p in self._order if p in self._pending]
+        self._pending.clear()
+        return changed
+
+    def lookup(self, devspec):
+        """ Return the entries named or symlinked by devspec, in order. """
+        paths = set()
+        for kind in ("name", "symlink"):
+            paths.update(self._indexes[kind].get(devspec, []))
+
+        return [self._entries[p] for p in self._order if p in paths]
+
+    def resolve(self, devspec, name=None):
+        """ Return the entry for a LABEL=, UUID=, name or symlink spec.
+
+            name is the device name devspec refers to, if it differs
+            from devspec itself.
+        """
+        self.refresh(settle=False)
+        if devspec.startswith("LABEL="):
+            paths = self._indexes["label"].get(devspec[6:], set())
+        elif devspec.startswith("UUID="):
+            paths = self._indexes["uuid"].get(devspec[5:], set())
+        else:
+            paths = set(self._indexes["name"].get(name or devspec, []))
+            paths.update(self._indexes["symlink"].get(devspec, []))
+
+        for path in self._order:
+            if path in paths:
+                return self._entries[path]
+
+        return None
+
+def _is_blacklisted_blockdev(dev_name):
     """Is this a blockdev we never want for an install?"""
     if dev_name.startswith("loop") or dev_name.startswith("ram") or dev_name.startswith("fd"):
         return True
@@ -115,7 +316,7 @@ def __is_blacklisted_blockdev(dev_name):
 def udev_enumerate_block_devices():
     import os.path
 
-    return filter(lambda d: not __is_blacklisted_blockdev(os.path.basename(d)),
+    return filter(lambda d: not _is_blacklisted_blockdev(os.path.basename(d)),
                   udev_enumerate_devices(deviceClass="block"))
 
 def udev_get_block_device(sysfs_path):
@@ -513,3 +714,5 @@ def udev_device_get_fcoe_identifier(info):
     path_components = udev_device_get_path(info).split("-")
 
     return path_components[3]
+
+global_snapshot = UdevSnapshot()
@@ -3,9 +3,9 @@ import os
 import subprocess
 
 
-def makeLoopDev(device_name, file_name):
+def makeLoopDev(device_name, file_name, size=100):
     proc = subprocess.Popen(["dd", "if=/dev/zero", "of=%s" % file_name,
-                             "bs=1024", "count=102400"],
+                             "bs=1024", "count=%d" % (size * 1024)],
                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     while True:
         proc.communicate()
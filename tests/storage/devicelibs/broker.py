@@ -0,0 +1,90 @@
+import unittest
+import storage.devicelibs.broker as broker
+import storage.devicelibs.lvm as lvm
+
+class BrokerTestCase(unittest.TestCase):
+
+    def testCommandStats(self):
+        ##
+        ## record
+        ##
+        stats = broker.CommandStats()
+        stats.record("lvm pvs", 0.0005)
+        stats.record("lvm pvs", 0.003)
+        stats.record("mdadm --examine", 10)
+
+        self.assertEqual(stats.counts, {"lvm pvs": 2, "mdadm --examine": 1})
+        self.assertEqual(stats.histograms["lvm pvs"][0], 1)
+        self.assertEqual(stats.histograms["lvm pvs"][2], 1)
+        self.assertEqual(stats.histograms["mdadm --examine"][-1], 1)
+
+        ##
+        ## summary
+        ##
+        lines = stats.summary()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("lvm pvs: 2 calls"))
+        self.assertTrue(lines[1].endswith(">5000ms:1"))
+
+        ##
+        ## reset
+        ##
+        stats.reset()
+        self.assertEqual(stats.summary(), [])
+
+    def testLVMShell(self):
+        ##
+        ## capture
+        ##
+        # arguments the shell would split differently are left to exec,
+        # without starting the shell
+        shell = broker.LVMShell()
+        self.assertEqual(shell.capture(["pvs", "--config",
+                                        'devices { filter=["r|sda|"] }']),
+                         None)
+        self.assertEqual(shell.capture(["pvs", ""]), None)
+        self.assertEqual(shell._proc, None)
+
+        shell.available = False
+        self.assertEqual(shell.capture(["pvs"]), None)
+
+        ##
+        ## stop
+        ##
+        shell.stop()
+        self.assertEqual(shell._proc, None)
+
+    def testLVMShellFilter(self):
+        ##
+        ## capture
+        ##
+        # pass
+        # queries with the --config filter lvm.py composes go to the shell
+        lvm.lvm_cc_addFilterRejectRegexp("sda")
+        try:
+            self.assertEqual(lvm.config_args,
+                             ["--config", 'devices{filter=["r|sda|"]}'])
+            argv = ["pvs", "--noheadings"] + lvm.config_args
+
+            shell = broker.LVMShell()
+            self.assertNotEqual(shell.capture(argv), None)
+            proc = shell._proc
+            self.assertNotEqual(proc, None)
+
+            # and the shell is reused for the next one
+            self.assertNotEqual(shell.capture(argv), None)
+            self.assertTrue(shell._proc is proc)
+
+            shell.stop()
+            self.assertEqual(shell._proc, None)
+            self.assertNotEqual(proc.returncode, None)
+        finally:
+            lvm.lvm_cc_resetFilter()
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(BrokerTestCase)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -132,6 +132,9 @@ class LVMTestCase(baseclass.DevicelibsTestCase):
         ##
         # pass
         self.assertEqual(lvm.lvactivate("test-vg", "test-lv"), None)
+        # several lvs at once
+        self.assertEqual(lvm.lvdeactivate("test-vg", ["test-lv"]), None)
+        self.assertEqual(lvm.lvactivate("test-vg", ["test-lv"]), None)
 
         # fail
         self.assertRaises(lvm.LVMError, lvm.lvactivate, "test-vg", "wrong-lv-name")
@@ -147,6 +150,20 @@ class LVMTestCase(baseclass.DevicelibsTestCase):
         # fail
         self.assertRaises(lvm.LVMError, lvm.lvs, "wrong-vg-name")
 
+        ##
+        ## pvreport
+        ##
+        # pass
+        lvm.flush_report()
+        info = lvm.pvreport(self._LOOP_DEV0)
+        self.assertEqual(info["LVM2_VG_NAME"], "test-vg")
+        self.assertEqual(info["LVM2_PV_COUNT"], "2")
+        self.assertTrue("test-lv" in info["LVM2_LV_NAME"])
+        self.assertEqual(lvm.lvorigin("test-vg", "test-lv"), "")
+
+        # fail
+        self.assertEqual(lvm.pvreport("/not/existing/device"), None)
+
         ##
         ## has_lvm
         ##
@@ -52,6 +52,25 @@ class MDRaidTestCase(baseclass.DevicelibsTestCase):
         # fail
         self.assertRaises(mdraid.MDRaidError, mdraid.mdcreate, "/dev/md1", 1, ["/not/existing/dev0", "/not/existing/dev1"])
 
+        ##
+        ## mdresync_progress
+        ##
+        # pass
+        self.assertEqual(len(mdraid.mdresync_progress("md0")), 2)
+
+        # fail
+        self.assertEqual(mdraid.mdresync_progress("not-existing-md"), None)
+
+        ##
+        ## mdthrottle_resync/mdrestore_resync
+        ##
+        # pass
+        speed_max = open("/proc/sys/dev/raid/speed_limit_max").read()
+        mdraid.mdthrottle_resync(100, 5000)
+        self.assertEqual(open("/proc/sys/dev/raid/speed_limit_max").read(), "5000\n")
+        mdraid.mdrestore_resync()
+        self.assertEqual(open("/proc/sys/dev/raid/speed_limit_max").read(), speed_max)
+
         ##
         ## mddeactivate
         ##
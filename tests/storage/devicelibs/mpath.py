@@ -22,6 +22,70 @@ size=10G features='1 queue_if_no_path' hwhandler='1 emc' wp=undef
         expected = {'mpatha':['sdb','sdc'], 'mpathb':['sda']}
         self.assertEqual(topology, expected)
 
+        ##
+        ## identifyMultipaths
+        ##
+        def disk(name, serial, **info):
+            d = {'name': name, 'sysfs_path': '/devices/test/block/' + name,
+                 'DEVTYPE': 'disk', 'ID_SERIAL': serial,
+                 'ID_SERIAL_SHORT': serial}
+            d.update(info)
+            return d
+
+        def part(name, serial):
+            return {'name': name, 'sysfs_path': '/devices/test/block/' + name,
+                    'DEVTYPE': 'partition', 'ID_SERIAL': serial,
+                    'ID_SERIAL_SHORT': serial}
+
+        devices = [disk('sr0', 'cd', DEVTYPE='cdrom'),
+                   disk('sda', '1ATA_disk', ID_VENDOR='ATA'), part('sda1', '1ATA_disk'),
+                   disk('sdb', '3600a'), part('sdb1', '3600a'),
+                   disk('sdc', '3600a'), part('sdc1', '3600a'),
+                   disk('sdd', '3600b'), disk('sde', '3600c'),
+                   disk('sdf', '3600c'), disk('sdg', '3600b'),
+                   disk('sdh', 'reader', ID_USB_DRIVER='usb-storage'),
+                   disk('sdi', 'reader', ID_USB_DRIVER='usb-storage'),
+                   disk('sdj', None)]
+        (singlepath, multipaths, partitions) = mpath.identifyMultipaths(devices)
+        self.assertEqual([d['name'] for d in singlepath],
+                         ['sda', 'sdh', 'sdi', 'sdj'])
+        self.assertEqual([[d['name'] for d in m] for m in multipaths],
+                         [['sdb', 'sdc'], ['sdd', 'sdg'], ['sde', 'sdf']])
+        self.assertEqual([d['name'] for d in partitions], ['sr0', 'sda1'])
+        self.assertEqual([d['ID_MPATH_NAME'] for d in multipaths[2]],
+                         ['mpathc', 'mpathc'])
+        self.assertEqual(multipaths[0][0]['ID_FS_TYPE'], 'multipath_member')
+        self.assertEqual(mpath._multipath_name(26), 'mpathaa')
+
+        # devices blacklisted in multipath.conf on an earlier scan
+        class Blacklisted(object):
+            def __init__(self, serial=None, vendor=None, model=None):
+                self.serial = serial
+                self.vendor = vendor
+                self.model = model
+
+        devices = [disk('sda', '3600a'), disk('sdb', '3600a'),
+                   disk('sdc', '3600b', ID_VENDOR='ACME', ID_MODEL='Array'),
+                   disk('sdd', '3600b', ID_VENDOR='ACME', ID_MODEL='Array'),
+                   disk('sde', '3600c'), disk('sdf', '3600c')]
+        blacklist = [Blacklisted(serial='3600a'),
+                     Blacklisted(vendor='ACME', model='Array')]
+        (singlepath, multipaths, partitions) = \
+            mpath.identifyMultipaths(devices, blacklist=blacklist)
+        self.assertEqual([d['name'] for d in singlepath],
+                         ['sda', 'sdb', 'sdc', 'sdd'])
+        self.assertEqual([[d['name'] for d in m] for m in multipaths],
+                         [['sde', 'sdf']])
+        self.assertEqual(multipaths[0][0]['ID_MPATH_NAME'], 'mpatha')
+
+        # paths are grouped by ID_SERIAL only, which MultipathDevice
+        # takes its identity from
+        devices = [disk('sda', None, ID_WWN='0x5000'),
+                   disk('sdb', None, ID_WWN='0x5000')]
+        (singlepath, multipaths, partitions) = mpath.identifyMultipaths(devices)
+        self.assertEqual([d['name'] for d in singlepath], ['sda', 'sdb'])
+        self.assertEqual(multipaths, [])
+
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(MPathTestCase)
 
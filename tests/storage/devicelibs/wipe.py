@@ -0,0 +1,57 @@
+import baseclass
+import unittest
+import os
+import storage.devicelibs.wipe as wipe
+
+class WipeTestCase(baseclass.DevicelibsTestCase):
+
+    def testWipe(self):
+        ##
+        ## wipe
+        ##
+        # pass
+        # the loop devices are 100MB
+        fd = os.open(self._LOOP_DEV0, os.O_WRONLY)
+        os.write(fd, "\xff" * 3 * wipe.MB)
+        os.lseek(fd, -wipe.MB, 2)
+        os.write(fd, "\xff" * wipe.MB)
+        os.close(fd)
+
+        ranges = [(0, wipe.MB), (-wipe.MB, wipe.MB),
+                  (2 * wipe.MB, 4096), (200 * wipe.MB, 4096)]
+        self.assertEqual(wipe.wipe(self._LOOP_DEV0, ranges),
+                         2 * wipe.MB + 4096)
+
+        f = open(self._LOOP_DEV0)
+        data = f.read(3 * wipe.MB)
+        f.seek(-wipe.MB, 2)
+        end = f.read()
+        f.close()
+        self.assertEqual(data[:wipe.MB], "\0" * wipe.MB)
+        self.assertEqual(data[wipe.MB:2 * wipe.MB], "\xff" * wipe.MB)
+        self.assertEqual(data[2 * wipe.MB:2 * wipe.MB + 4096], "\0" * 4096)
+        self.assertEqual(end, "\0" * wipe.MB)
+
+        # fail
+        self.assertRaises(OSError, wipe.wipe, "/not/existing/device", ranges)
+
+        ##
+        ## discard
+        ##
+        # pass
+        # the device only counts as zeroed if it reads back as zeroes
+        if wipe.discard(self._LOOP_DEV1):
+            f = open(self._LOOP_DEV1)
+            self.assertEqual(f.read(wipe.MB), "\0" * wipe.MB)
+            f.close()
+
+        # fail
+        self.assertRaises(OSError, wipe.discard, "/not/existing/device")
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(WipeTestCase)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+#
+# growlvm_benchmark.py
+# Compare growLVM with the LV-at-a-time loop it replaced.
+#
+# Copyright (C) 2009  Red Hat, Inc.  All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import time
+import random
+
+from storage.devices import StorageDevice, LVMVolumeGroupDevice, \
+                            LVMLogicalVolumeDevice
+from storage.formats import getFormat
+from storage.partitioning import growLVM
+
+SIZES = [10, 100, 1000]
+
+class FakeStorage(object):
+    def __init__(self, vgs):
+        self.vgs = vgs
+
+def makeVG(count, seed=0):
+    """ Return a VG with count LVs, a quarter of them fixed-size and the
+        rest growable, some up to a maximum size.
+    """
+    rand = random.Random(seed)
+    pv = StorageDevice("pv%d" % count, size=count * 4096,
+                       format=getFormat("lvmpv"), exists=True)
+    vg = LVMVolumeGroupDevice("vg%d" % count, [pv], peSize=4)
+    for i in range(count):
+        size = rand.choice([64, 100, 256, 500, 1000])
+        grow = i % 4 != 0
+        maxsize = None
+        if grow and rand.random() < 0.3:
+            maxsize = size * rand.choice([2, 3, 5])
+
+        LVMLogicalVolumeDevice("lv%d" % i, vg, size=size,
+                               grow=grow, maxsize=maxsize)
+
+    return vg
+
+def lvCompare(lv1, lv2):
+    """ More specifically defined lvs come first, the order the loop in
+        loopGrowVG grew them in.
+
+        < 1 => x < y
+          0 => x == y
+        > 1 => x > y
+    """
+    ret = 0
+
+    # larger requests go to the front of the list
+    ret -= cmp(lv1.size, lv2.size) * 100
+
+    # fixed size requests to the front
+    ret += cmp(lv1.req_grow, lv2.req_grow) * 50
+
+    # potentially larger growable requests go to the front
+    if lv1.req_grow and lv2.req_grow:
+        if not lv1.req_max_size and lv2.req_max_size:
+            ret -= 25
+        elif lv1.req_max_size and not lv2.req_max_size:
+            ret += 25
+        else:
+            ret -= cmp(lv1.req_max_size, lv2.req_max_size) * 25
+
+    if ret > 0:
+        ret = 1
+    elif ret < 0:
+        ret = -1
+
+    return ret
+
+def loopGrowVG(vg):
+    """ The growLVM loop as it was, for a single VG. """
+    total_free = vg.freeSpace
+    grow_amounts = {}
+    lv_total = vg.size - total_free
+    lvs = vg.lvs
+    lvs.sort(cmp=lvCompare)
+
+    leftover = 0
+    for lv in lvs:
+        if not lv.req_grow or lv.req_percent:
+            continue
+
+        portion = float(lv.req_size) / float(lv_total)
+        grow = portion * total_free
+        todo = lvs[lvs.index(lv):]
+        unallocated = reduce(lambda x,y: x+y,
+                             [l.req_size for l in todo
+                              if l.req_grow and not l.req_percent])
+        extra_portion = float(lv.req_size) / float(unallocated)
+        extra = extra_portion * leftover
+        leftover -= extra
+        grow += extra
+        max_size = lv.req_size + grow
+        if lv.req_max_size and max_size > lv.req_max_size:
+            max_size = lv.req_max_size
+
+        if lv.format.maxSize and max_size > lv.format.maxSize:
+            max_size = lv.format.maxSize
+
+        leftover += (lv.req_size + grow) - max_size
+        grow = max_size - lv.req_size
+        grow_amounts[lv.name] = vg.align(grow)
+
+    for lv in lvs:
+        if lv.name not in grow_amounts.keys():
+            continue
+        lv.size += grow_amounts[lv.name]
+
+    if vg.freeSpace:
+        for lv in lvs:
+            if not lv.req_grow:
+                continue
+
+            if lv.req_max_size and lv.size == lv.req_max_size:
+                continue
+
+            if lv.format.maxSize and lv.size == lv.format.maxSize:
+                continue
+
+            projected = lv.size + vg.freeSpace
+            if lv.req_max_size and projected > lv.req_max_size:
+                projected = lv.req_max_size
+
+            if lv.format.maxSize and projected > lv.format.maxSize:
+                projected = lv.format.maxSize
+
+            lv.size = projected
+
+def spread(vg):
+    """ Return the ratio between the largest and the smallest growth,
+        relative to requested size, of the LVs without a maximum.
+    """
+    ratios = [float(lv.size) / lv.req_size for lv in vg.lvs
+                if lv.req_grow and not lv.req_max_size]
+    return max(ratios) / min(ratios)
+
+def main():
+    print "%6s  %10s %8s %7s  %10s %8s %7s" % ("lvs", "loop", "free", "spread",
+                                               "growLVM", "free", "spread")
+    for count in SIZES:
+        vg = makeVG(count)
+        start = time.time()
+        loopGrowVG(vg)
+        loop_time = time.time() - start
+        loop_result = (vg.freeSpace, spread(vg))
+
+        vg = makeVG(count)
+        start = time.time()
+        growLVM(FakeStorage([vg]))
+        grow_time = time.time() - start
+        grow_result = (vg.freeSpace, spread(vg))
+
+        print "%6d  %9.3fs %6dMB %7.3f  %9.3fs %6dMB %7.3f" % \
+              ((count, loop_time) + loop_result + (grow_time,) + grow_result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+import os
+import unittest
+
+import parted
+
+import storage.partitioning as partitioning
+from storage.devices import DiskDevice, PartitionDevice
+from storage.errors import PartitioningError
+from storage.formats import getFormat
+
+from devicelibs import baseclass
+
+class PartitioningTestCase(unittest.TestCase):
+
+    def testAllocateExtents(self):
+        ##
+        ## allocateExtents
+        ##
+        # pass
+        # shares in proportion to the weights
+        self.assertEqual(partitioning.allocateExtents(100, [1, 3], [None, None]),
+                         [25, 75])
+
+        # all of the extents are used despite rounding
+        growth = partitioning.allocateExtents(100, [1, 1, 1], [None] * 3)
+        self.assertEqual(sum(growth), 100)
+        self.assertEqual(sorted(growth), [33, 33, 34])
+
+        # capped requests leave their share to the others
+        self.assertEqual(partitioning.allocateExtents(100, [1, 1, 2], [10, None, 30]),
+                         [10, 60, 30])
+
+        # with every request capped some extents stay free
+        self.assertEqual(partitioning.allocateExtents(100, [1, 1], [10, 20]),
+                         [10, 20])
+
+        # requests without weight or room get nothing
+        self.assertEqual(partitioning.allocateExtents(10, [0, 1, 1], [None, 0, None]),
+                         [0, 0, 10])
+        self.assertEqual(partitioning.allocateExtents(0, [1, 1], [None, None]),
+                         [0, 0])
+
+
+class Platform(object):
+    def __init__(self, bootDevice=None):
+        self._bootDevice = bootDevice
+
+    def bootDevice(self):
+        return self._bootDevice
+
+
+class Anaconda(object):
+    def __init__(self, bootDevice=None):
+        self.platform = Platform(bootDevice)
+
+
+class Storage(object):
+    """ The part of storage.Storage the partitioning code uses. """
+    def __init__(self, disks=None, partitions=None, bootDevice=None):
+        self.partitioned = disks or []
+        self.partitions = partitions or []
+        self.anaconda = Anaconda(bootDevice)
+
+    def compareDisks(self, first, second):
+        return cmp(first, second)
+
+    def deviceImmutable(self, device):
+        return False
+
+
+class IncrementalPartitioningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # disks that do not exist, so their labels never read anything
+        self.disks = [DiskDevice("testdisk%d" % i,
+                                 format=getFormat("disklabel",
+                                                  device="/dev/testdisk%d" % i))
+                        for i in range(4)]
+        self._planPartitions = partitioning._planPartitions
+        partitioning._planPartitions = self.planPartitions
+        self.planned = []
+
+    def tearDown(self):
+        partitioning._planPartitions = self._planPartitions
+
+    def planPartitions(self, storage, disks, partitions):
+        self.planned.append((disks, partitions))
+
+    def makeRequest(self, disks, **kwargs):
+        return PartitionDevice("req", size=100, parents=disks,
+                               format=getFormat(None), **kwargs)
+
+    def testGetAffectedDisks(self):
+        ##
+        ## getAffectedDisks
+        ##
+        # pass
+        (a, b, c, d) = self.disks
+        first = self.makeRequest([a])
+        second = self.makeRequest([a, b])
+        third = self.makeRequest([c])
+        storage = Storage(self.disks, [first, second, third])
+
+        # requests that compete for a disk affect each other's disks
+        self.assertEqual(partitioning.getAffectedDisks(storage, [first]),
+                         [a, b])
+        self.assertEqual(partitioning.getAffectedDisks(storage, [third]), [c])
+        self.assertEqual(partitioning.getAffectedDisks(storage, [d]), [d])
+        self.assertEqual(partitioning.getAffectedDisks(storage, []), [])
+
+        # a request moved to other disks affects the disk it is on, too
+        third.disk = d
+        self.assertEqual(partitioning.getAffectedDisks(storage, [third]),
+                         [c, d])
+        third.disk = None
+
+        # a request without disks competes with every other one
+        anywhere = self.makeRequest([])
+        storage.partitions.append(anywhere)
+        self.assertEqual(partitioning.getAffectedDisks(storage, [third]),
+                         self.disks)
+
+        # unless it keeps its allocation
+        self.assertEqual(partitioning.getAffectedDisks(storage, [third],
+                                                       fixed=[anywhere]),
+                         [c])
+
+    def testDoIncrementalPartitioning(self):
+        ##
+        ## doIncrementalPartitioning
+        ##
+        # pass
+        (a, b, c, d) = self.disks
+        boot = self.makeRequest([])
+        boot.disk = a
+        boot._partedPartition = True    # allocated
+        boot.req_bootable = True
+        first = self.makeRequest([b])
+        second = self.makeRequest([c, d])
+        storage = Storage(self.disks, [boot, first, second], bootDevice=boot)
+
+        # an allocated boot partition without disks does not pull every
+        # disk into an edit
+        self.assertEqual(partitioning.doIncrementalPartitioning(storage,
+                                                                [first]),
+                         [b])
+        self.assertEqual(self.planned.pop(), ([b], [first]))
+
+        self.assertEqual(partitioning.doIncrementalPartitioning(storage, [c]),
+                         [c, d])
+        self.assertEqual(self.planned.pop(), ([c, d], [second]))
+
+        # editing it does
+        self.assertEqual(partitioning.doIncrementalPartitioning(storage,
+                                                                [boot]),
+                         self.disks)
+        self.assertEqual(self.planned.pop(), (self.disks, storage.partitions))
+
+        # and so does a growable one, which may grow into any disk
+        boot.req_grow = True
+        self.assertEqual(partitioning.doIncrementalPartitioning(storage,
+                                                                [first]),
+                         self.disks)
+        self.planned.pop()
+        boot.req_grow = False
+
+        # a new boot partition re-plans the old and the new one
+        newBoot = self.makeRequest([d])
+        storage.partitions.append(newBoot)
+        storage.anaconda = Anaconda(newBoot)
+        self.assertEqual(partitioning.doIncrementalPartitioning(storage,
+                                                                [newBoot]),
+                         self.disks)
+        self.assertEqual(self.planned.pop(), (self.disks, storage.partitions))
+
+        # no change, nothing to re-plan
+        self.assertEqual(partitioning.doIncrementalPartitioning(Storage(), []),
+                         [])
+        self.assertEqual(self.planned, [])
+
+
+class DiskImageTestCase(unittest.TestCase):
+    """ Allocate partitions on disk images with an empty msdos label. """
+
+    def setUp(self):
+        self._loopDevices = []
+
+    def tearDown(self):
+        for (dev, file) in self._loopDevices:
+            baseclass.removeLoopDev(dev, file)
+
+    def makeDisks(self, sizes):
+        """ Return a DiskDevice for a new disk image of each size (in MB). """
+        disks = []
+        for size in sizes:
+            i = len(self._loopDevices)
+            dev = "/dev/loop%d" % i
+            file = "/tmp/test-partdisk%d" % i
+            baseclass.makeLoopDev(dev, file, size=size)
+            self._loopDevices.append((dev, file))
+
+            parted.freshDisk(parted.getDevice(dev), "msdos").commitToDevice()
+            disklabel = getFormat("disklabel", device=dev, exists=True)
+            disks.append(DiskDevice(os.path.basename(dev), format=disklabel))
+
+        return disks
+
+    def makeRequests(self, disks, sizes, **kwargs):
+        """ Return a new partition request of each size (in MB). """
+        return [PartitionDevice("req%d" % i, size=size, parents=disks, **kwargs)
+                    for (i, size) in enumerate(sizes)]
+
+    def getLayout(self, partitions):
+        return [(p.disk.name, p.partedPartition.type,
+                 p.partedPartition.geometry.start,
+                 p.partedPartition.geometry.end) for p in partitions]
+
+    def getDiskState(self, disk):
+        partedDisk = disk.format.partedDisk
+        return ([(p.type, p.geometry.start, p.geometry.end)
+                    for p in partedDisk.partitions],
+                [(g.start, g.end) for g in partedDisk.getFreeSpaceRegions()])
+
+
+class PartitionSearchTestCase(DiskImageTestCase):
+
+    def testSearch(self):
+        ##
+        ## allocatePartitionsSearch
+        ##
+        # pass
+        # the greedy allocator puts the 50MB and one 40MB request on the
+        # first disk and has no room left for the last 20MB request
+        disks = self.makeDisks([102, 102])
+        parts = self.makeRequests(disks, [50, 40, 40, 30, 20, 20])
+        free = partitioning.getFreeRegions(disks)
+        self.assertRaises(PartitioningError, partitioning.allocatePartitions,
+                          Storage(), disks, parts, free)
+
+        # the search finds the layout that fills both disks
+        partitioning.allocatePartitionsSearch(Storage(), disks, parts, free)
+        for part in parts:
+            self.assertNotEqual(part.partedPartition, None)
+            self.assertTrue(part.disk in disks)
+
+        self.assertEqual([sum([p.req_size for p in parts if p.disk is d])
+                            for d in disks],
+                         [100, 100])
+
+    def testUnplace(self):
+        ##
+        ## PartitionSearch._unplace
+        ##
+        # pass
+        disks = self.makeDisks([102])
+        disk = disks[0]
+        (first, second) = self.makeRequests(disks, [10, 20])
+        free = partitioning.getFreeRegions(disks)
+        search = partitioning.PartitionSearch(Storage(), disks,
+                                              [first, second], free, 5)
+        empty = self.getDiskState(disk)
+
+        self.assertTrue(search._place(first, disk, parted.PARTITION_NORMAL))
+        placed = self.getDiskState(disk)
+
+        # a logical partition brings its extended partition along
+        self.assertTrue(search._place(second, disk, parted.PARTITION_EXTENDED))
+        self.assertNotEqual(disk.format.extendedPartition, None)
+        self.assertEqual(second.partedPartition.type, parted.PARTITION_LOGICAL)
+
+        # removing it leaves the disk as it was, extended partition included
+        search._unplace()
+        self.assertEqual(self.getDiskState(disk), placed)
+        self.assertEqual(disk.format.extendedPartition, None)
+        self.assertEqual(second.partedPartition, None)
+        self.assertEqual(second.disk, None)
+        self.assertEqual(search.placed[disk.path], [first])
+        self.assertEqual(len(search.choices), 1)
+
+        # the free space index sees the restored disk
+        for part_type in (parted.PARTITION_NORMAL, parted.PARTITION_EXTENDED):
+            self.assertEqual([(g.start, g.end) for g in
+                                search.index.getFreeRegions(disk.format.partedDisk,
+                                                            part_type)],
+                             [(g.start, g.end) for g in
+                                partitioning.getFreeRegionsForType(
+                                                disk.format.partedDisk,
+                                                part_type)])
+
+        search._unplace()
+        self.assertEqual(self.getDiskState(disk), empty)
+        self.assertEqual(first.partedPartition, None)
+        self.assertEqual(search.placed[disk.path], [])
+        self.assertEqual(search.choices, [])
+
+    def testTimeout(self):
+        ##
+        ## allocatePartitionsSearch
+        ##
+        # a search without any time finds no layout
+        disks = self.makeDisks([102, 102])
+        parts = self.makeRequests(disks, [50, 40, 40, 30, 20, 20])
+        free = partitioning.getFreeRegions(disks)
+        search = partitioning.PartitionSearch(Storage(), disks, parts, free, -1)
+        self.assertFalse(search.run())
+        self.assertTrue(search.timedOut)
+        self.assertEqual(search.best, None)
+
+        # fail
+        # so the greedy allocator is used, which cannot fit these requests
+        self.assertRaises(PartitioningError,
+                          partitioning.allocatePartitionsSearch,
+                          Storage(), disks, parts, free, timeout=-1)
+
+        # pass
+        # and places requests it can fit the same as when called directly
+        partitioning.removeNewPartitions(disks, parts)
+        parts = self.makeRequests(disks, [50, 40, 30])
+        parts += self.makeRequests(disks, [10, 20], grow=True)
+        partitioning.allocatePartitions(Storage(), disks, parts, free)
+        greedy = self.getLayout(parts)
+
+        partitioning.allocatePartitionsSearch(Storage(), disks, parts, free,
+                                              timeout=-1)
+        self.assertEqual(self.getLayout(parts), greedy)
+
+
+class UncachedDiskGrowth(partitioning.DiskGrowthCache):
+    """ A growth cache that works out the growth of a disk every time. """
+    def getGrowth(self, disk, partitions):
+        self.invalidate(disk)
+        return super(UncachedDiskGrowth, self).getGrowth(disk, partitions)
+
+
+class AllocatePartitionsTestCase(DiskImageTestCase):
+
+    def testFreeSpaceIndex(self):
+        ##
+        ## FreeSpaceIndex.getBestFreeSpaceRegion
+        ##
+        # pass
+        disks = self.makeDisks([202])
+        disklabel = disks[0].format
+        partedDisk = disklabel.partedDisk
+
+        def add(part_type, size):
+            free = partitioning.getFreeRegionsForType(partedDisk, part_type)[-1]
+            return partitioning.addPartition(disklabel, free, part_type, size)
+
+        # leave free regions of different sizes in and outside of an
+        # extended partition
+        primaries = [add(parted.PARTITION_NORMAL, size) for size in [10, 30, 20]]
+        add(parted.PARTITION_EXTENDED, None)
+        logicals = [add(parted.PARTITION_LOGICAL, size)
+                        for size in [10, 20, 10, 30, 10]]
+        for partition in [primaries[0], primaries[2], logicals[0], logicals[3]]:
+            partedDisk.removePartition(partition)
+
+        geometry = lambda g: g and (g.start, g.end)
+        index = partitioning.FreeSpaceIndex()
+        for part_type in (parted.PARTITION_NORMAL, parted.PARTITION_LOGICAL):
+            regions = partitioning.getFreeRegionsForType(partedDisk, part_type)
+            self.assertTrue(len(regions) > 1)
+            for req_size in [1, 10, 15, 20, 25, 30, 50, 500]:
+                for (boot, grow) in [(True, False), (False, True), (False, False)]:
+                    for best_free in [None] + regions:
+                        expected = partitioning.getBestFreeSpaceRegion(
+                                            partedDisk, part_type, req_size,
+                                            boot=boot, best_free=best_free,
+                                            grow=grow)
+                        found = index.getBestFreeSpaceRegion(
+                                            partedDisk, part_type, req_size,
+                                            boot=boot, best_free=best_free,
+                                            grow=grow)
+                        self.assertEqual(geometry(found), geometry(expected))
+
+    def testGrowthCache(self):
+        ##
+        ## allocatePartitions
+        ##
+        # pass
+        disks = self.makeDisks([102, 152, 202])
+        parts = self.makeRequests(disks, [30])
+        parts += self.makeRequests(disks[:1], [20])
+        parts += self.makeRequests(disks, [10, 30, 50], grow=True)
+        parts += self.makeRequests(disks, [20], grow=True, maxsize=40)
+        parts += self.makeRequests(disks[1:], [25], grow=True)
+        free = partitioning.getFreeRegions(disks)
+
+        partitioning.allocatePartitions(Storage(), disks, parts, free)
+        cached = self.getLayout(parts)
+        self.assertEqual(len(set([p[0] for p in cached])), len(disks))
+
+        # working out the growth of every disk for every candidate layout
+        # chooses the same disks and regions
+        cache = partitioning.DiskGrowthCache
+        partitioning.DiskGrowthCache = UncachedDiskGrowth
+        try:
+            partitioning.allocatePartitions(Storage(), disks, parts, free)
+        finally:
+            partitioning.DiskGrowthCache = cache
+
+        self.assertEqual(self.getLayout(parts), cached)
+
+
+def suite():
+    return unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(PartitioningTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(IncrementalPartitioningTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(PartitionSearchTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(AllocatePartitionsTestCase)])
+
+
+if __name__ == "__main__":
+    unittest.main()